@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Admission control and load shedding for the REST server
+"""
+
+import math
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: rate tokens per second, up to burst tokens
+    kept in reserve.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self):
+        """
+        Take a token. Return 0 on success, otherwise the delay in seconds
+        until a token is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionLimits:
+    """
+    Configurable limits of the REST server. A limit set to None is not
+    enforced.
+    """
+    def __init__(self, max_connections=64, max_inflight_per_client=4,
+            max_queue_depth=32, client_rate=20, client_burst=40,
+            retry_after=1):
+        self.max_connections = max_connections
+        self.max_inflight_per_client = max_inflight_per_client
+        self.max_queue_depth = max_queue_depth
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.retry_after = retry_after
+
+class Rejection:
+    """
+    Reason why a request is refused, as an HTTP status and a Retry-After
+    delay.
+    """
+    def __init__(self, status_code, reason, retry_after):
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class AdmissionController:
+    """
+    Track connections and in-flight requests, and decide whether new ones
+    are accepted.
+
+    Clients are identified by their address; each of them has its own
+    token bucket and in-flight request count. Requests are counted in
+    flight while their handler runs, as they are what queues work on the
+    gateway.
+    """
+    # Number of idle clients whose token bucket is remembered
+    MAX_TRACKED_CLIENTS = 1024
+
+    def __init__(self, limits=None):
+        self.limits = limits or AdmissionLimits()
+        self.connections = 0
+        self.inflight = 0
+        self.client_inflight = {}
+        self.buckets = OrderedDict()
+
+    def open_connection(self):
+        """
+        Register a new connection. Return a Rejection when there are too
+        many of them, None otherwise.
+        """
+        if self.limits.max_connections is not None and \
+                self.connections >= self.limits.max_connections:
+            return Rejection(503, b'Service unavailable', self.limits.retry_after)
+        self.connections += 1
+        return None
+
+    def close_connection(self):
+        self.connections -= 1
+
+    def bucket(self, client):
+        try:
+            self.buckets.move_to_end(client)
+            return self.buckets[client]
+        except KeyError:
+            bucket = self.buckets[client] = TokenBucket(
+                    self.limits.client_rate, self.limits.client_burst)
+            while len(self.buckets) > self.MAX_TRACKED_CLIENTS:
+                self.buckets.popitem(last=False)
+            return bucket
+
+    def admit(self, client):
+        """
+        Decide whether a request from client may be handled now. Return
+        a Rejection, or None after having counted the request in flight;
+        release must then be called once it is done.
+        """
+        limits = self.limits
+        if limits.max_queue_depth is not None and \
+                self.inflight >= limits.max_queue_depth:
+            return Rejection(503, b'Service unavailable', limits.retry_after)
+
+        if limits.max_inflight_per_client is not None and \
+                self.client_inflight.get(client, 0) >= limits.max_inflight_per_client:
+            return Rejection(429, b'Too many requests', limits.retry_after)
+
+        if limits.client_rate is not None:
+            delay = self.bucket(client).take()
+            if delay:
+                return Rejection(429, b'Too many requests', delay)
+
+        self.inflight += 1
+        self.client_inflight[client] = self.client_inflight.get(client, 0) + 1
+        return None
+
+    def release(self, client):
+        self.inflight -= 1
+        count = self.client_inflight[client] - 1
+        if count:
+            self.client_inflight[client] = count
+        else:
+            del self.client_inflight[client]
@@ -0,0 +1,215 @@
+#!env python3
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks of the frame codec and SLIP framing.
+
+Each benchmark reports its throughput in operations per second and the
+peak memory allocated by one operation. Results can be saved as a
+baseline, and later runs compared against it: the exit status is 1 when
+a benchmark regressed beyond the tolerance.
+
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import random
+import re
+import struct
+import sys
+import time
+import tracemalloc
+
+import messages.command_handler
+import messages.fp
+import messages.info
+from client import KlfConnection
+from messages.base import KlfGwResponse, KlfGwResponseMetaclass
+from simulator import build_frame
+
+CHUNK_SIZES = (1, 64, 1024, 16384)
+ESCAPE_DENSITIES = (0, 0.1, 0.5)
+FRAMES_PER_STREAM = 200
+
+def make_stream(escape_density, frames=FRAMES_PER_STREAM):
+    """
+    Return SLIP-encoded GetAllNodesInformationNtf frames, whose node
+    names contain the given proportion of bytes needing an escape.
+    """
+    generator = random.Random(0)
+    stream = b''
+    for node_id in range(frames):
+        name = bytes(generator.choice(b'\xc0\xdb')
+                if generator.random() < escape_density
+                else generator.randrange(0x20, 0x7f) for i in range(64))
+        stream += KlfConnection.slip_pack(build_frame(
+            messages.info.GetAllNodesInformationNtf, node_id % 200, 0, 0,
+            name, 0, 0, 0, 0, 0, 0, 0, b'\0' * 8, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+            0, 0, 0, 0, 0, 0))
+    return stream
+
+def zero_response_frame(response_class):
+    """
+    Build a frame of the given response class with all arguments null.
+    """
+    arguments_format = '>' + (getattr(response_class, 'arguments_format', None) or '')
+    arguments = struct.unpack(arguments_format, bytes(struct.calcsize(arguments_format)))
+    return build_frame(response_class, *arguments)
+
+class Benchmark:
+    """
+    Operation to measure. Calling function performs ops operations.
+    """
+    def __init__(self, name, function, ops=1):
+        self.name = name
+        self.function = function
+        self.ops = ops
+
+    def run(self, min_time):
+        """
+        Return (operations per second, peak bytes per operation).
+        """
+        function = self.function
+        function()
+
+        calls = 0
+        start = time.perf_counter()
+        elapsed = 0
+        while elapsed < min_time:
+            for i in range(10):
+                function()
+            calls += 10
+            elapsed = time.perf_counter() - start
+        ops_per_second = calls * self.ops / elapsed
+
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            function()
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+        return ops_per_second, peak / self.ops
+
+def receive_data_benchmark(chunk_size, escape_density):
+    stream = make_stream(escape_density)
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    connection = KlfConnection()
+
+    def receive():
+        for chunk in chunks:
+            connection.receive_data(chunk)
+        for event in connection.iter_events():
+            pass
+
+    return Benchmark('receive_data[chunk={chunk},escapes={density}]'.format(
+        chunk=chunk_size, density=escape_density), receive, FRAMES_PER_STREAM)
+
+def build_benchmarks():
+    benchmarks = [receive_data_benchmark(chunk_size, escape_density)
+            for escape_density in ESCAPE_DENSITIES
+            for chunk_size in CHUNK_SIZES]
+
+    for escape_density in ESCAPE_DENSITIES:
+        frame = make_stream(escape_density, 1)[1:-1]
+        benchmarks.append(Benchmark('slip_pack[escapes={}]'.format(escape_density),
+            lambda frame=frame: KlfConnection.slip_pack(frame)))
+
+    request = messages.command_handler.CommandSendReq(
+            main_parameter=messages.fp.Relative(0.5),
+            nodes=tuple(range(20)))
+    benchmarks.append(Benchmark('CommandSendReq.__bytes__',
+        lambda: bytes(request)))
+    request.free_session(request.session_id)
+
+    for klf_command, response_class in sorted(
+            KlfGwResponseMetaclass._klf_response_class.items()):
+        frame = zero_response_frame(response_class)
+        try:
+            KlfGwResponse(frame)
+        except Exception:
+            # Null arguments are not valid for every response
+            continue
+        benchmarks.append(Benchmark('response[{}]'.format(response_class.__name__),
+            lambda frame=frame: KlfGwResponse(frame)))
+
+    return benchmarks
+
+def compare(results, baseline, tolerance):
+    """
+    Return the list of regression descriptions of results against
+    baseline.
+    """
+    regressions = []
+    for name, (ops_per_second, bytes_per_op) in results.items():
+        if name not in baseline:
+            continue
+        base_ops, base_bytes = baseline[name]
+        if ops_per_second < base_ops * (1 - tolerance):
+            regressions.append("{name}: {ops:.0f} ops/s, baseline {base:.0f}".format(
+                name=name, ops=ops_per_second, base=base_ops))
+        # Small absolute slack: tracemalloc peaks vary by a few blocks
+        if bytes_per_op > base_bytes * (1 + tolerance) + 64:
+            regressions.append("{name}: {bytes:.0f} B/op, baseline {base:.0f}".format(
+                name=name, bytes=bytes_per_op, base=base_bytes))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame codec micro-benchmarks")
+    parser.add_argument('--baseline', help="compare against this baseline file")
+    parser.add_argument('--save-baseline', help="save results to this file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help="allowed relative regression (default 0.2)")
+    parser.add_argument('--min-time', type=float, default=0.2,
+            help="minimal duration of each benchmark, in seconds")
+    parser.add_argument('--filter', help="only run benchmarks matching this regex")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    for benchmark in build_benchmarks():
+        if args.filter and not re.search(args.filter, benchmark.name):
+            continue
+        ops_per_second, bytes_per_op = benchmark.run(args.min_time)
+        results[benchmark.name] = (ops_per_second, bytes_per_op)
+
+        line = '{name:<45} {ops:>12.0f} ops/s {bytes:>9.0f} B/op'.format(
+                name=benchmark.name, ops=ops_per_second, bytes=bytes_per_op)
+        if benchmark.name in baseline:
+            line += ' {:>+7.1%}'.format(ops_per_second / baseline[benchmark.name][0] - 1)
+        print(line)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
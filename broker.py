@@ -0,0 +1,450 @@
+#!env python3
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Gateway connection shared by several REST worker processes.
+
+The broker process owns the connection to the gateway. Workers connect
+to it through a Unix domain socket, and exchange messages made of a
+header, holding the message length (4 bytes, excluding the length
+itself), type (1 byte) and correlation id (4 bytes), followed by a raw
+KLF200 frame:
+
+    HELLO    broker -> worker, correlation id is the worker index
+    REQUEST  worker -> broker, request frame
+    CONFIRM  broker -> worker, confirmation frame of a request
+    ERROR    broker -> worker, ErrorNtf frame answering a request
+    FAILURE  broker -> worker, UTF-8 error message for a request
+    NOTIFY   broker -> worker, frame received from the gateway
+
+Each worker allocates session ids from its own range, so that the
+gateway sees unique sessions. Frames about a session are only notified
+to the worker owning its range; the other frames go to every worker.
+
+The socket lives in a directory only its owner can enter, and workers
+may only send the requests of BROKER_COMMANDS: configuration changes
+such as passwords or a reset to the virgin state are not relayed.
+A worker exits when it loses the broker, which then starts another one.
+
+    python broker.py broker --config klf200.ini --workers 4
+    python broker.py worker
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+
+import messages.commands
+from client import KlfClient
+from framelog import COMMAND_NAMES, FRAME_IN, FRAME_OUT, redact_frame
+from logs import setup_logging
+from messages.base import KlfError, KlfGwResponse, KlfGwResponseMetaclass
+from messages.command_handler import KlfSessionId
+from metrics import REGISTRY
+
+logger = logging.getLogger('klf.broker')
+
+MSG_HELLO = 0
+MSG_REQUEST = 1
+MSG_CONFIRM = 2
+MSG_ERROR = 3
+MSG_FAILURE = 4
+MSG_NOTIFY = 5
+
+HEADER = struct.Struct('>IBI')
+
+# Session ids of worker n range from n * SESSION_BLOCK, block 0 being
+# left to the broker process itself.
+SESSION_BLOCK = 4096
+MAX_WORKERS = 2 ** 16 // SESSION_BLOCK - 1
+
+# Seconds between two checks of the worker processes by the broker
+WORKER_CHECK_INTERVAL = 1
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+        'klf200-broker-{}'.format(os.getuid()), 'broker.sock')
+
+# Requests which workers may send through the broker: those of the REST
+# and WebSocket servers, minus the gateway configuration ones.
+BROKER_COMMANDS = frozenset((
+    messages.commands.GW_GET_VERSION_REQ,
+    messages.commands.GW_GET_PROTOCOL_VERSION_REQ,
+    messages.commands.GW_GET_STATE_REQ,
+    messages.commands.GW_GET_NETWORK_SETUP_REQ,
+    messages.commands.GW_GET_LOCAL_TIME_REQ,
+    messages.commands.GW_SET_UTC_REQ,
+    messages.commands.GW_RTC_SET_TIME_ZONE_REQ,
+    messages.commands.GW_GET_ALL_NODES_INFORMATION_REQ,
+    messages.commands.GW_COMMAND_SEND_REQ,
+    messages.commands.GW_STATUS_REQUEST_REQ,
+    messages.commands.GW_WINK_SEND_REQ,
+    messages.commands.GW_ACTIVATE_SCENE_REQ,
+))
+
+BROKER_WORKERS = REGISTRY.gauge('klf_broker_workers',
+        'Worker processes connected to the broker')
+DROPPED_NOTIFICATIONS = REGISTRY.counter('klf_broker_dropped_notifications_total',
+        'Notifications not sent to a worker which does not keep up')
+
+class KlfBrokerError(Exception):
+    """
+    Exception raised when the broker cannot handle a request.
+    """
+    pass
+
+def pack_message(message_type, correlation_id, payload=b''):
+    return HEADER.pack(len(payload) + HEADER.size - 4, message_type,
+            correlation_id) + payload
+
+async def read_message(reader):
+    """
+    Read a message and return its (type, correlation id, payload).
+    """
+    length, message_type, correlation_id = HEADER.unpack(
+            await reader.readexactly(HEADER.size))
+    payload = await reader.readexactly(length - (HEADER.size - 4))
+    return message_type, correlation_id, payload
+
+class KlfRawRequest:
+    """
+    Request frame built by a worker, sent to the gateway as is.
+    """
+    def __init__(self, frame, cfm_type):
+        self.frame = frame
+        self.cfm_type = cfm_type
+
+    def __bytes__(self):
+        return self.frame
+
+# Request classes named after each request command, so that logs and
+# metrics of the broker show the actual command.
+_raw_request_classes = {}
+
+def raw_request(frame):
+    """
+    Wrap a request frame into a KlfRawRequest instance.
+    """
+    try:
+        klf_command = struct.unpack('>H', frame[2:4])[0]
+    except struct.error:
+        raise KlfBrokerError("Truncated request frame")
+
+    try:
+        return _raw_request_classes[klf_command](frame)
+    except KeyError:
+        pass
+
+    command_name = COMMAND_NAMES.get(klf_command, '')
+    if not command_name.endswith('_REQ'):
+        raise KlfBrokerError("0x{:04x} is not a request".format(klf_command))
+    if klf_command not in BROKER_COMMANDS:
+        raise KlfBrokerError("{} is not allowed through the broker".format(
+            command_name))
+    cfm_command = getattr(messages.commands, command_name[:-4] + '_CFM', None)
+    cfm_type = KlfGwResponseMetaclass._klf_response_class.get(cfm_command)
+    if cfm_type is None:
+        raise KlfBrokerError("No confirmation known for {}".format(command_name))
+
+    name = cfm_type.__name__[:-3] + 'Req'
+    request_class = type(name, (KlfRawRequest,), {
+        '__init__': lambda self, frame: KlfRawRequest.__init__(self, frame, cfm_type),
+    })
+    _raw_request_classes[klf_command] = request_class
+    return request_class(frame)
+
+class KlfBroker:
+    """
+    Multiplex the requests of worker processes on a single KlfClient,
+    and fan out the gateway frames to the workers.
+
+    The broker allocates its own session ids from block 0.
+    handle_worker is meant to be given to asyncio.start_unix_server.
+    """
+    # Notifications are dropped for a worker whose socket buffer exceeds
+    # this size
+    MAX_WORKER_BUFFER = 1024 * 1024
+
+    def __init__(self, klf_client, max_workers=MAX_WORKERS):
+        self.klf_client = klf_client
+        self.max_workers = min(max_workers, MAX_WORKERS)
+        self.workers = {}
+        KlfSessionId.set_session_range(0, SESSION_BLOCK)
+        BROKER_WORKERS.set_function(lambda: len(self.workers))
+        klf_client.add_listener(self.broadcast)
+
+    def broadcast(self, event):
+        session_id = getattr(event, 'session_id', None)
+        if session_id is None:
+            writers = self.workers.values()
+        else:
+            # Only the worker which opened the session waits for it
+            writer = self.workers.get(session_id // SESSION_BLOCK)
+            writers = () if writer is None else (writer,)
+
+        message = pack_message(MSG_NOTIFY, 0, event.raw_frame)
+        for writer in writers:
+            if writer.transport.get_write_buffer_size() > self.MAX_WORKER_BUFFER:
+                DROPPED_NOTIFICATIONS.inc()
+                continue
+            writer.write(message)
+
+    async def handle_worker(self, reader, writer):
+        free = [index for index in range(1, self.max_workers + 1)
+                if index not in self.workers]
+        if not free:
+            logger.warning("Refusing worker: too many workers")
+            writer.close()
+            return
+
+        index = free[0]
+        self.workers[index] = writer
+        writer.write(pack_message(MSG_HELLO, index))
+        logger.info("Worker connected", extra={'worker': index})
+        requests = set()
+        try:
+            while True:
+                message_type, correlation_id, payload = await read_message(reader)
+                if message_type != MSG_REQUEST:
+                    logger.warning("Unexpected message from worker",
+                            extra={'worker': index, 'type': message_type})
+                    continue
+                request = asyncio.ensure_future(
+                        self.forward(writer, correlation_id, payload))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.workers[index]
+            for request in requests:
+                request.cancel()
+            writer.close()
+            logger.info("Worker disconnected", extra={'worker': index})
+
+    async def forward(self, writer, correlation_id, frame):
+        try:
+            confirmation = await self.klf_client.send(raw_request(frame))
+        except KlfBrokerError as e:
+            reply = pack_message(MSG_FAILURE, correlation_id, str(e).encode('utf-8'))
+        except Exception as e:
+            if e.args and isinstance(e.args[0], KlfGwResponse):
+                reply = pack_message(MSG_ERROR, correlation_id, e.args[0].raw_frame)
+            else:
+                reply = pack_message(MSG_FAILURE, correlation_id,
+                        repr(e).encode('utf-8'))
+        else:
+            reply = pack_message(MSG_CONFIRM, correlation_id, confirmation.raw_frame)
+        if not writer.is_closing():
+            writer.write(reply)
+
+class KlfBrokerClient(KlfClient):
+    """
+    KlfClient talking to the gateway through a broker.
+
+    Requests are sent to the broker and matched with their confirmation
+    by correlation id; every frame the broker fans out is dispatched to
+    futures and listeners as if it came from the gateway.
+    """
+    def __init__(self, loop):
+        # The broker keeps the gateway connection alive: connection_made,
+        # which starts the keepalive task, is never called.
+        super().__init__(loop)
+        self.reader = None
+        self.writer = None
+        self.correlation_id = 0
+        self.requests = {}
+        self.reader_task = None
+        self.worker_index = None
+
+    async def connect(self, path):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        message_type, self.worker_index, payload = await read_message(self.reader)
+        if message_type != MSG_HELLO:
+            raise KlfBrokerError("Unexpected message from the broker")
+        KlfSessionId.set_session_range(self.worker_index * SESSION_BLOCK,
+                (self.worker_index + 1) * SESSION_BLOCK)
+        self.reader_task = asyncio.ensure_future(self.read_messages())
+        logger.info("Connected to the broker", extra={'worker': self.worker_index})
+
+    async def read_messages(self):
+        try:
+            while True:
+                message_type, correlation_id, payload = await read_message(self.reader)
+                if message_type == MSG_NOTIFY:
+                    self.frame_ring.record(FRAME_IN, redact_frame(payload))
+                    try:
+                        event = KlfGwResponse(payload)
+                    except (KlfError, struct.error):
+                        continue
+                    self.dispatch(event)
+                    continue
+
+                future = self.requests.pop(correlation_id, None)
+                if future is None or future.done():
+                    continue
+                if message_type == MSG_CONFIRM:
+                    future.set_result(KlfGwResponse(payload))
+                elif message_type == MSG_ERROR:
+                    future.set_exception(Exception(KlfGwResponse(payload)))
+                else:
+                    future.set_exception(KlfBrokerError(payload.decode('utf-8', 'replace')))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.error("Connection to the broker lost")
+        finally:
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(KlfBrokerError("Connection to the broker lost"))
+            self.requests.clear()
+
+    def send(self, message):
+        frame = bytes(message)
+        self.frame_ring.record(FRAME_OUT, redact_frame(frame))
+        self.correlation_id = (self.correlation_id + 1) % 2 ** 32
+        future = self.loop.create_future()
+        if self.reader_task is None or self.reader_task.done():
+            future.set_exception(KlfBrokerError("Not connected to the broker"))
+            return future
+        self.requests[self.correlation_id] = future
+        self.writer.write(pack_message(MSG_REQUEST, self.correlation_id, frame))
+        self.track_request(message, future)
+        return future
+
+def prepare_socket_directory(path):
+    """
+    Create the directory of the socket at path, readable by its owner
+    only, or check that an existing one is. Raise KlfBrokerError when
+    other users could reach the socket.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    directory_stat = os.lstat(directory)
+    if not stat.S_ISDIR(directory_stat.st_mode) or \
+            directory_stat.st_uid != os.getuid() or \
+            directory_stat.st_mode & 0o077:
+        raise KlfBrokerError("{} must be a directory private to its owner".format(
+            directory))
+
+async def start_broker_server(broker, path):
+    """
+    Listen for workers on the Unix domain socket at path, accessible to
+    the current user only. Return the asyncio server.
+    """
+    prepare_socket_directory(path)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(broker.handle_worker, path)
+    os.chmod(path, 0o600)
+    return server
+
+def start_worker(args):
+    """
+    Start a worker process talking to the broker listening on args.socket.
+    """
+    command = [sys.executable, os.path.abspath(__file__), 'worker',
+            '--socket', args.socket, '--port', str(args.port)]
+    if args.config is not None:
+        command += ['--config', args.config]
+    return subprocess.Popen(command)
+
+async def run_broker(args, gateway, keepalive):
+    from main import connect_klf_client
+
+    name, address, password, port = gateway
+    klf_client = await connect_klf_client(address, password, port, **keepalive)
+    broker = KlfBroker(klf_client)
+    server = await start_broker_server(broker, args.socket)
+    logger.info("Broker listening", extra={'socket': args.socket})
+
+    workers = [start_worker(args)
+        for i in range(min(args.workers, MAX_WORKERS))]
+    try:
+        async with server:
+            # Replace the workers which exited, such as those which lost
+            # their connection to the broker
+            while True:
+                await asyncio.sleep(WORKER_CHECK_INTERVAL)
+                for i, worker in enumerate(workers):
+                    if worker.poll() is not None:
+                        logger.warning("Restarting worker", extra={
+                            'pid': worker.pid, 'status': worker.returncode})
+                        workers[i] = start_worker(args)
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+async def run_worker(args, config):
+    """
+    Serve the REST API through the broker. Return when the connection to
+    the broker is lost, so that the worker process exits and gets
+    restarted.
+    """
+    from main import build_rest_server
+
+    klf_client = KlfBrokerClient(asyncio.get_running_loop())
+    await klf_client.connect(args.socket)
+    # Every worker listens on the same port, the kernel spreads the
+    # connections between them.
+    server = await asyncio.start_server(
+            build_rest_server(config, klf_client).handle_client,
+            '', args.port, reuse_port=True)
+    async with server:
+        await klf_client.reader_task
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway broker")
+    parser.add_argument('mode', choices=('broker', 'worker'))
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+            help="Unix domain socket of the broker")
+    parser.add_argument('--port', type=int, default=52280,
+            help="REST server port of the workers")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help="worker processes started by the broker")
+    parser.add_argument('-c', '--config',
+            help="INI configuration file of main.py; the broker connects "
+            "to its first gateway, the workers set up their REST server "
+            "from it")
+    args = parser.parse_args()
+
+    from main import (KlfConfigError, check_rest_config, config_gateways,
+            config_keepalive, load_config)
+    try:
+        config = load_config(args.config)
+        check_rest_config(config)
+        if args.mode == 'broker':
+            gateway = config_gateways(config)[0]
+            keepalive = config_keepalive(config)
+    except KlfConfigError as e:
+        parser.error(str(e))
+
+    setup_logging(config['logging']['level'].upper())
+    if args.mode == 'broker':
+        asyncio.run(run_broker(args, gateway, keepalive))
+    else:
+        asyncio.run(run_worker(args, config))
+        # The broker restarts the workers which exit
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
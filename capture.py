@@ -0,0 +1,225 @@
+#!env python3
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Capture of the frames exchanged with the gateway, and replay of such
+captures.
+
+A capture file starts with a magic string, followed by one record per
+frame: a header made of the timestamp (double), the direction (byte)
+and the frame length (unsigned short), all big-endian, then the raw
+unescaped frame.
+
+    python capture.py dump traffic.klfcap
+    python capture.py replay traffic.klfcap --speed 10 --target client
+"""
+
+import argparse
+import asyncio
+import cProfile
+import datetime
+import pstats
+import struct
+import sys
+import time
+
+from client import KlfClient, KlfConnection
+from framelog import DIRECTION_NAMES, FRAME_IN, command_name, redact_frame
+
+CAPTURE_MAGIC = b'KLFCAP1\n'
+RECORD_HEADER = struct.Struct('>dBH')
+
+class CaptureFormatError(Exception):
+    """
+    Exception raised when reading a file which is not a valid capture.
+    """
+    pass
+
+class CaptureWriter:
+    """
+    Frame recorder writing a capture file. It can be given as the
+    recorder of a KlfClient or of a KlfConnection. Password frames are
+    stored redacted.
+    """
+    def __init__(self, path):
+        self.output = open(path, 'wb')
+        self.output.write(CAPTURE_MAGIC)
+        self.count = 0
+
+    def record(self, direction, frame):
+        frame = redact_frame(frame)
+        self.output.write(RECORD_HEADER.pack(time.time(), direction, len(frame)))
+        self.output.write(frame)
+        self.count += 1
+
+    def flush(self):
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_capture(path):
+    """
+    Iterate over the (timestamp, direction, frame) records of a capture
+    file.
+    """
+    with open(path, 'rb') as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise CaptureFormatError("{} is not a frame capture".format(path))
+        while True:
+            header = capture.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                raise CaptureFormatError("Truncated record header")
+            timestamp, direction, length = RECORD_HEADER.unpack(header)
+            frame = capture.read(length)
+            if len(frame) < length:
+                raise CaptureFormatError("Truncated frame")
+            yield timestamp, direction, frame
+
+class NullTransport(asyncio.Transport):
+    """
+    Transport discarding everything the client writes.
+    """
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+class KlfReplayer:
+    """
+    Feed the inbound frames of a capture to a decoder, either a bare
+    KlfConnection or a whole KlfClient with its listeners.
+
+    speed scales the delays between frames: 1 replays in real time, 10
+    ten times faster, and 0 as fast as possible.
+    """
+    def __init__(self, path, target='client', speed=0):
+        self.path = path
+        self.speed = speed
+        if target == 'client':
+            self.client = KlfClient(asyncio.get_event_loop())
+            self.client.connection_made(NullTransport())
+            self.feed = self.client.data_received
+        elif target == 'connection':
+            self.connection = KlfConnection()
+            def feed(data):
+                self.connection.receive_data(data)
+                for event in self.connection.iter_events():
+                    pass
+            self.feed = feed
+        else:
+            raise ValueError("Unknown replay target {}".format(target))
+        self.frames = 0
+
+    async def run(self):
+        """
+        Replay the capture and return the time spent feeding frames.
+        """
+        inbound = [(timestamp, KlfConnection.slip_pack(frame))
+                for timestamp, direction, frame in read_capture(self.path)
+                if direction == FRAME_IN]
+        if not inbound:
+            return 0
+
+        busy = 0
+        first_timestamp = inbound[0][0]
+        start = time.monotonic()
+        for timestamp, data in inbound:
+            if self.speed:
+                delay = (timestamp - first_timestamp) / self.speed \
+                        - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            fed = time.perf_counter()
+            self.feed(data)
+            busy += time.perf_counter() - fed
+            self.frames += 1
+        return busy
+
+def dump(path):
+    for timestamp, direction, frame in read_capture(path):
+        print('{time} {direction:<3} {command} {frame}'.format(
+            time=datetime.datetime.fromtimestamp(timestamp).isoformat(),
+            direction=DIRECTION_NAMES[direction],
+            command=command_name(frame),
+            frame=frame.hex()))
+
+async def replay(args):
+    replayer = KlfReplayer(args.capture, args.target, args.speed)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    busy = await replayer.run()
+    if profiler is not None:
+        profiler.disable()
+
+    print("Replayed {frames} frames, {busy:.3f}s spent decoding ({rate:.0f} frames/s)".format(
+        frames=replayer.frames, busy=busy,
+        rate=replayer.frames / busy if busy else 0))
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats(args.sort).print_stats(args.profile)
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame capture tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    dump_parser = subparsers.add_parser('dump', help="print a capture as text")
+    dump_parser.add_argument('capture')
+
+    replay_parser = subparsers.add_parser('replay',
+            help="feed a capture to the decoder")
+    replay_parser.add_argument('capture')
+    replay_parser.add_argument('--target', choices=('client', 'connection'),
+            default='client',
+            help="decode with a whole KlfClient, or only a KlfConnection")
+    replay_parser.add_argument('--speed', type=float, default=0,
+            help="replay speed factor, 0 for as fast as possible")
+    replay_parser.add_argument('--profile', type=int, metavar='N', default=0,
+            help="profile the replay and print the N first functions")
+    replay_parser.add_argument('--sort', default='cumulative',
+            help="profile sort key")
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'dump':
+            dump(args.capture)
+        else:
+            asyncio.run(replay(args))
+    except CaptureFormatError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
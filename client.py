@@ -23,11 +23,54 @@ import struct
 import logging
 import messages.auth
 import messages.general
+import messages.info
 import asyncio
+import functools
 import inspect
 import re
+import weakref
 
-from messages.base import KlfGwResponse
+from framelog import FrameRing, FRAME_IN, FRAME_OUT, redact_frame
+from logs import HexDump
+from messages.base import KlfGwResponse, KlfError
+from messages.command_handler import KlfSessionId
+from metrics import REGISTRY
+from nodes import KlfNodeTable, MAX_NODES
+
+logger = logging.getLogger('klf.client')
+frames_logger = logging.getLogger('klf.frames')
+slip_logger = logging.getLogger('klf.slip')
+
+FRAMES = REGISTRY.counter('klf_frames_total',
+        'Frames exchanged with the gateway', ('direction',))
+BYTES = REGISTRY.counter('klf_bytes_total',
+        'Bytes exchanged with the gateway, SLIP encoding included',
+        ('direction',))
+DECODE_ERRORS = REGISTRY.counter('klf_decode_errors_total',
+        'Frames received from the gateway which could not be decoded',
+        ('error',))
+REQUEST_LATENCY = REGISTRY.histogram('klf_request_latency_seconds',
+        'Delay between a request and its confirmation', ('command',))
+REQUESTS_INFLIGHT = REGISTRY.gauge('klf_requests_inflight',
+        'Requests sent to the gateway and waiting for their confirmation')
+RESPONSES_QUEUED = REGISTRY.gauge('klf_responses_queued',
+        'Futures waiting for a frame from the gateway')
+LIVE_SESSIONS = REGISTRY.gauge('klf_live_sessions',
+        'Command sessions not finished yet')
+LIVE_SESSIONS.set_function(lambda: len(KlfSessionId._running_sessions))
+
+# Live clients, summed by the gauges above
+CLIENTS = weakref.WeakSet()
+REQUESTS_INFLIGHT.set_function(lambda: sum(client.inflight for client in CLIENTS))
+RESPONSES_QUEUED.set_function(lambda: sum(len(futures)
+    for client in CLIENTS for futures in client.futures.values()))
+
+class KlfConnectionLost(ConnectionError):
+    """
+    Exception given to requests which cannot get an answer because the
+    gateway connection is down.
+    """
+    pass
 
 def toHex(s):
     return ":".join("{:02x}".format(c) for c in s)
@@ -47,43 +90,53 @@ class KlfConnection:
     SLIP_ESC_END = b'\xDC'
     SLIP_ESC_ESC = b'\xDD'
 
-    def __init__(self):
+    def __init__(self, frame_ring=None, recorder=None, instrumented=True):
         self.frames = []
         self.input_buffer = b''
         self.input_state = self.INPUT_STATE_INIT
+        # Without instrumentation, frames are neither counted in the
+        # metrics, nor recorded, nor logged: the gateway simulator uses
+        # it, so that only the client side of its traffic is accounted.
+        self.instrumented = instrumented
+        self.frame_ring = None
+        if instrumented:
+            self.frame_ring = frame_ring if frame_ring is not None else FrameRing()
+        # Optional object with a record(direction, frame) method, such as
+        # a capture.CaptureWriter, given every frame after the ring
+        self.recorder = recorder
 
     def receive_data(self, data):
         """
         Read and decode frames received from the gateway.
         """
-        # Detect when the socket has been closed on the remote side
-        if data == '':
-            logging.debug("Socket has been closed by the gateway")
-            #TODO
-
-        logging.debug("Parsing received data: {data}".format(
-            data=toHex(data)))
+        if self.instrumented:
+            BYTES.inc(len(data), direction='in')
+            # Frames are only logged once decoded and redacted
+            frames_logger.debug("Parsing %d bytes of received data", len(data))
+        # Checked once per chunk: the byte-level trace is far too costly
+        # to be even considered in the loop below.
+        trace = slip_logger.isEnabledFor(logging.DEBUG)
         for c in data:
-            logging.debug("Frame parser: handling byte {byte} in state {state}".format(
-                byte=c, state=self.input_state))
+            if trace:
+                slip_logger.debug("Frame parser: handling byte %s in state %s",
+                        c, self.input_state)
             if self.input_state == self.INPUT_STATE_INIT:
                 if c == self.SLIP_END[0]:
-                    logging.debug("Frame parser: new frame start")
+                    if trace:
+                        slip_logger.debug("Frame parser: new frame start")
                     self.input_state = self.INPUT_STATE_FRAME
 
             elif self.input_state == self.INPUT_STATE_FRAME:
                 if c == self.SLIP_END[0]:
-                    logging.debug("Frame parser: frame end")
-                    logging.debug("Frame parser: frame content: {}".format(
-                        toHex(self.input_buffer)))
                     self.input_state = self.INPUT_STATE_INIT
-                    self.frames.append(KlfGwResponse(self.input_buffer))
+                    if self.input_buffer:
+                        self.decode_frame(self.input_buffer)
                     self.input_buffer = b''
                 elif c == self.SLIP_ESC[0]:
-                    logging.debug("Frame parser: escape sequence")
+                    if trace:
+                        slip_logger.debug("Frame parser: escape sequence")
                     self.input_state = self.INPUT_STATE_ESC
                 else:
-                    logging.debug("Frame parser: regular byte")
                     self.input_buffer += bytes([c])
 
             elif self.input_state == self.INPUT_STATE_ESC:
@@ -93,6 +146,32 @@ class KlfConnection:
                 elif c == self.SLIP_ESC_ESC[0]:
                     self.input_buffer += self.SLIP_ESC
 
+    def decode_frame(self, frame):
+        """
+        Decode a frame and queue the resulting message. Invalid frames
+        are dropped.
+        """
+        if not self.instrumented:
+            try:
+                self.frames.append(KlfGwResponse(frame))
+            except (KlfError, struct.error):
+                pass
+            return
+
+        redacted = redact_frame(frame)
+        frames_logger.debug("Received frame: %s", HexDump(redacted))
+        self.frame_ring.record(FRAME_IN, redacted)
+        if self.recorder is not None:
+            self.recorder.record(FRAME_IN, redacted)
+        try:
+            self.frames.append(KlfGwResponse(frame))
+        except (KlfError, struct.error) as e:
+            DECODE_ERRORS.inc(error=type(e).__name__)
+            frames_logger.warning("Dropping invalid frame: %s", HexDump(redacted),
+                    extra={'error': type(e).__name__})
+        else:
+            FRAMES.inc(direction='in')
+
     def next_event(self):
         try:
             return self.frames.pop(0)
@@ -122,43 +201,165 @@ class KlfConnection:
         """
         Format a message so that it can be sent to the gateway.
         """
-        logging.debug("Sent frame: {frame}".format(
-            frame=toHex(bytes(message))))
-        return self.slip_pack(bytes(message))
+        frame = bytes(message)
+        if not self.instrumented:
+            return self.slip_pack(frame)
+
+        redacted = redact_frame(frame)
+        self.frame_ring.record(FRAME_OUT, redacted)
+        if self.recorder is not None:
+            self.recorder.record(FRAME_OUT, redacted)
+        frames_logger.debug("Sent frame: %s", HexDump(redacted),
+                extra={'command': type(message).__name__})
+        packed = self.slip_pack(frame)
+        FRAMES.inc(direction='out')
+        BYTES.inc(len(packed), direction='out')
+        return packed
 
 class KlfClient(asyncio.Protocol):
-    def __init__(self, loop):
+    # Policy for requests sent while the connection is down or not
+    # ready: 'fail' them at once, or 'hold' them until release_held is
+    # called, for at most hold_timeout seconds.
+    POLICY_FAIL = 'fail'
+    POLICY_HOLD = 'hold'
+
+    def __init__(self, loop, policy=POLICY_FAIL, hold_timeout=30, max_held=64,
+            heartbeat_interval=10 * 60, heartbeat_timeout=30):
         super().__init__()
         self.loop = loop
-        self.heartbeat_handler = loop.call_later(10 * 60, self.ping)
+        # A heartbeat is sent after heartbeat_interval seconds without
+        # any frame in either direction; the connection is considered
+        # dead when it is not answered within heartbeat_timeout seconds.
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.heartbeat_task = None
+        self.last_activity = loop.time()
+        self.transport = None
+        self.policy = policy
+        self.hold_timeout = hold_timeout
+        self.max_held = max_held
+        self.holding = False
+        self.held_requests = []
+        # Called with the exception, if any, when the connection is lost
+        self.connection_lost_handler = None
         self.pending_request = None
+        self.listeners = []
+        self.frame_ring = FrameRing()
+        self.recorder = None
+        self.nodes = KlfNodeTable()
+        self.add_listener(self.nodes)
+        self.futures = {}
+        self.inflight = 0
+        CLIENTS.add(self)
+
+    async def keepalive(self):
+        """
+        Send a heartbeat whenever the connection has been idle for
+        heartbeat_interval seconds, and abort the connection when the
+        gateway does not answer it.
+
+        Frames only record their time: the deadline is checked when the
+        task wakes up, instead of being rescheduled on every frame.
+        """
+        while True:
+            idle = self.loop.time() - self.last_activity
+            if idle < self.heartbeat_interval:
+                await asyncio.sleep(self.heartbeat_interval - idle)
+                continue
 
-    def reschedule_heartbeat(self):
-        self.heartbeat_handler.cancel()
-        self.heartbeat_handler = self.loop.call_later(10 * 60, self.ping)
+            try:
+                await asyncio.wait_for(self.send_now(messages.general.GetStateReq()),
+                        self.heartbeat_timeout)
+            except asyncio.TimeoutError:
+                logger.error("Gateway did not answer the heartbeat, closing the connection",
+                        extra={'timeout': self.heartbeat_timeout})
+                self.transport.abort()
+                return
+            except Exception:
+                # Any answer, even an error, shows that the link is up
+                pass
 
     def connection_made(self, transport):
         self.transport = transport
-        self.klf_connection = KlfConnection()
-        self.futures = {}
+        self.klf_connection = KlfConnection(self.frame_ring, self.recorder)
+        # Futures registered while disconnected, such as the responses
+        # awaited by held requests, stay: only connection_lost fails them.
+        self.last_activity = self.loop.time()
+        self.heartbeat_task = asyncio.ensure_future(self.keepalive())
+
+    def connection_lost(self, exc):
+        """
+        Fail everything waiting for a frame: the gateway forgets about
+        requests of a closed connection. Later requests are held or
+        failed according to the policy.
+        """
+        logger.warning("Connection to the gateway lost", extra={'error': exc})
+        self.transport = None
+        self.holding = True
+        self.pending_request = None
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        futures, self.futures = self.futures, {}
+        for future in (future for waiting in futures.values() for future in waiting):
+            if not future.done():
+                future.set_exception(KlfConnectionLost("Connection to the gateway lost"))
+        if self.connection_lost_handler is not None:
+            self.connection_lost_handler(exc)
 
     def data_received(self, data):
+        self.last_activity = self.loop.time()
         self.klf_connection.receive_data(data)
         for event in self.klf_connection.iter_events():
-            if isinstance(event, messages.general.ErrorNtf) and \
-                self.pending_request is not None:
-                self.pending_request.set_exception(Exception(event))
-
-            elif isinstance(event, KlfGwResponse):
-                def iter_and_remove(list):
-                    while True:
-                        try:
-                            yield list.pop(0)
-                        except IndexError:
-                            break
-                for future in iter_and_remove(self.futures.get(type(event), [])):
+            self.dispatch(event)
+
+    def dispatch(self, event):
+        """
+        Resolve the futures waiting for an event, then hand it to the
+        listeners.
+        """
+        if isinstance(event, messages.general.ErrorNtf) and \
+            self.pending_request is not None and \
+            not self.pending_request.done():
+            self.pending_request.set_exception(Exception(event))
+
+        elif isinstance(event, KlfGwResponse):
+            def iter_and_remove(list):
+                while True:
+                    try:
+                        yield list.pop(0)
+                    except IndexError:
+                        break
+            for future in iter_and_remove(self.futures.get(type(event), [])):
+                if not future.cancelled():
                     future.set_result(event)
 
+        for listener in tuple(self.listeners):
+            listener(event)
+
+    def add_listener(self, listener):
+        """
+        Register a callable which will be given every event received
+        from the gateway, after pending futures have been resolved.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def route(self, node_ids):
+        """
+        Return the client handling the given nodes, along with their
+        identifiers on its gateway: a single client handles them all.
+        """
+        return self, tuple(node_ids)
+
+    def is_node_id(self, node_id):
+        """
+        Tell whether node_id may address a node of the gateway.
+        """
+        return 0 <= node_id < MAX_NODES
+
     def get_response(self, response_type):
         future = self.loop.create_future()
         self.futures.setdefault(response_type, []).append(future)
@@ -166,15 +367,94 @@ class KlfClient(asyncio.Protocol):
 
     @staticmethod
     def get_cfm_type(request):
+        # Requests without a class of their own name their confirmation
+        cfm_type = getattr(request, 'cfm_type', None)
+        if cfm_type is not None:
+            return cfm_type
         kls = type(request)
         return getattr(inspect.getmodule(kls), re.sub(r'Req$', 'Cfm', kls.__name__))
 
     def send(self, message):
+        """
+        Send a request and return the future of its confirmation. While
+        the client is not ready, the request is held or failed.
+        """
+        if self.holding or self.transport is None:
+            return self.hold(message)
+        return self.send_now(message)
+
+    def hold(self, message):
+        future = self.loop.create_future()
+        if self.policy != self.POLICY_HOLD or len(self.held_requests) >= self.max_held:
+            future.set_exception(KlfConnectionLost("Gateway not connected"))
+            return future
+
+        def expire():
+            if not future.done():
+                future.set_exception(KlfConnectionLost(
+                    "Gateway not connected after {}s".format(self.hold_timeout)))
+        self.held_requests.append((message, future,
+            self.loop.call_later(self.hold_timeout, expire)))
+        return future
+
+    def release_held(self):
+        """
+        Mark the client as ready, and send the held requests.
+        """
+        self.holding = False
+        held, self.held_requests = self.held_requests, []
+        for message, future, expiry in held:
+            expiry.cancel()
+            if not future.done():
+                self.send(message).add_done_callback(
+                        functools.partial(self.copy_outcome, future))
+
+    @staticmethod
+    def copy_outcome(target, source):
+        if target.done():
+            return
+        if source.cancelled():
+            target.cancel()
+        elif source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    def send_now(self, message):
+        """
+        Send a request, even though the client is not ready.
+        """
         self.pending_request = self.get_response(KlfClient.get_cfm_type(message))
         self.transport.write(self.klf_connection.send(message))
-        self.reschedule_heartbeat()
+        self.last_activity = self.loop.time()
+        self.track_request(message, self.pending_request)
         return self.pending_request
 
+    def track_request(self, message, future):
+        """
+        Account for a request until its confirmation future is done.
+        """
+        command = type(message).__name__
+        nodes = getattr(message, 'nodes', None)
+        start = self.loop.time()
+        self.inflight += 1
+
+        def request_done(future):
+            self.inflight -= 1
+            if not future.cancelled() and future.exception() is None:
+                latency = self.loop.time() - start
+                REQUEST_LATENCY.observe(latency, command=command)
+                if logger.isEnabledFor(logging.DEBUG):
+                    extra = {
+                        'command': command,
+                        'session_id': getattr(future.result(), 'session_id', None),
+                        'latency': round(latency, 6),
+                    }
+                    if nodes:
+                        extra['node'] = ','.join(str(node_id) for node_id in nodes)
+                    logger.debug("Request confirmed", extra=extra)
+        future.add_done_callback(request_done)
+
     def authenticate(self, password):
         """
         Send password to the gateway and return authentication status
@@ -186,3 +466,30 @@ class KlfClient(asyncio.Protocol):
         Send a heartbeat frame to the gateway
         """
         return self.send(messages.general.GetStateReq())
+
+    async def get_all_nodes_information(self):
+        """
+        Ask information about all nodes to the gateway and return the
+        list of received GetAllNodesInformationNtf frames.
+        """
+        logger.info("Asking all nodes information to the KLF gateway")
+        # Several notifications may arrive in a single read, so collect
+        # them from a listener rather than from one-shot futures.
+        nodes_info = []
+        def collect(event):
+            if isinstance(event, messages.info.GetAllNodesInformationNtf):
+                logger.debug("Got one frame in response to all nodes information")
+                nodes_info.append(event)
+
+        finished_ntf = self.get_response(messages.info.GetAllNodesInformationFinishedNtf)
+        self.add_listener(collect)
+        try:
+            await self.send(messages.info.GetAllNodesInformationReq())
+            logger.info("Waiting for all nodes information")
+            await finished_ntf
+            logger.info("Got final frame in response to all nodes information")
+        finally:
+            self.remove_listener(collect)
+            finished_ntf.cancel()
+
+        return nodes_info
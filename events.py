@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Conversion of gateway notifications into events pushed to REST clients
+"""
+
+import asyncio
+import logging
+
+import messages.command_handler
+import messages.info
+from nodes import position_to_percent
+
+def node_position_event(event):
+    return 'node_position', {
+        'node': event.node_id,
+        'state': event.state,
+        'position': position_to_percent(event.current_position),
+        'target': position_to_percent(event.target_position),
+        'remaining_time': event.remaining_time,
+    }
+
+def run_status_event(event):
+    return 'run_status', {
+        'session_id': event.session_id,
+        'node': event.index,
+        'parameter': event.node_parameter,
+        'value': event.parameter_value,
+        'run_status': event.run_status,
+        'status_reply': event.status_reply,
+        'information_code': event.information_code,
+    }
+
+def session_finished_event(event):
+    return 'session_finished', {
+        'session_id': event.session_id,
+    }
+
+EVENT_SERIALIZERS = {
+    messages.info.GetAllNodesInformationNtf: node_position_event,
+    messages.info.NodeStatePositionChangedNtf: node_position_event,
+    messages.command_handler.CommandRunStatusNtf: run_status_event,
+    messages.command_handler.SessionFinishedNtf: session_finished_event,
+}
+
+def serialize_event(event):
+    """
+    Return an (event name, JSON-serializable data) pair for a gateway
+    notification, or None when the notification is not published.
+    """
+    serializer = EVENT_SERIALIZERS.get(type(event))
+    if serializer is None:
+        return None
+    return serializer(event)
+
+class KlfEventSubscription:
+    """
+    Bounded queue of serialized events for a single REST client.
+
+    The subscription is a KlfClient listener and must never block the
+    gateway reader: when the client does not keep up, the oldest events
+    are dropped.
+    """
+    def __init__(self, klf_client, maxsize=256):
+        self.klf_client = klf_client
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def __call__(self, event):
+        serialized = serialize_event(event)
+        if serialized is None:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(serialized)
+
+    def __enter__(self):
+        self.klf_client.add_listener(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.klf_client.remove_listener(self)
+        if self.dropped:
+            logging.warning("Event subscriber dropped {dropped} events".format(
+                dropped=self.dropped))
+
+    async def get(self):
+        return await self.queue.get()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Ring buffer of the last frames exchanged with the gateway
+"""
+
+import datetime
+import logging
+import os
+import signal
+import struct
+import tempfile
+import time
+from functools import reduce
+from operator import xor
+
+import messages.commands
+
+FRAME_IN = 0
+FRAME_OUT = 1
+
+DIRECTION_NAMES = ('in', 'out')
+
+# Command names, indexed by command number
+COMMAND_NAMES = {value: name for name, value in vars(messages.commands).items()
+        if name.startswith('GW_')}
+
+# Commands whose arguments hold the gateway password
+SECRET_COMMANDS = frozenset(struct.pack('>H', klf_command) for klf_command in (
+    messages.commands.GW_PASSWORD_ENTER_REQ,
+    messages.commands.GW_PASSWORD_CHANGE_REQ,
+    messages.commands.GW_PASSWORD_CHANGE_NTF,
+))
+
+def redact_frame(frame):
+    """
+    Return a raw frame fit for buffers, logs and captures: the arguments
+    of frames holding a password are zeroed, and the checksum fixed.
+    """
+    if frame[2:4] not in SECRET_COMMANDS or len(frame) < 5:
+        return frame
+    redacted = frame[:4] + bytes(len(frame) - 5)
+    return redacted + bytes((reduce(xor, redacted),))
+
+def command_name(frame):
+    """
+    Return the name of the command carried by a raw (unescaped) frame.
+    """
+    try:
+        klf_command = struct.unpack('>H', frame[2:4])[0]
+    except struct.error:
+        return None
+    return COMMAND_NAMES.get(klf_command, '0x{:04x}'.format(klf_command))
+
+class FrameRing:
+    """
+    Fixed-size ring buffer of raw frames, in both directions.
+
+    Slots are allocated once; recording a frame only stores references,
+    and decoding is left to whoever reads the buffer, so that the ring
+    can stay enabled permanently. Frames must go through redact_frame
+    before being recorded.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.timestamps = [0.0] * size
+        self.directions = bytearray(size)
+        self.frames = [b''] * size
+        self.index = 0
+        self.count = 0
+
+    def record(self, direction, frame):
+        index = self.index
+        self.timestamps[index] = time.time()
+        self.directions[index] = direction
+        self.frames[index] = frame
+        self.index = (index + 1) % self.size
+        self.count += 1
+
+    def __iter__(self):
+        """
+        Iterate over (timestamp, direction, frame), oldest first.
+        """
+        recorded = min(self.count, self.size)
+        start = (self.index - recorded) % self.size
+        for offset in range(recorded):
+            index = (start + offset) % self.size
+            yield self.timestamps[index], self.directions[index], self.frames[index]
+
+    def to_json(self):
+        return [{
+                'time': timestamp,
+                'direction': DIRECTION_NAMES[direction],
+                'command': command_name(frame),
+                'frame': frame.hex(),
+            } for timestamp, direction, frame in self]
+
+    def dump(self, path):
+        """
+        Write the buffer content to a text file, one frame per line,
+        readable by the owner only.
+
+        The file is created under a random name then renamed, so that
+        a file or link planted at path in a shared directory is never
+        written through.
+        """
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with open(fd, 'w') as output:
+                for timestamp, direction, frame in self:
+                    output.write('{time} {direction:<3} {command} {frame}\n'.format(
+                        time=datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                        direction=DIRECTION_NAMES[direction],
+                        command=command_name(frame),
+                        frame=frame.hex()))
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+def install_dump_signal(loop, ring, path, signum=signal.SIGUSR1):
+    """
+    Dump the frame ring to path whenever the process receives signum.
+    """
+    def dump():
+        try:
+            ring.dump(path)
+        except OSError as e:
+            logging.error("Cannot dump frames to {path}: {error}".format(
+                path=path, error=e))
+        else:
+            logging.info("Dumped frames to {path}".format(path=path))
+    loop.add_signal_handler(signum, dump)
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Durable journal of the commands sent to the gateway.
+
+The journal is an append-only file of JSON lines. A "submit" record is
+written, and synced to disk, before its command is sent to the gateway;
+a "done" record is written once the outcome of the command is known.
+Commands without outcome, because the connection dropped or the process
+died, are sent again until they get one: delivery is at least once.
+
+Records are written by a single task, one batch at a time: records
+added while a batch is being synced go to the next batch, so that
+concurrent commands share their fsync calls.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+
+import messages.command_handler
+from client import KlfConnectionLost
+from metrics import REGISTRY
+
+logger = logging.getLogger('klf.journal')
+
+JOURNAL_COMMITS = REGISTRY.counter('klf_journal_commits_total',
+        'Batches of records synced to the command journal')
+JOURNAL_RECORDS = REGISTRY.counter('klf_journal_records_total',
+        'Records written to the command journal')
+JOURNAL_PENDING = REGISTRY.gauge('klf_journal_pending_commands',
+        'Journaled commands without outcome')
+
+# Main parameter values moving nodes relatively to their current
+# position: sending them twice moves nodes twice.
+RELATIVE_VALUES = range(0xC900, 0xD0D0 + 1)
+
+class KlfJournalError(Exception):
+    """
+    Exception raised when a command cannot be journaled.
+    """
+    pass
+
+class KlfDuplicateCommand(KlfJournalError):
+    """
+    Exception raised when the key of a command is already pending.
+    """
+    pass
+
+class KlfJournalEntry:
+    """
+    Command sent to the gateway, waiting for its outcome.
+    """
+    def __init__(self, key, nodes, main_parameter, originator, priority,
+            created):
+        self.key = key
+        self.nodes = list(nodes)
+        self.main_parameter = main_parameter
+        self.originator = originator
+        self.priority = priority
+        self.created = created
+
+    @classmethod
+    def from_request(cls, key, request):
+        return cls(key, request.nodes, bytes(request.main_parameter),
+                request.command_originator, request.priority_level,
+                time.time())
+
+    @classmethod
+    def from_json(cls, record):
+        return cls(record['key'], record['nodes'],
+                bytes.fromhex(record['main_parameter']),
+                record['originator'], record['priority'], record['created'])
+
+    def to_json(self):
+        return {
+            'op': 'submit',
+            'key': self.key,
+            'nodes': self.nodes,
+            'main_parameter': self.main_parameter.hex(),
+            'originator': self.originator,
+            'priority': self.priority,
+            'created': self.created,
+        }
+
+    @property
+    def raw_value(self):
+        return struct.unpack('>H', self.main_parameter)[0]
+
+    @property
+    def idempotent(self):
+        return self.raw_value not in RELATIVE_VALUES
+
+    def request(self, nodes=None):
+        """
+        Build a new CommandSendReq for this command, with a new session.
+        """
+        return messages.command_handler.CommandSendReq(
+                main_parameter=self.main_parameter,
+                command_originator=self.originator,
+                priority_level=self.priority,
+                nodes=tuple(self.nodes if nodes is None else nodes))
+
+class KlfCommandJournal:
+    """
+    Journal of the CommandSendReq frames sent through it.
+
+    open must be called before anything else. Commands found without
+    outcome in the file are only sent again by replay.
+    """
+    # Delays between delivery attempts of a command whose connection
+    # dropped, in seconds
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 60
+
+    # The file is truncated when no command is pending and it grew
+    # beyond this size
+    COMPACT_SIZE = 1024 * 1024
+
+    def __init__(self, path, max_age=3600):
+        self.path = path
+        # Commands older than max_age seconds are given up
+        self.max_age = max_age
+        self.entries = {}
+        self.fd = None
+        self.batch = []
+        self.waiters = []
+        self.writer_task = None
+        # Keys of the entries being delivered by this process
+        self.delivering = set()
+        self.tasks = set()
+        JOURNAL_PENDING.set_function(lambda: len(self.entries))
+
+    def open(self):
+        """
+        Load the pending commands of the journal file, and rewrite the
+        file with only them.
+        """
+        try:
+            with open(self.path, 'rb') as journal_file:
+                for line_number, line in enumerate(journal_file, 1):
+                    try:
+                        record = json.loads(line)
+                        if record['op'] == 'submit':
+                            self.entries[record['key']] = KlfJournalEntry.from_json(record)
+                        else:
+                            self.entries.pop(record['key'], None)
+                    except (ValueError, KeyError, TypeError):
+                        # The last record may have been torn by a crash
+                        logger.warning("Ignoring invalid journal record",
+                                extra={'path': self.path, 'line': line_number})
+        except FileNotFoundError:
+            pass
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as journal_file:
+            for entry in self.entries.values():
+                journal_file.write(self.encode(entry.to_json()))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_path, self.path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        logger.info("Command journal opened", extra={
+            'path': self.path, 'pending': len(self.entries)})
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def encode(record):
+        return json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+
+    def write(self, record, durable=False):
+        """
+        Queue a record for the next batch. When durable is true, return
+        a future resolved once the record is synced to disk.
+        """
+        self.batch.append(self.encode(record))
+        future = None
+        if durable:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append(future)
+        if self.writer_task is None:
+            self.writer_task = asyncio.ensure_future(self.write_batches())
+        return future
+
+    async def write_batches(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.batch:
+                batch, self.batch = self.batch, []
+                waiters, self.waiters = self.waiters, []
+                # Without pending commands, nothing in the file matters
+                compact = not self.entries
+                try:
+                    await loop.run_in_executor(None, self.write_sync,
+                            b''.join(batch), compact)
+                except OSError as e:
+                    logger.error("Cannot write the command journal",
+                            extra={'path': self.path, 'error': e})
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(KlfJournalError(str(e)))
+                    continue
+
+                JOURNAL_COMMITS.inc()
+                JOURNAL_RECORDS.inc(len(batch))
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        finally:
+            self.writer_task = None
+
+    def write_sync(self, data, compact):
+        """
+        Append data to the file and sync it. With compact set, the file
+        holds nothing pending and is emptied first when too large.
+        """
+        if compact and os.fstat(self.fd).st_size > self.COMPACT_SIZE:
+            os.ftruncate(self.fd, 0)
+        # The batch is written even then: its writers are told that
+        # their records are on disk.
+        os.write(self.fd, data)
+        os.fsync(self.fd)
+
+    def finish(self, entry, status):
+        self.entries.pop(entry.key, None)
+        self.write({'op': 'done', 'key': entry.key, 'status': status})
+
+    async def send(self, klf_client, request, key=None):
+        """
+        Journal a CommandSendReq then send it to the gateway, and return
+        its confirmation.
+
+        When the connection drops before the confirmation, the command
+        is delivered again in the background and None is returned.
+        """
+        if key is None:
+            key = uuid.uuid4().hex
+        if key in self.entries:
+            request.free_session(request.session_id)
+            raise KlfDuplicateCommand("Command {} is already pending".format(key))
+
+        entry = KlfJournalEntry.from_request(key, request)
+        self.entries[key] = entry
+        try:
+            await self.write(entry.to_json(), durable=True)
+        except BaseException:
+            self.entries.pop(key, None)
+            request.free_session(request.session_id)
+            raise
+
+        self.delivering.add(key)
+        try:
+            confirmation = await self.attempt(klf_client, entry, request)
+        except BaseException:
+            self.delivering.discard(key)
+            raise
+        if confirmation is None:
+            self.redeliver(klf_client, entry, self.RETRY_DELAY)
+        else:
+            self.delivering.discard(key)
+        return confirmation
+
+    async def attempt(self, klf_client, entry, request):
+        """
+        Send a request for entry. Return its confirmation, or None when
+        the connection dropped first.
+        """
+        try:
+            confirmation = await klf_client.send(request)
+        except KlfConnectionLost:
+            # The gateway forgets the sessions of a closed connection
+            request.free_session(request.session_id)
+            return None
+        except Exception:
+            self.finish(entry, 'error')
+            raise
+        self.finish(entry, 'accepted' if confirmation.is_success else 'rejected')
+        return confirmation
+
+    def redeliver(self, klf_client, entry, delay):
+        self.delivering.add(entry.key)
+        task = asyncio.ensure_future(self.deliver(klf_client, entry, delay))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, klf_client, entry, delay):
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(max(delay, self.RETRY_DELAY) * 2, self.MAX_RETRY_DELAY)
+
+                if time.time() - entry.created > self.max_age:
+                    logger.warning("Giving up a journaled command", extra={
+                        'key': entry.key, 'nodes': entry.nodes})
+                    self.finish(entry, 'expired')
+                    return
+                if not entry.idempotent:
+                    # The gateway may have run it already
+                    logger.warning("Not sending a relative move again", extra={
+                        'key': entry.key, 'nodes': entry.nodes})
+                    self.finish(entry, 'abandoned')
+                    return
+
+                # Skip nodes which already reached the target, when
+                # their position is known from the gateway
+                node_table = klf_client.nodes
+                trusted = node_table.populated and not node_table.stale
+                nodes = [node_id for node_id in entry.nodes
+                        if not trusted or
+                        getattr(node_table.get(node_id),
+                            'expected_position', None) != entry.raw_value]
+                if not nodes:
+                    self.finish(entry, 'skipped')
+                    return
+
+                try:
+                    confirmation = await self.attempt(klf_client, entry,
+                            entry.request(nodes))
+                except Exception as e:
+                    logger.warning("Journaled command failed", extra={
+                        'key': entry.key, 'error': e})
+                    return
+                if confirmation is not None:
+                    logger.info("Journaled command delivered", extra={
+                        'key': entry.key, 'accepted': confirmation.is_success})
+                    return
+        finally:
+            self.delivering.discard(entry.key)
+
+    def replay(self, klf_client):
+        """
+        Deliver again the commands without outcome which this process
+        is not already delivering. Nodes already at their target are
+        skipped when the node table is up to date.
+        """
+        for entry in list(self.entries.values()):
+            if entry.key not in self.delivering:
+                self.redeliver(klf_client, entry, 0)
@@ -0,0 +1,296 @@
+#!env python3
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Open-loop load generator for the REST server.
+
+Requests are started at Poisson arrival times, whatever the response
+times, and their latency is measured from their scheduled start, so that
+a saturated server shows up in the percentiles instead of slowing the
+load down.
+
+    python loadgen.py --rate 200 --duration 30 --mix list=6,send=2,wink=1,version=1
+    python loadgen.py --local --rate 500
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+
+import h11
+
+# Request kinds: name -> (method, path template, body)
+REQUEST_KINDS = {
+    'list': ('GET', '/actuator/', None),
+    'send': ('POST', '/actuator/{node}/send/', {'value': '50%'}),
+    'wink': ('POST', '/actuator/{node}/wink/', {}),
+    'version': ('GET', '/version/', None),
+}
+
+def parse_mix(mix):
+    """
+    Parse a request mix such as "list=6,send=2" into a dictionary of
+    weights.
+    """
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in REQUEST_KINDS:
+            raise ValueError("Unknown request kind {}".format(kind))
+        weights[kind] = float(weight or 1)
+    return weights
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+class HttpConnection:
+    """
+    Keep-alive HTTP/1.1 client connection.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.connection = h11.Connection(our_role=h11.CLIENT)
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, method, target, body=None):
+        """
+        Send a request and return its status code. The connection can
+        be reused afterwards only if next_cycle returns true.
+        """
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        headers = [('Host', 'localhost'), ('Content-Length', str(len(data)))]
+        if body is not None:
+            headers.append(('Content-Type', 'application/json'))
+
+        self.writer.write(self.connection.send(h11.Request(method=method,
+            target=target, headers=headers)))
+        if data:
+            self.writer.write(self.connection.send(h11.Data(data=data)))
+        self.writer.write(self.connection.send(h11.EndOfMessage()))
+
+        status_code = None
+        while True:
+            event = self.connection.next_event()
+            if event is h11.NEED_DATA:
+                received = await self.reader.read(65536)
+                self.connection.receive_data(received)
+                if not received and self.connection.their_state is not h11.MUST_CLOSE:
+                    raise ConnectionError("Connection closed by the server")
+            elif isinstance(event, h11.Response):
+                status_code = event.status_code
+            elif isinstance(event, (h11.EndOfMessage, h11.ConnectionClosed)):
+                break
+        return status_code
+
+    def next_cycle(self):
+        """
+        Prepare the connection for another request. Return whether it can
+        be reused, that is, whether both sides completed the last one.
+        """
+        if self.connection.our_state is h11.DONE and \
+                self.connection.their_state is h11.DONE:
+            self.connection.start_next_cycle()
+            return True
+        return False
+
+    def close(self):
+        self.writer.close()
+
+class LoadGenerator:
+    """
+    Fire requests at a Poisson rate and record their outcome.
+    """
+    def __init__(self, host, port, rate, duration, weights, nodes,
+            max_connections=256):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.duration = duration
+        self.kinds = list(weights)
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.nodes = nodes
+        self.connection_slots = asyncio.Semaphore(max_connections)
+        self.idle_connections = []
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.random = random.Random()
+
+    async def get_connection(self):
+        await self.connection_slots.acquire()
+        if self.idle_connections:
+            return self.idle_connections.pop()
+        try:
+            return await HttpConnection.open(self.host, self.port)
+        except Exception:
+            self.connection_slots.release()
+            raise
+
+    def put_connection(self, connection):
+        if connection.next_cycle():
+            self.idle_connections.append(connection)
+        else:
+            connection.close()
+        self.connection_slots.release()
+
+    async def fire(self, kind, scheduled):
+        method, template, body = REQUEST_KINDS[kind]
+        target = template.format(node=self.random.choice(self.nodes))
+        connection = None
+        try:
+            connection = await self.get_connection()
+            status_code = await connection.request(method, target, body)
+        except Exception as e:
+            if connection is not None:
+                connection.close()
+                self.connection_slots.release()
+            self.errors[(kind, type(e).__name__)] += 1
+            return
+        self.put_connection(connection)
+
+        self.latencies[kind].append(time.monotonic() - scheduled)
+        if status_code >= 400:
+            self.errors[(kind, status_code)] += 1
+
+    async def run(self):
+        """
+        Generate load for the configured duration, then wait for the
+        outstanding requests. Return the elapsed time.
+        """
+        tasks = set()
+        start = time.monotonic()
+        scheduled = start
+        end = start + self.duration
+        while True:
+            scheduled += self.random.expovariate(self.rate)
+            if scheduled >= end:
+                break
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            task = asyncio.ensure_future(self.fire(kind, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        elapsed = time.monotonic() - start
+        for connection in self.idle_connections:
+            connection.close()
+        return elapsed
+
+    def report(self, elapsed):
+        lines = ['{kind:<10} {count:>8} {p50:>10} {p99:>10} {p999:>10} {max:>10}'.format(
+            kind='request', count='count', p50='p50 ms', p99='p99 ms',
+            p999='p999 ms', max='max ms')]
+        all_latencies = []
+        for kind in self.kinds + ['all']:
+            if kind == 'all':
+                latencies = sorted(all_latencies)
+            else:
+                latencies = sorted(self.latencies[kind])
+                all_latencies.extend(latencies)
+            lines.append('{kind:<10} {count:>8} {p50:>10.2f} {p99:>10.2f} {p999:>10.2f} {max:>10.2f}'.format(
+                kind=kind, count=len(latencies),
+                p50=percentile(latencies, .5) * 1000,
+                p99=percentile(latencies, .99) * 1000,
+                p999=percentile(latencies, .999) * 1000,
+                max=(latencies[-1] if latencies else float('nan')) * 1000))
+
+        lines.append("Throughput: {rate:.1f} responses/s over {elapsed:.1f}s (offered {offered:.1f}/s)".format(
+            rate=len(all_latencies) / elapsed, elapsed=elapsed, offered=self.rate))
+        error_count = sum(self.errors.values())
+        lines.append("Errors: {}".format(error_count))
+        for (kind, error), count in sorted(self.errors.items(), key=str):
+            lines.append("    {kind} {error}: {count}".format(
+                kind=kind, error=error, count=count))
+        return '\n'.join(lines)
+
+async def start_local_stack(nodes):
+    """
+    Start a simulated gateway, a client and a REST server in this
+    process, and return the REST server port.
+
+    All the load comes from a single address, so the per-client and
+    connection limits of the server are lifted; its queue depth limit
+    still applies.
+    """
+    from admission import AdmissionLimits
+    from main import connect_klf_client
+    from rest_server import RestServer
+    from simulator import SimulatorOptions, start_simulator
+
+    gateway, simulator = await start_simulator('127.0.0.1', 0,
+            SimulatorOptions(nodes=nodes))
+    gateway_port = gateway.sockets[0].getsockname()[1]
+    klf_client = await connect_klf_client('127.0.0.1',
+            simulator.options.password, gateway_port)
+    limits = AdmissionLimits(max_connections=None,
+            max_inflight_per_client=None, client_rate=None)
+    rest_server = await asyncio.start_server(
+            RestServer(klf_client, limits=limits).handle_client, '127.0.0.1', 0)
+    return rest_server.sockets[0].getsockname()[1]
+
+async def main():
+    parser = argparse.ArgumentParser(description="REST server load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=52280)
+    parser.add_argument('--rate', type=float, default=50,
+            help="mean request arrival rate, per second")
+    parser.add_argument('--duration', type=float, default=10,
+            help="load duration, in seconds")
+    parser.add_argument('--mix', default='list=6,send=2,wink=1,version=1',
+            help="weights of the request kinds: " + ', '.join(REQUEST_KINDS))
+    parser.add_argument('--nodes', type=int, default=10,
+            help="commanded node ids range from 0 to this value, excluded")
+    parser.add_argument('--max-connections', type=int, default=256)
+    parser.add_argument('--local', action='store_true',
+            help="run against a simulated gateway and a REST server started "
+            "in this process; they share its CPU with the load generator")
+    args = parser.parse_args()
+
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    port = args.port
+    if args.local:
+        port = await start_local_stack(args.nodes)
+
+    generator = LoadGenerator(args.host, port, args.rate, args.duration,
+            weights, list(range(args.nodes)), args.max_connections)
+    elapsed = await generator.run()
+    print(generator.report(elapsed))
+    return 1 if generator.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
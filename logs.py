@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Logging configuration: structured key/value records, written by a
+background thread so that the event loop never waits for log output.
+
+Subsystems log through their own loggers, whose levels can be set
+independently:
+
+    klf.client  requests and confirmations exchanged with the gateway
+    klf.frames  raw frames, as hexadecimal dumps
+    klf.slip    byte-level trace of the SLIP decoder
+    klf.rest    REST server
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+# Attributes of a LogRecord which are not extra structured fields
+STANDARD_ATTRIBUTES = frozenset(logging.LogRecord(
+    '', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+class HexDump:
+    """
+    Lazy hexadecimal representation of bytes, only computed when a log
+    record is actually emitted.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return ":".join("{:02x}".format(c) for c in self.data)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving the whole formatting of records to the listener
+    thread: the message is not merged with its arguments beforehand, so
+    that HexDump and the like are only rendered off the event loop.
+
+    Arguments must not be changed once logged, which holds for the
+    immutable values and HexDump of bytes logged here.
+    """
+    def prepare(self, record):
+        return record
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Format records as a line of key=value pairs, including the fields
+    given through the extra argument of logging calls.
+    """
+    def format_value(self, value):
+        value = str(value)
+        if not value or any(c in value for c in ' "='):
+            value = '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+        return value
+
+    def format(self, record):
+        fields = [
+            ('time', self.formatTime(record)),
+            ('level', record.levelname),
+            ('logger', record.name),
+            ('msg', record.getMessage()),
+        ]
+        fields.extend((key, value) for key, value in record.__dict__.items()
+                if key not in STANDARD_ATTRIBUTES)
+        line = ' '.join('{key}={value}'.format(key=key,
+            value=self.format_value(value)) for key, value in fields)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def setup_logging(level=logging.INFO, levels=None, structured=True,
+        background=True, handler=None):
+    """
+    Configure the root logger.
+
+    levels maps logger names to their own levels. With background set,
+    records are handed to a QueueHandler and written by a
+    QueueListener thread. Return the listener, or None.
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+    if structured:
+        handler.setFormatter(KeyValueFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+
+    root = logging.getLogger()
+    for existing_handler in list(root.handlers):
+        root.removeHandler(existing_handler)
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    if not background:
+        root.addHandler(handler)
+        return None
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler,
+            respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
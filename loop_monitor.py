@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Event loop lag and slow callback monitoring
+"""
+
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from metrics import REGISTRY
+
+LOOP_LAG = REGISTRY.histogram('event_loop_lag_seconds',
+        'Delay between the scheduled and actual wake up of a timer',
+        buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+SLOW_CALLBACKS = REGISTRY.counter('event_loop_slow_callbacks_total',
+        'Callbacks which blocked the event loop longer than the threshold')
+
+class SlowCallback:
+    """
+    Record of a callback which blocked the event loop.
+    """
+    def __init__(self, timestamp, stack):
+        self.timestamp = timestamp
+        self.duration = None
+        self.stack = stack
+
+    def to_json(self):
+        return {
+            'timestamp': self.timestamp,
+            'duration': self.duration,
+            'stack': self.stack,
+        }
+
+class LoopMonitor:
+    """
+    Watchdog for the asyncio event loop.
+
+    A task on the loop measures how late its timers fire. A separate
+    thread regularly schedules a callback on the loop: when the loop
+    does not run it within slow_threshold seconds, the thread captures
+    the stack of the loop thread, which points at the blocking code.
+    A loop still blocked after stall_limit seconds is reported at once,
+    with no duration until it runs again.
+
+    The monitor costs a thread and a timer; it only runs once started.
+    """
+    def __init__(self, loop, interval=0.5, slow_threshold=0.1, history=32,
+            stall_limit=30):
+        self.loop = loop
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.stall_limit = stall_limit
+        self.slow_callbacks = collections.deque(maxlen=history)
+        # Guards slow_callbacks, shared by the loop and watchdog threads
+        self.slow_callbacks_lock = threading.Lock()
+        self.last_lag = 0
+        self.max_lag = 0
+        self.task = None
+        self.thread = None
+        self.running = False
+        self.loop_thread_id = None
+
+    def start(self):
+        self.running = True
+        self.loop_thread_id = threading.get_ident()
+        self.task = self.loop.create_task(self.measure_lag())
+        self.thread = threading.Thread(target=self.watch,
+                name='loop-monitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def measure_lag(self):
+        while True:
+            expected = self.loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0, self.loop.time() - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            LOOP_LAG.observe(self.last_lag)
+
+    def capture_stack(self):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return []
+        return traceback.format_stack(frame)
+
+    def watch(self):
+        """
+        Body of the watchdog thread.
+        """
+        while self.running:
+            ran = threading.Event()
+            scheduled = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(ran.set)
+            except RuntimeError:
+                # The loop is closed
+                return
+
+            if not ran.wait(self.slow_threshold):
+                slow = SlowCallback(time.time(), self.capture_stack())
+                if not ran.wait(max(0, self.stall_limit - self.slow_threshold)):
+                    with self.slow_callbacks_lock:
+                        self.slow_callbacks.append(slow)
+                    logging.error("Event loop stalled for more than {limit}s in:\n{stack}".format(
+                        limit=self.stall_limit, stack=''.join(slow.stack[-5:])))
+                    # Keep waiting, but let stop() end the thread
+                    while not ran.wait(self.interval):
+                        if not self.running:
+                            return
+                    slow.duration = time.monotonic() - scheduled
+                else:
+                    slow.duration = time.monotonic() - scheduled
+                    with self.slow_callbacks_lock:
+                        self.slow_callbacks.append(slow)
+                try:
+                    self.loop.call_soon_threadsafe(self.report, slow)
+                except RuntimeError:
+                    return
+
+            time.sleep(self.interval)
+
+    def report(self, slow):
+        SLOW_CALLBACKS.inc()
+        logging.warning("Event loop blocked for {duration:.3f}s in:\n{stack}".format(
+            duration=slow.duration, stack=''.join(slow.stack[-5:])))
+
+    def to_json(self):
+        with self.slow_callbacks_lock:
+            slow_callbacks = list(self.slow_callbacks)
+        return {
+            'interval': self.interval,
+            'slow_threshold': self.slow_threshold,
+            'stall_limit': self.stall_limit,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'slow_callbacks': [slow.to_json() for slow in slow_callbacks],
+        }
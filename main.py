@@ -17,50 +17,377 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from client import KlfClient
-from rest_server import RestClientConnection
+"""
+REST server in front of one or several KLF200 gateways.
+
+    python main.py --config klf200.ini
+    KLF200_PASSWORD=velux123 python main.py --gateway 192.168.1.10
+
+The configuration file holds one section per gateway, taken in file
+order; node identifiers of the n-th gateway are offset by
+n * manager.NODE_ID_STRIDE in the REST API:
+
+    [gateway:main]
+    address = 192.168.1.10
+    password = velux123
+    port = 51200
+
+    [rest]
+    host =
+    port = 52280
+    # Expose /debug/frames/ and watch the event loop for /debug/loop/
+    debug_frames = no
+    loop_monitor = no
+
+    [journal]
+    path = /var/lib/klf200/journal
+
+    [snapshot]
+    path = /var/lib/klf200/nodes.snapshot
+
+    [keepalive]
+    interval = 600
+    timeout = 30
+
+    # Limits of the REST server; an empty value is not enforced
+    [admission]
+    max_connections = 64
+    max_inflight_per_client = 4
+    max_queue_depth = 32
+    client_rate = 20
+    client_burst = 40
+
+    [logging]
+    level = INFO
+
+Command line options override the configuration file. The REST server
+listens while the gateways are being connected, answering 503 until
+they are.
+"""
+
+import argparse
+import asyncio
+import configparser
+import functools
 import logging
+import os
 import sys
-import asyncio
-import ssl
+import tempfile
+import time
+
+from logs import setup_logging
+
+# Heavy modules (TLS client, HTTP stack) are imported where they are
+# needed, so that importing connect_klf_client stays cheap.
+
+DEFAULT_CONFIG = {
+    'rest': {
+        'host': '',
+        'port': '52280',
+        'debug_frames': 'no',
+        'loop_monitor': 'no',
+    },
+    'journal': {
+        'path': '',
+    },
+    'snapshot': {
+        'path': '',
+    },
+    'keepalive': {
+        'interval': '600',
+        'timeout': '30',
+    },
+    'admission': {
+        'max_connections': '64',
+        'max_inflight_per_client': '4',
+        'max_queue_depth': '32',
+        'client_rate': '20',
+        'client_burst': '40',
+    },
+    'logging': {
+        'level': 'INFO',
+    },
+}
+
+GATEWAY_SECTION_PREFIX = 'gateway:'
+
+class KlfConfigError(Exception):
+    """
+    Exception raised for an invalid or incomplete configuration.
+    """
+    pass
+
+def load_config(path=None):
+    """
+    Return the configuration read from the INI file at path, on top of
+    the defaults.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_dict(DEFAULT_CONFIG)
+    if path is not None:
+        try:
+            with open(path) as config_file:
+                config.read_file(config_file)
+        except (OSError, configparser.Error) as e:
+            raise KlfConfigError("Cannot read {}: {}".format(path, e))
+    return config
+
+def config_gateways(config):
+    """
+    Return the configured gateways, as (name, address, password, port)
+    tuples.
+    """
+    gateways = []
+    for section in config.sections():
+        if not section.startswith(GATEWAY_SECTION_PREFIX):
+            continue
+        options = config[section]
+        try:
+            gateways.append((section[len(GATEWAY_SECTION_PREFIX):],
+                options['address'], options['password'].encode('utf-8'),
+                options.getint('port', 51200)))
+        except KeyError as e:
+            raise KlfConfigError("Missing {} in [{}]".format(e, section))
+        except ValueError:
+            raise KlfConfigError("Invalid port in [{}]".format(section))
+    if not gateways:
+        raise KlfConfigError("No gateway configured")
+    return gateways
+
+def check_config(config):
+    """
+    Raise KlfConfigError unless the configuration is usable.
+    """
+    config_gateways(config)
+    check_rest_config(config)
+    config_keepalive(config)
+
+def check_rest_config(config):
+    """
+    Raise KlfConfigError unless the REST server and logging settings are
+    usable.
+    """
+    try:
+        config['rest'].getint('port')
+    except ValueError:
+        raise KlfConfigError("Invalid REST server port")
+    for option in ('debug_frames', 'loop_monitor'):
+        try:
+            config['rest'].getboolean(option)
+        except ValueError:
+            raise KlfConfigError("Invalid {} value".format(option))
+    if not isinstance(logging.getLevelName(config['logging']['level'].upper()), int):
+        raise KlfConfigError("Invalid logging level")
+    config_admission(config)
+
+def config_keepalive(config):
+    """
+    Return the heartbeat settings of the gateway connections, as
+    keyword arguments of connect_klf_client.
+    """
+    try:
+        keepalive = {
+            'heartbeat_interval': config['keepalive'].getfloat('interval'),
+            'heartbeat_timeout': config['keepalive'].getfloat('timeout'),
+        }
+    except ValueError:
+        raise KlfConfigError("Invalid keepalive setting")
+    if not all(value > 0 for value in keepalive.values()):
+        raise KlfConfigError("Keepalive settings must be positive")
+    return keepalive
+
+def config_admission(config):
+    """
+    Return the AdmissionLimits of the REST server.
+    """
+    from admission import AdmissionLimits
+
+    limits = {}
+    for option, convert in (('max_connections', int),
+            ('max_inflight_per_client', int), ('max_queue_depth', int),
+            ('client_rate', float), ('client_burst', int)):
+        value = config['admission'][option].strip()
+        try:
+            limits[option] = convert(value) if value else None
+        except ValueError:
+            raise KlfConfigError("Invalid {} value".format(option))
+    if (limits['client_rate'] is None) != (limits['client_burst'] is None):
+        raise KlfConfigError("client_rate and client_burst go together")
+    return AdmissionLimits(**limits)
+
+def apply_arguments(config, args):
+    """
+    Override the configuration with the command line options.
+    """
+    if args.gateway is not None:
+        password = os.environ.get('KLF200_PASSWORD')
+        if password is None:
+            raise KlfConfigError("--gateway needs the KLF200_PASSWORD environment variable")
+        for section in config.sections():
+            if section.startswith(GATEWAY_SECTION_PREFIX):
+                config.remove_section(section)
+        address, _, port = args.gateway.partition(':')
+        config[GATEWAY_SECTION_PREFIX + 'main'] = {
+            'address': address,
+            'password': password,
+            'port': port or '51200',
+        }
+    for section, option, value in (
+            ('rest', 'host', args.host),
+            ('rest', 'port', args.port),
+            ('rest', 'debug_frames', args.debug_frames),
+            ('rest', 'loop_monitor', args.loop_monitor),
+            ('journal', 'path', args.journal),
+            ('snapshot', 'path', args.snapshot),
+            ('logging', 'level', args.log_level)):
+        if value is not None:
+            config[section][option] = str(value)
+
+async def connect_klf_client(address, password, port=51200,
+        heartbeat_interval=10 * 60, heartbeat_timeout=30):
+    from supervisor import KlfAuthenticationError, KlfSupervisor
 
-async def connect_klf_client(address, password):
     loop = asyncio.get_running_loop()
-    
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-    ssl_context.check_hostname = False
-    # The gateway certificate is self-signed.
-    ssl_context.verify_mode = ssl.CERT_NONE
-
-    (klf_transport, klf_client) = await loop.create_connection(
-            lambda: KlfClient(loop),
-            host=address, port=51200, ssl=ssl_context)
-    if await klf_client.authenticate(password):
-        logging.info("Successfully authenticated on the gateway")
-    else:
+
+    # The supervisor reconnects whenever the connection drops
+    supervisor = KlfSupervisor(loop, address, password, port,
+            heartbeat_interval=heartbeat_interval,
+            heartbeat_timeout=heartbeat_timeout)
+    try:
+        klf_client = await supervisor.start()
+    except KlfAuthenticationError:
         logging.critical("Cannot authenticate on the gateway: invalid credentials")
         sys.exit(1)
+    logging.info("Successfully authenticated on the gateway")
 
     return klf_client
 
-async def connect_rest_server(klf_client):
+async def connect_rest_server(rest_server, host='', port=52280):
     logging.info("Starting REST server")
-    rest_server = await asyncio.start_server(lambda reader, writer:
-            RestClientConnection(reader, writer, klf_client).run(),
-            '', 52280)
+    server = await asyncio.start_server(rest_server.handle_client, host, port)
     logging.info("REST server waiting for incoming connections")
-    return rest_server
+    return server
+
+def build_rest_server(config, klf_client, journal=None):
+    """
+    Return the RestServer of klf_client, set up as configured.
+    """
+    from rest_server import RestServer
+
+    loop_monitor = None
+    if config['rest'].getboolean('loop_monitor'):
+        from loop_monitor import LoopMonitor
+        loop_monitor = LoopMonitor(asyncio.get_running_loop())
+        loop_monitor.start()
+
+    return RestServer(klf_client, limits=config_admission(config),
+            loop_monitor=loop_monitor, journal=journal,
+            debug_frames=config['rest'].getboolean('debug_frames'))
+
+async def resync_nodes(klf_client):
+    try:
+        await klf_client.get_all_nodes_information()
+    except Exception as e:
+        logging.error("Cannot resynchronize the node table: %s", e)
+    else:
+        logging.info("Node table resynchronized")
+
+def restore_snapshot(klf_client, path):
+    """
+    Fill the node table of klf_client from the snapshot at path. Return
+    whether it was restored.
+    """
+    from snapshot import SnapshotFormatError, load_snapshot
+
+    try:
+        saved = load_snapshot(path, klf_client.nodes)
+    except FileNotFoundError:
+        return False
+    except (OSError, SnapshotFormatError) as e:
+        logging.warning("Ignoring the node table snapshot: %s", e)
+        return False
+    logging.info("Node table restored from a snapshot saved %.0fs ago",
+            time.time() - saved)
+    return True
+
+async def run(config):
+    from framelog import install_dump_signal
+    from manager import KlfGatewayManager
+
+    loop = asyncio.get_running_loop()
+    gateways = config_gateways(config)
+
+    journal = None
+    if config['journal']['path']:
+        from journal import KlfCommandJournal
+        journal = KlfCommandJournal(config['journal']['path'])
+        journal.open()
+
+    gateway_manager = KlfGatewayManager()
+    snapshot_path = config['snapshot']['path']
+    restored = snapshot_path and restore_snapshot(gateway_manager, snapshot_path)
+
+    # Listen first: clients get 503 instead of connection errors while
+    # the gateways are being connected.
+    rest_server = build_rest_server(config, gateway_manager, journal)
+    rest_server.ready = False
+    server = await connect_rest_server(rest_server, config['rest']['host'],
+            config['rest'].getint('port'))
+
+    await gateway_manager.connect_gateways(gateways, functools.partial(
+        connect_klf_client, **config_keepalive(config)))
+    rest_server.ready = True
+    install_dump_signal(loop, gateway_manager.frame_ring,
+            os.path.join(tempfile.gettempdir(),
+                'klf200-frames-{}.txt'.format(os.getpid())))
+
+    if snapshot_path:
+        from snapshot import KlfSnapshotWriter
+        if restored:
+            # Replace the stale table in the background
+            asyncio.ensure_future(resync_nodes(gateway_manager))
+        KlfSnapshotWriter(snapshot_path, gateway_manager.nodes).start()
+    if journal is not None:
+        journal.replay(gateway_manager)
+
+    async with server:
+        await server.serve_forever()
 
-async def main():
-    logging.basicConfig(format='%(asctime)s %(message)s',
-            level=logging.DEBUG)
-    logging.debug("Here we go!")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="KLF200 REST server")
+    parser.add_argument('-c', '--config',
+            help="INI configuration file")
+    parser.add_argument('--gateway', metavar='ADDRESS[:PORT]',
+            help="single gateway to connect to, instead of the configured "
+            "ones; its password is read from KLF200_PASSWORD")
+    parser.add_argument('--host', help="REST server listening address")
+    parser.add_argument('--port', type=int, help="REST server port")
+    parser.add_argument('--debug-frames', action='store_true', default=None,
+            help="expose the last frames exchanged with the gateways "
+            "on /debug/frames/")
+    parser.add_argument('--loop-monitor', action='store_true', default=None,
+            help="watch the event loop for blocking code, reported on "
+            "/debug/loop/")
+    parser.add_argument('--journal', metavar='PATH',
+            help="command journal file, delivering commands again after "
+            "a crash or a disconnection")
+    parser.add_argument('--snapshot', metavar='PATH',
+            help="node table snapshot file, answered from after a restart "
+            "until the node table is resynchronized")
+    parser.add_argument('--log-level',
+            choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'))
+    args = parser.parse_args(argv)
 
-    klf_client = await connect_klf_client('klf_ip', b'klf_password')
-    rest_server = await connect_rest_server(klf_client)
+    try:
+        config = load_config(args.config)
+        apply_arguments(config, args)
+        check_config(config)
+    except KlfConfigError as e:
+        parser.error(str(e))
 
-    async with rest_server:
-        await rest_server.serve_forever()
+    setup_logging(level=config['logging']['level'].upper(),
+            levels={'klf.slip': logging.INFO})
+    asyncio.run(run(config))
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Several gateways behind a single node namespace
+"""
+
+import asyncio
+import copy
+
+import messages.command_handler
+import messages.info
+from nodes import KlfNodeTable, MAX_NODES
+
+# Global node identifiers are gateway_index * NODE_ID_STRIDE + local_id,
+# so that the nodes of the first gateway keep their own identifiers.
+NODE_ID_STRIDE = 1000
+
+# Attribute holding the node identifier, for notifications about a node
+NODE_ATTRIBUTES = {
+    messages.info.GetAllNodesInformationNtf: 'node_id',
+    messages.info.NodeStatePositionChangedNtf: 'node_id',
+    messages.command_handler.CommandRunStatusNtf: 'index',
+}
+
+class KlfRoutingError(ValueError):
+    """
+    Exception raised when node identifiers do not match a single known
+    gateway.
+    """
+    pass
+
+class KlfGateway:
+    """
+    One gateway handled by the manager.
+    """
+    def __init__(self, index, name, client):
+        self.index = index
+        self.name = name
+        self.client = client
+
+    def global_id(self, local_id):
+        return self.index * NODE_ID_STRIDE + local_id
+
+class KlfGatewayManager:
+    """
+    Set of gateway connections, presented with the KlfClient interface
+    used by the REST server.
+
+    Node identifiers given to the manager and found in the events it
+    forwards are global: requests addressing nodes are routed to their
+    gateway with local identifiers, and notifications about nodes are
+    copied with global identifiers before reaching listeners. Requests
+    which do not address nodes go to the first gateway.
+    """
+    def __init__(self):
+        # Set once connect_gateways returns
+        self.ready = False
+        self.gateways = []
+        # Listener -> list of (client, wrapper) registrations
+        self.listeners = {}
+        self.nodes = KlfNodeTable()
+        self.add_listener(self.nodes)
+
+    @classmethod
+    async def connect(cls, gateways, connect_client):
+        """
+        Return a manager connected to every gateway, see
+        connect_gateways.
+        """
+        manager = cls()
+        await manager.connect_gateways(gateways, connect_client)
+        return manager
+
+    async def connect_gateways(self, gateways, connect_client):
+        """
+        Connect to every gateway in parallel. gateways is a list of
+        (name, address, password, port) tuples, and connect_client a
+        coroutine function taking an address, a password and a port, and
+        returning an authenticated KlfClient.
+        """
+        clients = await asyncio.gather(*(connect_client(address, password, port)
+            for name, address, password, port in gateways))
+        for (name, address, password, port), client in zip(gateways, clients):
+            self.add_gateway(name, client)
+        self.ready = True
+
+    def add_gateway(self, name, client):
+        gateway = KlfGateway(len(self.gateways), name, client)
+        self.gateways.append(gateway)
+        for listener, registrations in self.listeners.items():
+            registrations.append(self.register(gateway, listener))
+        return gateway
+
+    @property
+    def primary(self):
+        return self.gateways[0].client
+
+    @property
+    def frame_ring(self):
+        return self.primary.frame_ring
+
+    def locate(self, global_id):
+        """
+        Return the gateway and the local identifier of a node.
+        """
+        index, local_id = divmod(global_id, NODE_ID_STRIDE)
+        if not 0 <= index < len(self.gateways) or local_id >= MAX_NODES:
+            raise KlfRoutingError("No gateway handles node {}".format(global_id))
+        return self.gateways[index], local_id
+
+    def is_node_id(self, global_id):
+        """
+        Tell whether global_id may address a node, whether its gateway
+        is connected yet or not.
+        """
+        return global_id >= 0 and global_id % NODE_ID_STRIDE < MAX_NODES
+
+    def route(self, node_ids):
+        """
+        Return the client handling the given nodes, along with their
+        local identifiers.
+        """
+        located = [self.locate(node_id) for node_id in node_ids]
+        gateways = set(gateway for gateway, local_id in located)
+        if len(gateways) > 1:
+            raise KlfRoutingError("Nodes {} belong to several gateways".format(
+                list(node_ids)))
+        if not gateways:
+            return self.primary, ()
+        return gateways.pop().client, tuple(local_id for gateway, local_id in located)
+
+    def globalize(self, gateway, event):
+        """
+        Return event with global node identifiers, or None when it must
+        not be forwarded.
+        """
+        if isinstance(event, messages.info.GetAllNodesInformationFinishedNtf):
+            # Only announce a full node table once every gateway sent its
+            # own; the gateway tables are listeners registered earlier.
+            if all(other.client.nodes.populated for other in self.gateways):
+                return event
+            return None
+
+        attribute = NODE_ATTRIBUTES.get(type(event))
+        if attribute is None or gateway.index == 0:
+            return event
+        # Other listeners of the gateway still see the original event.
+        # Responses cannot go through copy.copy, their constructor
+        # needing the frame.
+        routed = object.__new__(type(event))
+        routed.__dict__.update(vars(event))
+        setattr(routed, attribute, gateway.global_id(getattr(event, attribute)))
+        return routed
+
+    def register(self, gateway, listener):
+        def wrapper(event):
+            event = self.globalize(gateway, event)
+            if event is not None:
+                listener(event)
+        gateway.client.add_listener(wrapper)
+        return gateway.client, wrapper
+
+    def add_listener(self, listener):
+        self.listeners[listener] = [self.register(gateway, listener)
+                for gateway in self.gateways]
+
+    def remove_listener(self, listener):
+        for client, wrapper in self.listeners.pop(listener):
+            client.remove_listener(wrapper)
+
+    def send(self, message):
+        """
+        Send a message to the gateway of the nodes it addresses, and
+        return the future of its confirmation. The message keeps its
+        global node identifiers: the gateway gets a copy, with the same
+        session id, addressing its local ones.
+        """
+        nodes = getattr(message, 'nodes', None)
+        if nodes is None:
+            return self.primary.send(message)
+        try:
+            client, local_nodes = self.route(nodes)
+        except KlfRoutingError:
+            # The gateway will never finish the session
+            if isinstance(message, messages.command_handler.KlfSessionId):
+                message.free_session(message.session_id)
+            raise
+        local_message = copy.copy(message)
+        local_message.nodes = local_nodes
+        return client.send(local_message)
+
+    def get_response(self, response_type):
+        return self.primary.get_response(response_type)
+
+    async def get_all_nodes_information(self):
+        """
+        Sweep the nodes of every gateway in parallel, and return their
+        GetAllNodesInformationNtf frames with global identifiers.
+        """
+        results = await asyncio.gather(*(gateway.client.get_all_nodes_information()
+            for gateway in self.gateways))
+        return [self.globalize(gateway, information)
+                for gateway, gateway_information in zip(self.gateways, results)
+                for information in gateway_information]
+
@@ -42,20 +42,32 @@ class KlfSessionId:
     SessionFinishedNtf response from the gateway.
     """
     _running_sessions = set()
+    _session_range = (0, 2 ** 16)
+
+    @classmethod
+    def set_session_range(cls, first, last):
+        """
+        Only allocate session identifiers from first (included) to last
+        (excluded), so that processes sharing a gateway do not collide.
+        """
+        KlfSessionId._session_range = (first, last)
 
     @classmethod
     def _allocate_session(cls):
+        first, last = cls._session_range
         try:
-            session_id = 1 + max(cls._running_sessions)
+            session_id = 1 + max(session_id for session_id in cls._running_sessions
+                    if first <= session_id < last)
         except ValueError:
-            session_id = 0
+            session_id = first
 
-        if session_id >= 2 ** 16:
-            for i in range(2 ** 16):
+        if session_id >= last:
+            for i in range(first, last):
                 if i not in cls._running_sessions:
                     session_id = i
                     break
-            raise NoSessionIDAvailable
+            else:
+                raise NoSessionIDAvailable
         cls._running_sessions.add(session_id)
         return session_id
 
@@ -70,7 +82,7 @@ class KlfSessionId:
         After this call, the session identifier may be allocated again
         for a new session.
         """
-        cls._running_sessions.remove(session_id)
+        cls._running_sessions.discard(session_id)
 
 class CommandSendReq(KlfSessionId, KlfGwRequest):
     klf_command = commands.GW_COMMAND_SEND_REQ
@@ -165,15 +177,15 @@ class CommandSendCfm(KlfSuccessOneMixin, KlfGwResponse):
     arguments_format = 'HB'
     status_position = 1
 
-    def fill_parameters(self):
-        super().fill_parameters(self)
+    def fill_arguments(self):
+        super().fill_arguments()
         self.session_id = self.raw_arguments[0]
 
 class CommandRunStatusNtf(KlfGwResponse):
     klf_command = commands.GW_COMMAND_RUN_STATUS_NTF
     arguments_format = 'HBBBHBBL'
 
-    def fill_parameters(self):
+    def fill_arguments(self):
         self.session_id = self.raw_arguments[0]
         self.status_id = self.raw_arguments[1]
         self.index = self.raw_arguments[2]
@@ -187,7 +199,7 @@ class SessionFinishedNtf(KlfGwResponse):
     klf_command = commands.GW_SESSION_FINISHED_NTF
     arguments_format = 'H'
 
-    def fill_parameters(self):
+    def fill_arguments(self):
         self.session_id = self.raw_arguments[0]
         KlfSessionId.free_session(self.session_id)
 
@@ -198,7 +210,8 @@ class WinkSendReq(KlfSessionId, KlfGwRequest):
     WINK_ENABLE = 1
 
     def __init__(self, wink_state, wink_time, nodes,
-            originator=..., priority_level=...):
+            originator=CommandSendReq.ORIGINATOR_USER,
+            priority_level=CommandSendReq.PRIORITY_USER_LEVEL2):
         super().__init__()
         self.originator = originator
         self.priority_level = priority_level
@@ -211,7 +224,7 @@ class WinkSendReq(KlfSessionId, KlfGwRequest):
 
         return (
                 ('H', self.session_id),
-                ('B', self.command_originator),
+                ('B', self.originator),
                 ('B', self.priority_level),
                 ('B', self.wink_state),
                 ('B', self.wink_time),
@@ -221,3 +234,55 @@ class WinkSendReq(KlfSessionId, KlfGwRequest):
 
 class WinkSendCfm(KlfSuccessOneMixin, KlfGwResponse):
     klf_command = commands.GW_WINK_SEND_CFM
+    arguments_format = 'HB'
+    status_position = 1
+
+    def fill_arguments(self):
+        super().fill_arguments()
+        self.session_id = self.raw_arguments[0]
+
+class StatusRequestReq(KlfSessionId, KlfGwRequest):
+    klf_command = commands.GW_STATUS_REQUEST_REQ
+
+    STATUS_TARGET_POSITION = 0
+    STATUS_CURRENT_POSITION = 1
+    STATUS_REMAINING_TIME = 2
+    STATUS_MAIN_INFO = 3
+
+    def __init__(self, nodes, status_type=STATUS_CURRENT_POSITION,
+            functional_parameters=()):
+        super().__init__()
+        self.nodes = nodes
+        self.status_type = status_type
+        self.functional_parameters = functional_parameters
+
+    def get_arguments(self):
+        nodes = list(self.nodes) + [0 for i in range(20 - len(self.nodes))]
+
+        fpi1 = 0
+        fpi2 = 0
+        for fp_index in self.functional_parameters:
+            if fp_index < 8:
+                fpi1 |= 1 << fp_index
+            else:
+                fpi2 |= 1 << (fp_index - 8)
+
+        return (
+                ('H', self.session_id),
+                ('B', len(self.nodes)),
+            ) + \
+            tuple(('B', nodes[i]) for i in range(20)) + \
+            (
+                ('B', self.status_type),
+                ('B', fpi1),
+                ('B', fpi2),
+            )
+
+class StatusRequestCfm(KlfSuccessOneMixin, KlfGwResponse):
+    klf_command = commands.GW_STATUS_REQUEST_CFM
+    arguments_format = 'HB'
+    status_position = 1
+
+    def fill_arguments(self):
+        super().fill_arguments()
+        self.session_id = self.raw_arguments[0]
@@ -269,6 +269,9 @@ GW_COMMAND_REMAINING_TIME_NTF = 0x0303
 # Command send, Status request, Wink, Mode or Stop session is finished.
 GW_SESSION_FINISHED_NTF = 0x0304
 
+# Get status request from one or more io-homecontrol nodes.
+GW_STATUS_REQUEST_REQ = 0x0305
+
 # Acknowledge to GW_STATUS_REQUEST_REQ.
 GW_STATUS_REQUEST_CFM = 0x0306
 
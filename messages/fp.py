@@ -20,6 +20,7 @@
 Functional parameters
 """
 
+import re
 import struct
 
 class FPValueMetaclass(type):
@@ -63,3 +64,31 @@ class Default(FPValue):
 class Ignore(FPValue):
     def __bytes__(self):
         return struct.pack('>H', 0xD400)
+
+def parse_value(value):
+    """
+    Parse a functional parameter value given as a string, such as
+    "50%", "+10%" or "current".
+    """
+    if value == 'current':
+        return Current()
+    elif value == 'target':
+        return Target()
+    elif value == 'default':
+        return Default()
+    elif value == 'ignore':
+        return Ignore()
+    else:
+        value_match = re.fullmatch(r'(?P<sign>[+-])?(?P<percent>\d{,3})%',
+                value)
+        if value_match is None:
+            raise ValueError(value)
+
+        sign = value_match.group('sign')
+        percent = min(100, int(value_match.group('percent'))) / 100
+        if sign is None:
+            return Relative(percent)
+        elif sign == '+':
+            return Percent(percent)
+        else: # sign == '-'
+            return Percent(-percent)
@@ -41,15 +41,21 @@ class GetAllNodesInformationNtf(KlfGwResponse):
         self.node_id = self.raw_arguments[0]
         self.order = self.raw_arguments[1]
         self.placement = self.raw_arguments[2]
-        self.name = self.raw_arguments[3].decode('utf-8')
+        self.name = self.raw_arguments[3].split(b'\0', 1)[0].decode('utf-8', 'replace')
         self.velocity = self.raw_arguments[4]
         self.node_subtype = self.raw_arguments[5]
-        self.product_type = self.raw_arguments[6]
-        self.node_variation = self.raw_arguments[7]
-        self.power_mode = self.raw_arguments[8]
-        self.serial_number = self.raw_arguments[9]
-        self.state = self.raw_arguments[10]
-        self.current_position = self.raw_arguments[11]
+        self.product_group = self.raw_arguments[6]
+        self.product_type = self.raw_arguments[7]
+        self.node_variation = self.raw_arguments[8]
+        self.power_mode = self.raw_arguments[9]
+        self.build_number = self.raw_arguments[10]
+        self.serial_number = self.raw_arguments[11]
+        self.state = self.raw_arguments[12]
+        self.current_position = self.raw_arguments[13]
+        self.target_position = self.raw_arguments[14]
+        self.functional_positions = self.raw_arguments[15:19]
+        self.remaining_time = self.raw_arguments[19]
+        self.timestamp = self.raw_arguments[20]
         ...
 
     def __str__(self):
@@ -62,3 +68,36 @@ class GetAllNodesInformationNtf(KlfGwResponse):
 class GetAllNodesInformationFinishedNtf(KlfGwResponse):
     klf_command = commands.GW_GET_ALL_NODES_INFORMATION_FINISHED_NTF
     arguments_format = ''
+
+class NodeStatePositionChangedNtf(KlfGwResponse):
+    klf_command = commands.GW_NODE_STATE_POSITION_CHANGED_NTF
+    arguments_format = 'BBHHHHHHHL'
+
+    def fill_arguments(self):
+        self.node_id = self.raw_arguments[0]
+        self.state = self.raw_arguments[1]
+        self.current_position = self.raw_arguments[2]
+        self.target_position = self.raw_arguments[3]
+        self.functional_positions = self.raw_arguments[4:8]
+        self.remaining_time = self.raw_arguments[8]
+        self.timestamp = self.raw_arguments[9]
+
+class HouseStatusMonitorEnableReq(KlfGwRequest):
+    klf_command = commands.GW_HOUSE_STATUS_MONITOR_ENABLE_REQ
+
+    def get_arguments(self):
+        return ()
+
+class HouseStatusMonitorEnableCfm(KlfGwResponse):
+    klf_command = commands.GW_HOUSE_STATUS_MONITOR_ENABLE_CFM
+    arguments_format = ''
+
+class HouseStatusMonitorDisableReq(KlfGwRequest):
+    klf_command = commands.GW_HOUSE_STATUS_MONITOR_DISABLE_REQ
+
+    def get_arguments(self):
+        return ()
+
+class HouseStatusMonitorDisableCfm(KlfGwResponse):
+    klf_command = commands.GW_HOUSE_STATUS_MONITOR_DISABLE_CFM
+    arguments_format = ''
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Commands from the "Scenes" section of the API
+"""
+
+from . import commands
+from .base import KlfGwResponse, KlfGwRequest, KlfSuccessZeroMixin
+from .command_handler import KlfSessionId, CommandSendReq
+
+class ActivateSceneReq(KlfSessionId, KlfGwRequest):
+    klf_command = commands.GW_ACTIVATE_SCENE_REQ
+
+    VELOCITY_DEFAULT = 0
+    VELOCITY_SILENT = 1
+    VELOCITY_FAST = 2
+
+    def __init__(self, scene_id, velocity=VELOCITY_DEFAULT,
+            originator=CommandSendReq.ORIGINATOR_USER,
+            priority_level=CommandSendReq.PRIORITY_USER_LEVEL2):
+        super().__init__()
+        self.scene_id = scene_id
+        self.velocity = velocity
+        self.originator = originator
+        self.priority_level = priority_level
+
+    def get_arguments(self):
+        return (
+            ('H', self.session_id),
+            ('B', self.originator),
+            ('B', self.priority_level),
+            ('B', self.scene_id),
+            ('B', self.velocity),
+        )
+
+class ActivateSceneCfm(KlfSuccessZeroMixin, KlfGwResponse):
+    klf_command = commands.GW_ACTIVATE_SCENE_CFM
+    arguments_format = 'BH'
+
+    def fill_arguments(self):
+        super().fill_arguments()
+        self.session_id = self.raw_arguments[1]
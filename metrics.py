@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Minimal metrics registry, exposed in the Prometheus text format
+"""
+
+import bisect
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(name=name,
+        value=escape_label(value)) for name, value in pairs) + '}'
+
+class Metric:
+    """
+    Base class for metrics. Each metric holds one value per combination
+    of label values.
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yield (suffix, label values, extra labels, value) tuples.
+        """
+        for labelvalues, value in sorted(self.values.items()):
+            yield '', labelvalues, (), value
+
+    def expose(self):
+        lines = [
+            '# HELP {name} {doc}'.format(name=self.name, doc=self.documentation),
+            '# TYPE {name} {type}'.format(name=self.name, type=self.metric_type),
+        ]
+        for suffix, labelvalues, extra, value in self.samples():
+            lines.append('{name}{suffix}{labels} {value}'.format(
+                name=self.name, suffix=suffix,
+                labels=format_labels(self.labelnames, labelvalues, extra),
+                value=format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    Gauge, either set explicitly or computed at exposition time by a
+    function given to set_function.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        self.functions[self.key(labels)] = function
+
+    def samples(self):
+        values = dict(self.values)
+        for key, function in self.functions.items():
+            values[key] = function()
+        for labelvalues, value in sorted(values.items()):
+            yield '', labelvalues, (), value
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+            2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(),
+            buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        try:
+            counts, total = self.values[key]
+        except KeyError:
+            counts, total = [0] * (len(self.buckets) + 1), 0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[key] = (counts, total + value)
+
+    def samples(self):
+        for labelvalues, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', labelvalues, (('le', format_value(bound)),), cumulative
+            yield '_sum', labelvalues, (), total
+            yield '_count', labelvalues, (), cumulative
+
+class MetricsRegistry:
+    """
+    Set of metrics exposed together.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Duplicate metric {}".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self.register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def expose(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        return ''.join(metric.expose() + '\n'
+                for name, metric in sorted(self.metrics.items()))
+
+# Registry fed by the gateway client and the REST server
+REGISTRY = MetricsRegistry()
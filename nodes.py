@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local cache of the actuator nodes known by the gateway
+"""
+
+import os
+
+import messages.info
+
+# Raw position values, see the "Standard Parameter definition" section of
+# the KLF200 API.
+POSITION_MAX_RELATIVE = 0xC800
+POSITION_UNKNOWN = 0xF7FF
+
+# The gateway handles at most 200 nodes, numbered from 0
+MAX_NODES = 200
+
+def position_to_percent(position):
+    """
+    Convert a raw relative position into a percentage between 0 and 100,
+    or None when the position is unknown or not a relative value.
+    """
+    if position is None or position > POSITION_MAX_RELATIVE:
+        return None
+    return round(100 * position / POSITION_MAX_RELATIVE, 1)
+
+class KlfNode:
+    """
+    Last known state of a single actuator node.
+    """
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.version = 0
+        self.name = None
+        self.product_group = None
+        self.product_type = None
+        self.state = None
+        self.current_position = None
+        self.target_position = None
+        self.remaining_time = None
+
+    def update(self, event):
+        """
+        Update the node from a gateway notification about it. Return
+        whether anything changed.
+        """
+        changed = False
+        for attribute in ('name', 'product_group', 'product_type', 'state',
+                'current_position', 'target_position', 'remaining_time'):
+            if hasattr(event, attribute):
+                value = getattr(event, attribute)
+                if getattr(self, attribute) != value:
+                    setattr(self, attribute, value)
+                    changed = True
+        return changed
+
+    @property
+    def expected_position(self):
+        """
+        Position the node is at, or is moving to. None when unknown.
+        """
+        for position in (self.target_position, self.current_position):
+            if position is not None and position != POSITION_UNKNOWN:
+                return position
+        return None
+
+    def to_json(self):
+        return {
+            'id': self.node_id,
+            'name': self.name,
+            'position': position_to_percent(self.current_position),
+            'target': position_to_percent(self.target_position),
+        }
+
+class KlfNodeTable:
+    """
+    Node cache, fed with the notifications received from the gateway.
+
+    An instance is meant to be registered as a listener on a KlfClient.
+
+    The table has a version, bumped on every node change; each node
+    records the table version of its last change, so that clients can
+    ask for the nodes changed since a version they already know. The
+    epoch identifies the table instance, hence the version sequence.
+    Removed nodes leave the version of their removal behind, so that
+    clients also learn about them.
+
+    A table restored from a snapshot is stale until the next full node
+    sweep, which also drops the nodes the gateway no longer knows.
+    """
+    node_events = (
+        messages.info.GetAllNodesInformationNtf,
+        messages.info.NodeStatePositionChangedNtf,
+    )
+
+    def __init__(self):
+        self.nodes = {}
+        self.populated = False
+        self.stale = False
+        # Nodes found by the current sweep of a stale table
+        self.swept = set()
+        self.version = 0
+        self.epoch = os.urandom(4).hex()
+        # Node id -> table version of its removal
+        self.removed = {}
+
+    def __call__(self, event):
+        if isinstance(event, self.node_events):
+            node = self.get_or_create(event.node_id)
+            if node.update(event):
+                self.touch(node)
+            if isinstance(event, messages.info.GetAllNodesInformationNtf):
+                self.swept.add(event.node_id)
+        elif isinstance(event, messages.info.GetAllNodesInformationFinishedNtf):
+            if self.stale:
+                for node_id in set(self.nodes) - self.swept:
+                    del self.nodes[node_id]
+                    self.version += 1
+                    self.removed[node_id] = self.version
+                self.stale = False
+            self.swept.clear()
+            self.populated = True
+
+    def touch(self, node):
+        """
+        Record a change of node in the table version.
+        """
+        self.version += 1
+        node.version = self.version
+
+    def get_or_create(self, node_id):
+        try:
+            return self.nodes[node_id]
+        except KeyError:
+            self.removed.pop(node_id, None)
+            node = self.nodes[node_id] = KlfNode(node_id)
+            return node
+
+    def get(self, node_id):
+        return self.nodes.get(node_id)
+
+    def changed_since(self, version):
+        """
+        Return the nodes changed after the given table version.
+        """
+        return [node for node in self if node.version > version]
+
+    def removed_since(self, version):
+        """
+        Return the identifiers of the nodes removed after the given
+        table version.
+        """
+        return sorted(node_id for node_id, removed in self.removed.items()
+                if removed > version)
+
+    @property
+    def etag(self):
+        return '"nodes-{epoch}-{version}"'.format(epoch=self.epoch,
+                version=self.version)
+
+    def __iter__(self):
+        return iter(sorted(self.nodes.values(), key=lambda node: node.node_id))
+
+    def __len__(self):
+        return len(self.nodes)
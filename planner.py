@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compile desired node states into as few command frames as possible
+"""
+
+import asyncio
+import logging
+import struct
+
+import messages.command_handler
+import messages.fp
+from manager import KlfRoutingError
+
+class KlfPlannedCommand:
+    """
+    One CommandSendReq frame, moving a group of nodes to the same main
+    parameter value.
+    """
+    def __init__(self, main_parameter, nodes=()):
+        self.main_parameter = main_parameter
+        self.nodes = list(nodes)
+        self.request = None
+        self.confirmation = None
+        self.error = None
+        self.queued = False
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return 'error'
+        elif self.queued:
+            return 'queued'
+        elif self.confirmation is None:
+            return 'pending'
+        elif self.confirmation.is_success:
+            return 'accepted'
+        else:
+            return 'rejected'
+
+    def to_json(self):
+        body = {
+            'nodes': self.nodes,
+            'status': self.status,
+        }
+        if self.request is not None:
+            body['session_id'] = self.request.session_id
+        if self.error is not None:
+            body['error'] = str(self.error)
+        return body
+
+class KlfCommandPlanner:
+    """
+    Turn a desired state, mapping node identifiers to functional
+    parameter values, into CommandSendReq frames.
+
+    Nodes already at (or moving to) their desired position are skipped,
+    and nodes sharing the same value are grouped in a single frame.
+    Commands go through journal, a KlfCommandJournal, when given.
+    """
+    # A CommandSendReq frame holds at most 20 node identifiers
+    MAX_NODES_PER_FRAME = 20
+
+    def __init__(self, klf_client, journal=None):
+        self.klf_client = klf_client
+        self.journal = journal
+
+    @staticmethod
+    def raw_value(value):
+        return struct.unpack('>H', bytes(value))[0]
+
+    def is_noop(self, node_id, value):
+        """
+        Tell whether sending value to the node would not change
+        anything, according to the cached node state.
+        """
+        if isinstance(value, messages.fp.Ignore):
+            return True
+        if not isinstance(value, messages.fp.Relative) or self.klf_client.nodes.stale:
+            return False
+        node = self.klf_client.nodes.get(node_id)
+        return node is not None and \
+                node.expected_position == self.raw_value(value)
+
+    def compile(self, commands):
+        """
+        Group (node_id, value) pairs into planned commands, each of them
+        holding nodes of the same gateway with the same value. When a
+        node appears several times, its last value wins: a node is only
+        sent one command.
+        """
+        planned = {}
+        for node_id, value in dict(commands).items():
+            try:
+                client = self.klf_client.route((node_id,))[0]
+            except KlfRoutingError:
+                # Grouped anyway, sending will report the error
+                client = None
+            frames = planned.setdefault((client, bytes(value)), [])
+            if not frames or len(frames[-1].nodes) >= self.MAX_NODES_PER_FRAME:
+                frames.append(KlfPlannedCommand(value))
+            frames[-1].nodes.append(node_id)
+        return [frame for frames in planned.values() for frame in frames]
+
+    def plan(self, desired):
+        """
+        Diff desired against the node cache and return the list of
+        planned commands together with the list of skipped nodes.
+        """
+        commands = []
+        skipped = []
+        for node_id, value in desired.items():
+            if self.is_noop(node_id, value):
+                skipped.append(node_id)
+            else:
+                commands.append((node_id, value))
+        return self.compile(commands), skipped
+
+    async def submit(self, planned_commands, **command_args):
+        """
+        Send planned commands concurrently to the gateway and wait for
+        all of their confirmations.
+        """
+        async def submit_one(planned):
+            planned.request = messages.command_handler.CommandSendReq(
+                    main_parameter=planned.main_parameter,
+                    nodes=tuple(planned.nodes), **command_args)
+            try:
+                if self.journal is None:
+                    planned.confirmation = await self.klf_client.send(planned.request)
+                else:
+                    planned.confirmation = await self.journal.send(
+                            self.klf_client, planned.request)
+                    planned.queued = planned.confirmation is None
+            except Exception as e:
+                logging.warning("Planned command for nodes {nodes} failed: {error}".format(
+                    nodes=planned.nodes, error=e))
+                planned.error = e
+
+        await asyncio.gather(*(submit_one(planned) for planned in planned_commands))
+        return planned_commands
+
+    async def apply(self, desired, **command_args):
+        """
+        Move nodes to the desired state, sending only needed commands.
+
+        Return the list of sent commands and the list of skipped nodes.
+        """
+        if not self.klf_client.nodes.populated:
+            await self.klf_client.get_all_nodes_information()
+
+        planned_commands, skipped = self.plan(desired)
+        await self.submit(planned_commands, **command_args)
+        return planned_commands, skipped
@@ -17,108 +17,491 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
-import re
 import h11
 import asyncio
+import collections
+import hashlib
 import logging
+import time
+from urllib.parse import parse_qs
 
 import messages.info
 import messages.general
 import messages.command_handler
 import messages.fp
+from admission import AdmissionController
+from events import KlfEventSubscription
+from metrics import REGISTRY
+from messages.fp import parse_value
+from router import Router, RouteNotFound, MethodNotAllowed
+
+# The WebSocket channel, the command journal, the gateway manager and
+# the command planner are imported where they are used, so that a
+# server only pays for the subsystems it enables.
+
+class RestRequest:
+    """
+    HTTP request received from a client, along with its body.
+
+    h11 events are immutable, hence this wrapper.
+    """
+    def __init__(self, event):
+        self.method = event.method
+        self.target = event.target
+        self.headers = event.headers
+        self.query = parse_qs(event.target.partition(b'?')[2].decode('utf-8', 'replace'))
+        self.body = b''
+        self.body_json = None
+        self.route = None
+        self.idempotency_key = None
+
+class RequestTooLarge(Exception):
+    """
+    Exception raised when a request body exceeds the configured limit.
+    """
+    pass
+
+logger = logging.getLogger('klf.rest')
+
+HTTP_REQUESTS = REGISTRY.counter('http_requests_total',
+        'HTTP requests handled by the REST server',
+        ('route', 'method', 'status'))
+HTTP_LATENCY = REGISTRY.histogram('http_request_duration_seconds',
+        'Time spent handling HTTP requests', ('route',))
+HTTP_CONNECTIONS = REGISTRY.gauge('http_connections',
+        'Open connections to the REST server')
+HTTP_INFLIGHT = REGISTRY.gauge('http_requests_inflight',
+        'HTTP requests being handled by the REST server')
+HTTP_IDEMPOTENT_REPLAYS = REGISTRY.counter('http_idempotent_replays_total',
+        'Requests answered with the response of an earlier request with the same Idempotency-Key',
+        ('state',))
+
+def etag_matches(if_none_match, etag):
+    """
+    Tell whether an If-None-Match header value matches an entity tag.
+    Weak comparison is used, as GET requests allow it.
+    """
+    if if_none_match is None:
+        return False
+    if isinstance(if_none_match, bytes):
+        if_none_match = if_none_match.decode('ascii', 'replace')
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+class CacheEntry:
+    """
+    Encoded response body kept in a ResponseCache.
+    """
+    def __init__(self, data, ttl):
+        self.data = data
+        self.etag = '"{}"'.format(hashlib.sha1(data).hexdigest()[:20])
+        self.expires = time.monotonic() + ttl
+
+    @property
+    def max_age(self):
+        return max(0, int(self.expires - time.monotonic()))
+
+    def matches(self, if_none_match):
+        """
+        Tell whether an If-None-Match header value matches this entry.
+        """
+        return etag_matches(if_none_match, self.etag)
+
+class ResponseCache:
+    """
+    JSON-encoded responses of rarely changing gateway endpoints, each key
+    having its own time to live.
+
+    The cache is a KlfClient listener: gateway frames which announce a
+    change flush the related entries.
+    """
+    # Default time to live of each cache key, in seconds
+    DEFAULT_TTLS = {
+        'version': 3600,
+        'network_setup': 300,
+        'clock': 1,
+    }
+
+    def __init__(self, ttls=None):
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.entries = {}
+        self.pending = {}
+        self.generation = 0
+        self.invalidation_hooks = {
+            messages.general.SetNetworkSetupCfm: ('network_setup',),
+            messages.general.SetUTCCfm: ('clock',),
+            messages.general.RtcSetTimeZoneCfm: ('clock',),
+            messages.general.RebootCfm: None,
+            messages.general.SetFactoryDefaultCfm: None,
+        }
+
+    def __call__(self, event):
+        try:
+            keys = self.invalidation_hooks[type(event)]
+        except KeyError:
+            return
+        self.invalidate(keys)
+
+    def invalidate(self, keys=None):
+        """
+        Drop the given cache keys, or every entry when keys is None.
+        """
+        self.generation += 1
+        if keys is None:
+            self.entries.clear()
+        else:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires <= time.monotonic():
+            del self.entries[key]
+            entry = None
+        return entry
+
+    async def fetch(self, key, build):
+        """
+        Return the cache entry for key, awaiting the build coroutine
+        function to compute its body on a miss. Concurrent misses share
+        a single build.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = asyncio.ensure_future(
+                    self.build(key, build))
+        return await asyncio.shield(pending)
+
+    async def build(self, key, build):
+        generation = self.generation
+        try:
+            entry = CacheEntry(json.dumps(await build()).encode('utf-8'),
+                    self.ttls[key])
+        finally:
+            del self.pending[key]
+        # Do not keep a response which may predate an invalidation
+        if generation == self.generation:
+            self.entries[key] = entry
+        return entry
+
+class IdempotencyEntry:
+    """
+    Response, possibly still being built, to a request carrying an
+    Idempotency-Key header.
+    """
+    def __init__(self, fingerprint, ttl):
+        self.fingerprint = fingerprint
+        self.response = asyncio.get_running_loop().create_future()
+        self.expires = time.monotonic() + ttl
+
+class IdempotencyCache:
+    """
+    Least recently used Idempotency-Key values, mapped to the response
+    of their first request. Entries expire after ttl seconds, and at
+    most max_entries of them are kept.
+
+    Requests with a known key do not reach the gateway: they get the
+    stored response, or wait for it while the first request is being
+    handled.
+    """
+    def __init__(self, max_entries=1024, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def add(self, key, fingerprint):
+        entry = self.entries[key] = IdempotencyEntry(fingerprint, self.ttl)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def discard(self, key, entry):
+        if self.entries.get(key) is entry:
+            del self.entries[key]
+
+class RestServer:
+    """
+    State shared by all client connections of the REST server.
+
+    klf_client is either a KlfClient, or a KlfGatewayManager presenting
+    the nodes of several gateways. When a KlfCommandJournal is given,
+    node commands go through it. handle_client is meant to be given to
+    asyncio.start_server.
+
+    Until ready is set, only requests which do not need the gateway are
+    handled; the others get 503.
+
+    The frames exchanged with the gateway are only exposed when
+    debug_frames is set.
+    """
+    def __init__(self, klf_client, max_body_size=None, limits=None,
+            loop_monitor=None, journal=None, debug_frames=False):
+        self.klf_client = klf_client
+        self.loop_monitor = loop_monitor
+        self.journal = journal
+        self.debug_frames = debug_frames
+        self.ready = True
+        self.max_body_size = max_body_size or RestClientConnection.MAX_BODY_SIZE
+        self.router = RestClientConnection.build_router()
+        self.admission = AdmissionController(limits)
+        HTTP_CONNECTIONS.set_function(lambda: self.admission.connections)
+        HTTP_INFLIGHT.set_function(lambda: self.admission.inflight)
+        self.response_cache = ResponseCache()
+        self.idempotency_cache = IdempotencyCache()
+        # Encoded node list, along with the node table version it matches
+        self.node_list = (None, None)
+        klf_client.add_listener(self.response_cache)
+
+    def handle_client(self, reader, writer):
+        return RestClientConnection(reader, writer, self).run()
 
 class RestClientConnection(asyncio.Protocol):
     """
     Client connection handling. One should instance a new object for
     each client connection then call the run coroutine which will handle
     client requests.
+
+    Connections are kept alive between requests, and pipelined requests
+    are answered in order.
     """
-    def __init__(self, reader, writer, klf_client):
-        logging.info("Client connected to the REST server")
+    # Bounds for the adaptive socket read size
+    MIN_READ_SIZE = 4096
+    MAX_READ_SIZE = 65536
+
+    # Largest accepted request body, in bytes
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self, reader, writer, server):
+        logger.debug("Client connected to the REST server", extra={
+            'client': writer.get_extra_info('peername')})
         self.reader = reader
         self.writer = writer
-        self.klf_client = klf_client
+        self.server = server
+        self.klf_client = server.klf_client
+        self.max_body_size = server.max_body_size
         self.connection = h11.Connection(h11.SERVER)
+        self.status_code = None
+        # Arguments of the last write_response call
+        self.last_response = None
+        peername = writer.get_extra_info('peername')
+        self.client = peername[0] if isinstance(peername, tuple) else peername
+        self.read_size = self.MIN_READ_SIZE
+
+    async def receive_data(self):
+        """
+        Read data from the client and feed it to the HTTP state machine.
+
+        The read size doubles while the client fills whole reads, and
+        shrinks back when reads become small.
+        """
+        data = await self.reader.read(self.read_size)
+        if len(data) >= self.read_size:
+            self.read_size = min(2 * self.read_size, self.MAX_READ_SIZE)
+        elif len(data) < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, self.MIN_READ_SIZE)
+        self.connection.receive_data(data)
+
+    async def next_event(self):
+        """
+        Return the next HTTP event, reading from the client as needed.
+        """
+        while True:
+            event = self.connection.next_event()
+            if event is not h11.NEED_DATA:
+                return event
+            await self.receive_data()
+
+    async def receive_body(self, request):
+        """
+        Read the request body until the end of the message.
+        """
+        content_length = dict(request.headers).get(b'content-length')
+        if content_length is not None and int(content_length) > self.max_body_size:
+            raise RequestTooLarge()
+
+        body = bytearray()
+        while True:
+            event = await self.next_event()
+            if isinstance(event, h11.Data):
+                if len(body) + len(event.data) > self.max_body_size:
+                    raise RequestTooLarge()
+                body += event.data
+            elif isinstance(event, h11.EndOfMessage):
+                return bytes(body)
+            elif isinstance(event, h11.ConnectionClosed):
+                raise ConnectionResetError()
 
     async def run(self):
         """
         Receive client requests, forward them to the KLF gateway client
         and build responses.
         """
-        while True:
-            self.connection.receive_data(await self.reader.read(100))
-            event = None
-            current_request = None
+        rejection = self.server.admission.open_connection()
+        if rejection is not None:
+            # Shed the connection without even parsing its request
+            self.writer.write('HTTP/1.1 {status} {reason}\r\n'
+                    'Retry-After: {retry_after}\r\n'
+                    'Connection: close\r\n'
+                    'Content-Length: 0\r\n\r\n'.format(
+                        status=rejection.status_code,
+                        reason=rejection.reason.decode('ascii'),
+                        retry_after=rejection.retry_after).encode('ascii'))
+            self.writer.close()
+            return
 
-            while not (isinstance(event, h11.ConnectionClosed)
-                    or event is h11.NEED_DATA
-                    or event is h11.PAUSED):
+        try:
+            await self.serve()
+        finally:
+            self.server.admission.close_connection()
 
-                event = self.connection.next_event()
+    async def serve(self):
+        try:
+            while not self.writer.is_closing():
+                event = await self.next_event()
 
                 if isinstance(event, h11.Request):
-                    if event.method == b'GET':
-                        await self.handle_GET(event)
-                    elif event.method == b'POST':
-                        current_request = event
-                        current_request.body = b''
-                    else:
-                        # Method not allowed
-                        await self.method_not_allowed()
-
-                elif isinstance(event, h11.Data):
-                    current_request.body += event.data
-
-                elif isinstance(event, h11.EndOfMessage) and \
-                        isinstance(current_request, h11.Request) and \
-                        current_request.method == b'POST':
-                    try:
-                        current_request.body_json = json.loads(current_request.body)
-                    except json.JSONDecodeError:
-                        await self.write_simple_response(
-                            status_code=400,
-                            reason='Invalid request',
-                            body={
-                                'status': 'error',
-                                'message': 'Invalid JSON data',
-                            })
+                    await self.handle_request(event)
+
+                elif event is h11.PAUSED:
+                    if self.connection.our_state is h11.DONE and \
+                            self.connection.their_state is h11.DONE:
+                        # Keep-alive: get ready for the next request,
+                        # which may already be buffered.
+                        self.connection.start_next_cycle()
                     else:
-                        await self.handle_POST(current_request)
+                        break
+
+                elif isinstance(event, h11.ConnectionClosed):
+                    break
 
-                    current_request = None
+                if self.connection.our_state is h11.MUST_CLOSE:
+                    break
 
-            if self.connection.our_state is h11.MUST_CLOSE:
-                self.writer.close()
-                await self.writer.wait_closed()
+        except h11.RemoteProtocolError as e:
+            logger.info("Invalid HTTP request: %s", e)
+            if self.connection.our_state in (h11.IDLE, h11.SEND_RESPONSE):
+                await self.write_simple_response(
+                        status_code=e.error_status_hint,
+                        reason=b'Invalid request',
+                        body={'status': 'error'})
+        except ConnectionError:
+            pass
+
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def handle_request(self, event):
+        """
+        Answer a request, and account for it in the request metrics
+        once its status is known, whichever step answered it.
+        """
+        start = time.monotonic()
+        self.status_code = None
+        request = RestRequest(event)
+        try:
+            try:
+                request.body = await self.receive_body(event)
+            except RequestTooLarge:
+                await self.write_simple_response(
+                    status_code=413,
+                    reason=b'Payload too large',
+                    headers=(('Connection', 'close'),),
+                    body={
+                        'status': 'error',
+                        'message': 'Request body is too large',
+                    })
                 return
 
-    async def write_simple_response(self, status_code=200, reason=b'OK',
-            headers=(), body={}):
-        data = h11.Data(data=json.dumps(body).encode('utf-8'))
+            await self.dispatch(request)
+        finally:
+            self.record_request(request, time.monotonic() - start)
+
+    def record_request(self, request, latency):
+        if self.status_code is None:
+            # The client left before getting an answer
+            return
+        route = request.route or 'unmatched'
+        # Streams last as long as their client, which says nothing
+        # about the server latency
+        if route not in self.long_lived_routes:
+            HTTP_LATENCY.observe(latency, route=route)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request handled", extra={
+                'route': route,
+                'status': self.status_code,
+                'latency': round(latency, 6),
+            })
+        HTTP_REQUESTS.inc(route=route,
+                method=request.method.decode('ascii', 'replace'),
+                status=self.status_code)
+
+    async def write_response(self, data, status_code=200, reason=b'OK',
+            headers=(), content_type='application/json'):
+        self.status_code = status_code
+        self.last_response = (data, status_code, reason, headers, content_type)
         response = h11.Response(status_code=status_code,
                 headers=headers + (
-                    ('Content-type', 'application/json'),
-                    ('Content-length', str(len(data.data))),
+                    ('Content-type', content_type),
+                    ('Content-length', str(len(data))),
                 ), reason=reason)
-        self.writer.write(self.connection.send(response) + self.connection.send(data) +
+        self.writer.write(self.connection.send(response) +
+                self.connection.send(h11.Data(data=data)) +
                 self.connection.send(h11.EndOfMessage()))
         await self.writer.drain()
 
-    async def method_not_allowed(self):
+    async def write_simple_response(self, status_code=200, reason=b'OK',
+            headers=(), body={}):
+        await self.write_response(json.dumps(body).encode('utf-8'),
+                status_code=status_code, reason=reason, headers=headers)
+
+    async def write_cached_response(self, request, key, build):
+        """
+        Answer from the response cache, honouring If-None-Match.
+        """
+        entry = await self.server.response_cache.fetch(key, build)
+        headers = (
+            ('ETag', entry.etag),
+            ('Cache-control', 'max-age={}'.format(entry.max_age)),
+        )
+        if entry.matches(dict(request.headers).get(b'if-none-match')):
+            self.status_code = 304
+            self.writer.write(self.connection.send(h11.Response(
+                status_code=304, headers=headers, reason=b'Not modified')) +
+                self.connection.send(h11.EndOfMessage()))
+            await self.writer.drain()
+        else:
+            await self.write_response(entry.data, headers=headers)
+
+    async def method_not_allowed(self, allowed):
         await self.write_simple_response(
                 status_code=405,
                 reason=b'Method not allowed',
-                headers=(('Allow', 'GET, POST'),),
+                headers=(('Allow', ', '.join(allowed)),),
                 body={'status': 'error', 'reason': 'HTTP method not allowed'})
 
-    @staticmethod
-    def find_handler(url_patterns, request):
-        for url_pattern, url_handler in url_patterns:
-            url_match = re.fullmatch(url_pattern, request.target)
-            if url_match is not None:
-                return url_handler(request, **url_match.groupdict())
-        return None
-
     async def internal_error(self, request):
         await self.write_simple_response(status_code=500,
                 reason='Internal server error',
@@ -129,117 +512,495 @@ class RestClientConnection(asyncio.Protocol):
             reason=b'Not found',
             body={'status': 'error'})
 
-    async def handle_GET(self, request):
+    # Route table: HTTP method, path template, handler name
+    routes = (
+        ('GET', '/actuator/', 'GET_actuator'),
+        ('GET', '/actuator/<int:node_id>/', 'GET_actuator'),
+        ('GET', '/version/', 'GET_gateway_version'),
+        ('GET', '/network_setup/', 'GET_network_setup'),
+        ('GET', '/clock/', 'GET_clock'),
+        ('GET', '/events/', 'GET_events'),
+        ('GET', '/ws/', 'GET_websocket'),
+        ('GET', '/metrics/', 'GET_metrics'),
+        ('GET', '/debug/loop/', 'GET_debug_loop'),
+        ('GET', '/debug/frames/', 'GET_debug_frames'),
+        ('POST', '/actuator/<int:node_id>/send/', 'POST_actuator'),
+        ('POST', '/actuator/<int:node_id>/wink/', 'POST_actuator_wink'),
+        ('POST', '/actuators/send/', 'POST_actuators_send'),
+        ('POST', '/actuators/apply/', 'POST_actuators_apply'),
+        ('POST', '/config/controller_copy/', 'POST_controller_copy'),
+        ('POST', '/config/virgin_state/', 'POST_virgin_state'),
+        ('POST', '/clock/', 'POST_clock'),
+    )
+
+    # Routes holding the connection for a stream, exempt from request
+    # admission control
+    long_lived_routes = frozenset(('/events/', '/ws/'))
+
+    # Routes answered before the gateway is connected
+    local_routes = frozenset(('/metrics/', '/debug/loop/'))
+
+    # Routes answered from the node table, once it is populated, even
+    # before the gateway is connected
+    node_table_routes = frozenset(('/actuator/', '/actuator/<int:node_id>/'))
+
+    # Routes commanding nodes, which honour the Idempotency-Key header
+    idempotent_routes = frozenset((
+        '/actuator/<int:node_id>/send/',
+        '/actuator/<int:node_id>/wink/',
+        '/actuators/send/',
+        '/actuators/apply/',
+    ))
+
+    # Longest accepted Idempotency-Key header value
+    MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+    @classmethod
+    def build_router(cls):
+        """
+        Build the router for the routes handled by this class.
+        """
+        router = Router()
+        for method, template, handler_name in cls.routes:
+            router.add(method, template, getattr(cls, handler_name))
+        return router
+
+    async def dispatch(self, request):
         try:
-            url_handler = self.find_handler((
-                (b'/actuator/(?:(?P<node_id>\d+)/)?$', self.GET_actuator),
-                (b'/version/?', self.GET_gateway_version),
-                (b'/network_setup/?', self.GET_network_setup),
-                (b'/clock/?', self.GET_clock),
-            ), request)
-            if url_handler is not None:
-                await url_handler
-            else:
-                await self.handle_not_found(request)
-        except Exception as e:
-            logging.error(e, exc_info=True)
-            await self.internal_error(request)
+            handler, parameters, request.route = \
+                    self.server.router.match(request.method, request.target)
+        except RouteNotFound:
+            await self.handle_not_found(request)
+            return
+        except MethodNotAllowed as e:
+            await self.method_not_allowed(e.allowed)
+            return
+
+        if 'node_id' in parameters and \
+                not self.klf_client.is_node_id(parameters['node_id']):
+            await self.handle_not_found(request)
+            return
+
+        if not self.server.ready and request.route not in self.local_routes and \
+                not (request.route in self.node_table_routes and
+                    self.klf_client.nodes.populated):
+            await self.write_simple_response(
+                status_code=503,
+                reason=b'Service unavailable',
+                headers=(('Retry-After', '1'),),
+                body={'status': 'error', 'message': 'Gateway not connected yet'})
+            return
+
+        if request.method == b'POST':
+            try:
+                request.body_json = json.loads(request.body)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                await self.write_simple_response(
+                    status_code=400,
+                    reason=b'Invalid request',
+                    body={
+                        'status': 'error',
+                        'message': 'Invalid JSON data',
+                    })
+                return
+
+        if request.route in self.long_lived_routes:
+            # Streams only count against the connection limit
+            await self.call_handler(handler, request, parameters)
+            return
+
+        if request.route in self.idempotent_routes:
+            request.idempotency_key = dict(request.headers).get(b'idempotency-key')
+            if request.idempotency_key is not None and \
+                    len(request.idempotency_key) > self.MAX_IDEMPOTENCY_KEY_LENGTH:
+                await self.write_simple_response(
+                    status_code=400,
+                    reason=b'Invalid request',
+                    body={
+                        'status': 'error',
+                        'message': 'Idempotency-Key is too long',
+                    })
+                return
+
+        admission = self.server.admission
+        rejection = admission.admit(self.client)
+        if rejection is not None:
+            await self.write_simple_response(
+                status_code=rejection.status_code,
+                reason=rejection.reason,
+                headers=(('Retry-After', str(rejection.retry_after)),),
+                body={'status': 'error', 'message': 'Server is busy'})
+            return
 
-    async def handle_POST(self, request):
         try:
-            url_handler = self.find_handler((
-                (b'/actuator/(?P<node_id>\d+)/send/?$', self.POST_actuator),
-                (b'/actuator/(?P<node_id>\d+)/wink/?$', self.POST_actuator_wink),
-                (b'/config/controller_copy/?', self.POST_controller_copy),
-                (b'/config/virgin_state/?', self.POST_virgin_state),
-                (b'/clock/?', self.POST_clock),
-            ), request)
-            if url_handler is not None:
-                await url_handler
+            if request.idempotency_key is None:
+                await self.call_handler(handler, request, parameters)
             else:
-                await self.handle_not_found(request)
+                await self.call_idempotent(handler, request, parameters)
+        finally:
+            admission.release(self.client)
+
+    async def call_idempotent(self, handler, request, parameters):
+        """
+        Call handler unless the Idempotency-Key of the request is known,
+        in which case the response of the first request is sent again.
+
+        Server errors are not kept, so that retries can succeed.
+        """
+        cache = self.server.idempotency_cache
+        key = request.idempotency_key
+        fingerprint = hashlib.sha1(request.method + b' ' + request.target +
+                b'\n' + request.body).digest()
+
+        entry = cache.get(key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                await self.write_simple_response(
+                    status_code=422,
+                    reason=b'Unprocessable entity',
+                    body={
+                        'status': 'error',
+                        'message': 'Idempotency-Key already used for another request',
+                    })
+                return
+            HTTP_IDEMPOTENT_REPLAYS.inc(
+                    state='completed' if entry.response.done() else 'inflight')
+            data, status_code, reason, headers, content_type = \
+                    await asyncio.shield(entry.response)
+            await self.write_response(data, status_code=status_code,
+                    reason=reason, content_type=content_type,
+                    headers=headers + (('Idempotent-Replayed', 'true'),))
+            return
+
+        entry = cache.add(key, fingerprint)
+        self.last_response = None
+        try:
+            await self.call_handler(handler, request, parameters)
+        finally:
+            response = self.last_response
+            if response is None:
+                response = (json.dumps({'status': 'error'}).encode('utf-8'),
+                        500, b'Internal server error', (), 'application/json')
+            if response[1] >= 500:
+                cache.discard(key, entry)
+            entry.response.set_result(response)
+
+    async def call_handler(self, handler, request, parameters):
+        try:
+            await handler(self, request, **parameters)
         except Exception as e:
-            logging.error(e, exc_info=True)
-            await self.internal_error(request)
+            # Only a KlfGatewayManager raises routing errors
+            from manager import KlfRoutingError
+            if isinstance(e, KlfRoutingError):
+                await self.handle_not_found(request)
+            else:
+                logger.error(e, exc_info=True, extra={'route': request.route})
+                await self.internal_error(request)
 
     async def GET_actuator(self, request, node_id=None):
         """
         Request for actuator information. When node_id is None, the full
         list of actuators is returned.
-        """
-        logging.info("Asking all nodes information to the KLF gateway")
-        information_ntf = self.klf_client.get_response(messages.info.GetAllNodesInformationNtf)
-        finished_ntf = self.klf_client.get_response(messages.info.GetAllNodesInformationFinishedNtf)
-        await self.klf_client.send(messages.info.GetAllNodesInformationReq())
-
-        finished_event = None
-        klf_nodes = []
-        logging.info("Waiting for all nodes information")
-        while finished_event != finished_ntf:
-            events, _ = await asyncio.wait((information_ntf, finished_ntf),
-                    return_when=asyncio.FIRST_COMPLETED)
-            for event in events:
-                if event == information_ntf:
-                    logging.info("Got one frame in response to all nodes information")
-                    information_ntf = self.klf_client.get_response(messages.info.GetAllNodesInformationNtf)
-                    node_info = event.result()
-                    klf_nodes.append({
-                        'id': node_info.node_id,
-                        'name': node_info.name,
-                        })
-                elif event == finished_ntf:
-                    logging.info("Got final frame in response to all nodes information")
-                    information_ntf.cancel()
-                    finished_event = finished_ntf
-
-        # Response to the HTTP request
-        await self.write_simple_response(body=klf_nodes)
 
-    async def POST_actuator(self, request, node_id):
-        command_args = {}
+        Answers come from the node table, which the gateway keeps up to
+        date. With a "since" query parameter, holding the "cursor" of a
+        previous answer ("epoch:version"), only nodes changed after that
+        version are returned, along with the identifiers of the nodes
+        removed since then in "removed", and the new cursor. A cursor
+        from another node table instance, for instance before a
+        restart, gets every node, and "full" set.
 
-        def parse_value(value):
-            if value == 'current':
-                return messages.fp.Current()
-            elif value == 'target':
-                return messages.fp.Target()
-            elif value == 'default':
-                return messages.fp.Default()
-            elif value == 'ignore':
-                return messages.fp.Ignore()
+        Until the first node sweep completes, a table restored from a
+        snapshot is used as is, with an "X-Node-Table-Stale: true"
+        header.
+        """
+        node_table = self.klf_client.nodes
+        if not node_table.populated:
+            await self.klf_client.get_all_nodes_information()
+
+        stale_headers = (('X-Node-Table-Stale', 'true'),) if node_table.stale else ()
+        if node_id is not None:
+            node = node_table.get(node_id)
+            if node is None:
+                await self.handle_not_found(request)
             else:
-                value_match = re.fullmatch('(?P<sign>[+-])?(?P<percent>\d{,3})%',
-                        value)
-                if value_match is None:
-                    raise ValueError(value)
-
-                sign = value_match.group('sign')
-                percent = min(100, int(value_match.group('percent'))) / 100
-                if sign is None:
-                    return messages.fp.Relative(percent)
-                elif sign == '+':
-                    return messages.fp.Percent(percent)
-                else: # sign == '-'
-                    return messages.fp.Percent(-percent)
+                await self.write_simple_response(headers=stale_headers,
+                        body=node.to_json())
+            return
+
+        headers = (
+            ('ETag', node_table.etag),
+            ('X-Node-Table-Epoch', node_table.epoch),
+            ('X-Node-Table-Version', str(node_table.version)),
+        ) + stale_headers
+
+        since = None
+        if 'since' in request.query:
+            # A bare version is accepted as a cursor of the current epoch
+            epoch, _, version = request.query['since'][0].rpartition(':')
+            try:
+                since = int(version)
+            except ValueError:
+                pass
+        if since is not None:
+            # The versions of another node table, or from the future,
+            # mean nothing here: the client needs everything.
+            if (epoch and epoch != node_table.epoch) or \
+                    not 0 <= since <= node_table.version:
+                since = 0
+            await self.write_simple_response(headers=headers, body={
+                'epoch': node_table.epoch,
+                'version': node_table.version,
+                'cursor': '{}:{}'.format(node_table.epoch, node_table.version),
+                'full': since == 0,
+                'nodes': [node.to_json() for node in node_table.changed_since(since)],
+                'removed': node_table.removed_since(since),
+            })
+            return
+
+        if etag_matches(dict(request.headers).get(b'if-none-match'),
+                node_table.etag):
+            self.status_code = 304
+            self.writer.write(self.connection.send(h11.Response(
+                status_code=304, headers=headers, reason=b'Not modified')) +
+                self.connection.send(h11.EndOfMessage()))
+            await self.writer.drain()
+            return
+
+        cached_version, data = self.server.node_list
+        if cached_version != (node_table.epoch, node_table.version):
+            data = json.dumps([node.to_json() for node in node_table]).encode('utf-8')
+            self.server.node_list = ((node_table.epoch, node_table.version), data)
+        await self.write_response(data, headers=headers)
+
+    async def GET_metrics(self, request):
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        await self.write_response(REGISTRY.expose().encode('utf-8'),
+                content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    async def GET_debug_loop(self, request):
+        """
+        Event loop lag and recent slow callbacks, when the loop monitor
+        is enabled.
+        """
+        if self.server.loop_monitor is None:
+            await self.handle_not_found(request)
+            return
+        await self.write_simple_response(body=self.server.loop_monitor.to_json())
+
+    async def GET_debug_frames(self, request):
+        """
+        Last frames exchanged with the gateway, oldest first, when
+        enabled. Password frames are redacted.
+        """
+        if not self.server.debug_frames:
+            await self.handle_not_found(request)
+            return
+        await self.write_simple_response(body=self.klf_client.frame_ring.to_json())
+
+    async def GET_events(self, request):
+        """
+        Server-Sent Events stream of node state changes. The connection
+        is dedicated to the stream and closed when the client leaves.
+        """
+        self.status_code = 200
+        self.writer.write(self.connection.send(h11.Response(status_code=200,
+                headers=(
+                    ('Content-type', 'text/event-stream'),
+                    ('Cache-control', 'no-cache'),
+                ), reason=b'OK')))
+
+        disconnected = asyncio.ensure_future(self.reader.read(1024))
+        with KlfEventSubscription(self.klf_client) as subscription:
+            try:
+                while True:
+                    if disconnected.done():
+                        if not disconnected.result():
+                            break
+                        # Anything sent by the client is ignored
+                        disconnected = asyncio.ensure_future(self.reader.read(1024))
+
+                    next_event = asyncio.ensure_future(subscription.get())
+                    done, _ = await asyncio.wait((next_event, disconnected),
+                            timeout=15, return_when=asyncio.FIRST_COMPLETED)
+                    if next_event in done:
+                        name, data = next_event.result()
+                        chunk = 'event: {name}\ndata: {data}\n\n'.format(
+                                name=name, data=json.dumps(data))
+                    else:
+                        next_event.cancel()
+                        if disconnected in done:
+                            continue
+                        # Comment line, which lets us notice dead clients
+                        chunk = ': keepalive\n\n'
+
+                    self.writer.write(self.connection.send(
+                        h11.Data(data=chunk.encode('utf-8'))))
+                    await self.writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                disconnected.cancel()
+
+        logger.info("Event stream client disconnected")
+        self.writer.close()
 
+    async def GET_websocket(self, request):
+        """
+        Upgrade the connection to the WebSocket control channel.
+        """
+        from ws_server import WebSocketConnection, accept_token
+
+        token = accept_token(request)
+        if token is None:
+            await self.write_simple_response(status_code=400,
+                reason=b'Invalid request',
+                body={
+                    'status': 'error',
+                    'message': 'WebSocket upgrade expected',
+                })
+            return
+
+        self.status_code = 101
+        self.writer.write(self.connection.send(h11.InformationalResponse(
+            status_code=101,
+            headers=(
+                ('Upgrade', 'websocket'),
+                ('Connection', 'Upgrade'),
+                ('Sec-WebSocket-Accept', token),
+            ), reason=b'Switching Protocols')))
+        trailing_data, _ = self.connection.trailing_data
+        await WebSocketConnection(self.reader, self.writer, self.klf_client,
+                trailing_data).run()
+
+    async def POST_actuator(self, request, node_id):
+        command_args = {}
         command_args['main_parameter'] = parse_value(request.body_json.get('value'))
-        command_args['nodes'] = (int(node_id),)
+        command_args['nodes'] = (node_id,)
         command_req = messages.command_handler.CommandSendReq(**command_args)
-        command_cfm = await self.klf_client.send(messages.command_handler.CommandSendReq(**command_args))
+        if self.server.journal is None:
+            command_cfm = await self.klf_client.send(command_req)
+        else:
+            from journal import KlfDuplicateCommand
+            key = request.idempotency_key
+            if key is not None:
+                key = key.decode('ascii', 'replace')
+            try:
+                command_cfm = await self.server.journal.send(self.klf_client,
+                        command_req, key)
+            except KlfDuplicateCommand as e:
+                await self.write_simple_response(status_code=409,
+                    reason=b'Conflict',
+                    body={'status': 'error', 'message': str(e)})
+                return
         # TODO check if command_cfm has the same session id
         body = {'session_id': command_req.session_id}
-        if command_cfm.is_success:
+        if command_cfm is None:
+            # The journal delivers the command once the gateway is back
+            body['status'] = 'queued'
+            await self.write_simple_response(status_code=202,
+                    reason=b'Accepted', body=body)
+            return
+        elif command_cfm.is_success:
             body['status'] = 'accepted'
         else:
             body['status'] = 'rejected'
 
         await self.write_simple_response(body=body)
 
+    async def POST_actuators_send(self, request):
+        """
+        Send commands to several nodes at once. The request body is a
+        list of {"node": ..., "value": ...} objects; nodes sharing the
+        same value are commanded with a single frame. When a node is
+        listed several times, only its last entry is sent, the former
+        ones being reported as superseded.
+        """
+        if not isinstance(request.body_json, list):
+            await self.write_simple_response(status_code=400,
+                reason=b'Invalid request',
+                body={
+                    'status': 'error',
+                    'message': 'Expected a list of {"node", "value"} objects',
+                })
+            return
+
+        from planner import KlfCommandPlanner
+
+        results = []
+        commands = []
+        # Result of the last entry of each node
+        node_entries = {}
+        for entry in request.body_json:
+            try:
+                node_id = int(entry['node'])
+                value = parse_value(entry['value'])
+                if not self.klf_client.is_node_id(node_id):
+                    raise ValueError(node_id)
+            except (KeyError, TypeError, ValueError):
+                results.append({
+                    'node': entry.get('node') if isinstance(entry, dict) else None,
+                    'status': 'error',
+                    'message': 'Invalid node or value',
+                })
+            else:
+                if node_id in node_entries:
+                    node_entries[node_id]['status'] = 'superseded'
+                node_entries[node_id] = {'node': node_id}
+                results.append(node_entries[node_id])
+                commands.append((node_id, value))
+
+        planner = KlfCommandPlanner(self.klf_client, self.server.journal)
+        planned_commands = await planner.submit(planner.compile(commands))
+
+        node_results = {}
+        for planned in planned_commands:
+            planned_json = planned.to_json()
+            del planned_json['nodes']
+            for node_id in planned.nodes:
+                node_results[node_id] = planned_json
+        for result in results:
+            if 'status' not in result:
+                result.update(node_results[result['node']])
+
+        await self.write_simple_response(body=results)
+
+    async def POST_actuators_apply(self, request):
+        """
+        Move several nodes to a desired state. The request body maps
+        node identifiers to values, under the "nodes" key. Nodes already
+        in the desired state are skipped.
+        """
+        from planner import KlfCommandPlanner
+
+        try:
+            desired = {int(node_id): parse_value(value)
+                    for node_id, value in request.body_json['nodes'].items()}
+            if not all(self.klf_client.is_node_id(node_id) for node_id in desired):
+                raise ValueError(desired)
+        except (KeyError, AttributeError, TypeError, ValueError):
+            await self.write_simple_response(status_code=400,
+                reason=b'Invalid request',
+                body={
+                    'status': 'error',
+                    'message': 'Expected a "nodes" object mapping node identifiers to values',
+                })
+            return
+
+        planned_commands, skipped = await KlfCommandPlanner(self.klf_client,
+                self.server.journal).apply(desired)
+        await self.write_simple_response(body={
+            'sent': [planned.to_json() for planned in planned_commands],
+            'skipped': skipped,
+        })
+
     async def POST_actuator_wink(self, request, node_id):
         wink_cfm = await self.klf_client.send(messages.command_handler.WinkSendReq(
             wink_state=messages.command_handler.WinkSendReq.WINK_ENABLE,
             wink_time=15,
-            nodes=(int(node_id),)))
+            nodes=(node_id,)))
         await self.write_simple_response(body={
             'status': 'accepted' if wink_cfm.is_success else 'rejected',
             })
@@ -264,33 +1025,39 @@ class RestClientConnection(asyncio.Protocol):
         })
 
     async def GET_gateway_version(self, request):
-        firmware_version_info = await self.klf_client.send(messages.general.GetVersionReq())
-        protocol_version_info = await self.klf_client.send(messages.general.GetProtocolVersionReq())
-        await self.write_simple_response(body={
-            'software_version': list(firmware_version_info.software_version),
-            'hardware_version': firmware_version_info.hardware_version,
-            'product_group': firmware_version_info.product_group,
-            'product_type': firmware_version_info.product_type,
-            'protocol_major_version': protocol_version_info.major_version,
-            'protocol_minor_version': protocol_version_info.minor_version,
-        })
+        async def build():
+            firmware_version_info = await self.klf_client.send(messages.general.GetVersionReq())
+            protocol_version_info = await self.klf_client.send(messages.general.GetProtocolVersionReq())
+            return {
+                'software_version': list(firmware_version_info.software_version),
+                'hardware_version': firmware_version_info.hardware_version,
+                'product_group': firmware_version_info.product_group,
+                'product_type': firmware_version_info.product_type,
+                'protocol_major_version': protocol_version_info.major_version,
+                'protocol_minor_version': protocol_version_info.minor_version,
+            }
+        await self.write_cached_response(request, 'version', build)
 
     async def GET_network_setup(self, request):
-        network_info = await self.klf_client.send(messages.general.GetNetworkSetupReq())
-        await self.write_simple_response(body={
-            'ip_address': str(network_info.ip_address),
-            'mask': str(network_info.mask),
-            'default_gw': str(network_info.default_gw),
-            'use_dhcp': network_info.use_dhcp
-        })
+        async def build():
+            network_info = await self.klf_client.send(messages.general.GetNetworkSetupReq())
+            return {
+                'ip_address': str(network_info.ip_address),
+                'mask': str(network_info.mask),
+                'default_gw': str(network_info.default_gw),
+                'use_dhcp': network_info.use_dhcp
+            }
+        await self.write_cached_response(request, 'network_setup', build)
 
     async def GET_clock(self, request):
-        clock_info = await self.klf_client.send(messages.general.GetLocalTimeReq())
-        await self.write_simple_response(body={
-            'time': clock_info.utc_time.isoformat(),
-            'localtime': clock_info.local_time.isoformat(),
-            'dst_flag': clock_info.dst_flag,
-        })
+        async def build():
+            clock_info = await self.klf_client.send(messages.general.GetLocalTimeReq())
+            return {
+                'time': clock_info.utc_time.isoformat(),
+                'localtime': clock_info.local_time.isoformat(),
+                'dst_flag': clock_info.dst_flag,
+            }
+        await self.write_cached_response(request, 'clock', build)
 
     async def POST_clock(self, request):
         clock_cfm = await self.klf_client.send(messages.general.SetUTCReq())
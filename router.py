@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+URL routing for the REST server
+"""
+
+from urllib.parse import unquote
+
+class RouteNotFound(Exception):
+    """
+    Exception raised when no route matches the requested path.
+    """
+    pass
+
+class MethodNotAllowed(Exception):
+    """
+    Exception raised when the requested path exists, but not for the
+    requested HTTP method.
+    """
+    def __init__(self, allowed):
+        super().__init__(allowed)
+        self.allowed = allowed
+
+def parse_int(segment):
+    """
+    Convert a path segment made of ASCII digits only to an integer.
+    Signs, spaces and other digits, which int accepts, raise ValueError.
+    """
+    if not (segment.isascii() and segment.isdigit()):
+        raise ValueError("Invalid integer {!r}".format(segment))
+    return int(segment)
+
+class RouteNode:
+    """
+    Node of the route trie, matching one path segment.
+    """
+    def __init__(self):
+        self.children = {}
+        self.parameters = []
+        self.handlers = {}
+        self.template = None
+
+class Router:
+    """
+    Route table mapping HTTP methods and paths to handlers.
+
+    Paths are templates such as '/actuator/<int:node_id>/send', where
+    typed parameters are converted before being handed to the handler.
+    Routes are stored in a trie indexed by path segment, so that matching
+    cost only depends on the depth of the path. Trailing slashes are
+    ignored.
+    """
+    converters = {
+        'int': parse_int,
+        'str': str,
+    }
+
+    def __init__(self):
+        self.root = RouteNode()
+
+    @staticmethod
+    def split_path(path):
+        return [segment for segment in path.split('/') if segment]
+
+    def add(self, method, template, handler):
+        node = self.root
+        for segment in self.split_path(template):
+            if segment.startswith('<') and segment.endswith('>'):
+                converter_name, _, name = segment[1:-1].rpartition(':')
+                converter = self.converters[converter_name or 'str']
+                for parameter in node.parameters:
+                    if parameter[:2] == (name, converter):
+                        node = parameter[2]
+                        break
+                else:
+                    child = RouteNode()
+                    node.parameters.append((name, converter, child))
+                    node = child
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+
+        node.handlers[method] = handler
+        node.template = template
+
+    def find_node(self, node, segments, parameters):
+        if not segments:
+            return node if node.handlers else None
+
+        segment, remaining = segments[0], segments[1:]
+        child = node.children.get(segment)
+        if child is not None:
+            found = self.find_node(child, remaining, parameters)
+            if found is not None:
+                return found
+
+        for name, converter, child in node.parameters:
+            try:
+                parameters[name] = converter(segment)
+            except ValueError:
+                continue
+            found = self.find_node(child, remaining, parameters)
+            if found is not None:
+                return found
+            del parameters[name]
+
+        return None
+
+    def match(self, method, target):
+        """
+        Find the handler for a request.
+
+        Return the handler, the dictionary of converted path parameters
+        and the matched route template. Raise RouteNotFound or
+        MethodNotAllowed when there is no suitable route.
+        """
+        if isinstance(target, bytes):
+            target = target.decode('utf-8', 'replace')
+        if isinstance(method, bytes):
+            method = method.decode('ascii', 'replace')
+        path = target.partition('?')[0]
+
+        parameters = {}
+        node = self.find_node(self.root,
+                [unquote(segment) for segment in self.split_path(path)],
+                parameters)
+        if node is None:
+            raise RouteNotFound(path)
+
+        try:
+            handler = node.handlers[method]
+        except KeyError:
+            raise MethodNotAllowed(sorted(node.handlers))
+
+        return handler, parameters, node.template
@@ -0,0 +1,434 @@
+#!env python3
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Local KLF200 gateway simulator, for testing and load testing without
+hardware.
+
+The simulator listens for TLS connections, speaks the same SLIP framing
+as the real gateway, and answers the requests implemented in the
+messages package. Simulated nodes move at a constant speed and report
+their progress through notifications. Latency, busy errors and
+disconnections can be injected.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import shutil
+import ssl
+import struct
+import subprocess
+import tempfile
+import time
+from functools import reduce
+from operator import xor
+
+import messages.auth
+import messages.command_handler
+import messages.general
+import messages.info
+import messages.scenes
+from client import KlfConnection
+from nodes import POSITION_MAX_RELATIVE
+
+def build_frame(response_class, *arguments):
+    """
+    Build the raw (unescaped) frame of a gateway response.
+    """
+    arguments_format = getattr(response_class, 'arguments_format', None) or ''
+    command_frame = struct.pack('>H' + arguments_format,
+            response_class.klf_command, *arguments)
+    frame = struct.pack('>BB', 0, len(command_frame) + 1) + command_frame
+    return frame + struct.pack('>B', reduce(xor, frame))
+
+def pack_response(response_class, *arguments):
+    """
+    Build the SLIP-encoded frame of a gateway response.
+    """
+    return KlfConnection.slip_pack(build_frame(response_class, *arguments))
+
+def generate_self_signed_cert(directory):
+    """
+    Generate a self-signed certificate and key with the openssl command
+    line tool, like the one of the real gateway. Return their paths.
+    """
+    cert_path = os.path.join(directory, 'simulator.crt')
+    key_path = os.path.join(directory, 'simulator.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+        '-nodes', '-days', '365', '-subj', '/CN=klf200-simulator',
+        '-keyout', key_path, '-out', cert_path],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_path, key_path
+
+class SimulatedNode:
+    """
+    Actuator moving at a constant speed between positions 0 and
+    POSITION_MAX_RELATIVE.
+    """
+    STATE_DONE = 5
+    STATE_EXECUTING = 4
+
+    def __init__(self, node_id, travel_time):
+        self.node_id = node_id
+        self.name = 'Simulated node {}'.format(node_id)
+        self.speed = POSITION_MAX_RELATIVE / travel_time
+        self.start_position = 0
+        self.target = 0
+        self.start_time = 0
+        self.session = None
+
+    def position(self, now):
+        distance = self.target - self.start_position
+        travelled = (now - self.start_time) * self.speed
+        if travelled >= abs(distance):
+            return self.target
+        return int(self.start_position + travelled * (1 if distance > 0 else -1))
+
+    def remaining_time(self, now):
+        return int(abs(self.target - self.position(now)) / self.speed)
+
+    def state(self, now):
+        if self.position(now) == self.target:
+            return self.STATE_DONE
+        return self.STATE_EXECUTING
+
+    def move_to(self, target, now, session):
+        self.start_position = self.position(now)
+        self.start_time = now
+        self.target = target
+        self.session = session
+
+class SimulatorOptions:
+    """
+    Behaviour of the simulated gateway.
+    """
+    def __init__(self, password=b'velux123', nodes=10, travel_time=20,
+            latency=0.02, jitter=0.01, busy_rate=0, disconnect_rate=0,
+            notification_interval=1):
+        self.password = password
+        self.nodes = nodes
+        self.travel_time = travel_time
+        self.latency = latency
+        self.jitter = jitter
+        self.busy_rate = busy_rate
+        self.disconnect_rate = disconnect_rate
+        self.notification_interval = notification_interval
+
+class KlfSimulator:
+    """
+    State of the simulated gateway, shared by all client connections.
+    """
+    # Gateway error numbers, see messages.general.ErrorNtf
+    ERROR_UNKNOWN_COMMAND = 1
+    ERROR_BUSY = 7
+    ERROR_NOT_AUTHENTICATED = 12
+
+    def __init__(self, options=None):
+        self.options = options or SimulatorOptions()
+        self.nodes = {node_id: SimulatedNode(node_id, self.options.travel_time)
+                for node_id in range(self.options.nodes)}
+        self.connections = set()
+        self.motion_task = None
+        # Temporary directory of the generated certificate, removed on stop
+        self.cert_directory = None
+
+    def start(self):
+        self.motion_task = asyncio.ensure_future(self.run_motion())
+
+    def stop(self):
+        if self.motion_task is not None:
+            self.motion_task.cancel()
+        if self.cert_directory is not None:
+            shutil.rmtree(self.cert_directory, ignore_errors=True)
+            self.cert_directory = None
+
+    def node_position_ntf(self, node, now):
+        return pack_response(messages.info.NodeStatePositionChangedNtf,
+                node.node_id, node.state(now), node.position(now), node.target,
+                0, 0, 0, 0, node.remaining_time(now), int(time.time()))
+
+    def node_information_ntf(self, node, now):
+        return pack_response(messages.info.GetAllNodesInformationNtf,
+                node.node_id, node.node_id, 0, node.name.encode('utf-8'),
+                0, 0x0040, 14, 2, 0, 0, 0, b'\0' * 8,
+                node.state(now), node.position(now), node.target,
+                0, 0, 0, 0, node.remaining_time(now), int(time.time()),
+                0, 0, 0, 0, 0, 0)
+
+    async def run_motion(self):
+        """
+        Report moving nodes, and finish sessions once their nodes have
+        arrived.
+        """
+        while True:
+            await asyncio.sleep(self.options.notification_interval)
+            now = time.monotonic()
+            for node in self.nodes.values():
+                if node.session is None:
+                    continue
+                connection, session_id = node.session
+                arrived = node.position(now) == node.target
+                for other in self.connections:
+                    if other.monitor_enabled:
+                        other.write(self.node_position_ntf(node, now))
+                if arrived:
+                    node.session = None
+                    connection.node_arrived(session_id, node)
+
+class SimulatorConnection(asyncio.Protocol):
+    """
+    One client connection to the simulated gateway.
+    """
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.options = simulator.options
+        # The client side already accounts for this traffic
+        self.klf_connection = KlfConnection(instrumented=False)
+        self.transport = None
+        self.authenticated = False
+        self.monitor_enabled = False
+        self.sessions = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.simulator.connections.add(self)
+        logging.info("Simulator: client connected")
+
+    def connection_lost(self, exc):
+        self.simulator.connections.discard(self)
+        logging.info("Simulator: client disconnected")
+
+    def write(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def data_received(self, data):
+        self.klf_connection.receive_data(data)
+        for request in self.klf_connection.iter_events():
+            asyncio.ensure_future(self.handle_request(request))
+
+    async def handle_request(self, request):
+        options = self.options
+        delay = options.latency + random.uniform(0, options.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if random.random() < options.disconnect_rate:
+            logging.info("Simulator: injecting a disconnection")
+            self.transport.abort()
+            return
+        if random.random() < options.busy_rate:
+            self.write(pack_response(messages.general.ErrorNtf,
+                KlfSimulator.ERROR_BUSY))
+            return
+
+        handler = self.handlers.get(request.klf_command)
+        if handler is None:
+            self.write(pack_response(messages.general.ErrorNtf,
+                KlfSimulator.ERROR_UNKNOWN_COMMAND))
+        elif not self.authenticated and \
+                request.klf_command != messages.auth.PasswordEnterReq.klf_command:
+            self.write(pack_response(messages.general.ErrorNtf,
+                KlfSimulator.ERROR_NOT_AUTHENTICATED))
+        else:
+            await handler(self, request.raw_frame[4:-1])
+
+    def node_arrived(self, session_id, node):
+        now = time.monotonic()
+        self.write(pack_response(messages.command_handler.CommandRunStatusNtf,
+            session_id, 1, node.node_id, 0, node.position(now), 0, 1, 0))
+        remaining = self.sessions.get(session_id)
+        if remaining is None:
+            return
+        remaining.discard(node.node_id)
+        if not remaining:
+            del self.sessions[session_id]
+            self.write(pack_response(messages.command_handler.SessionFinishedNtf,
+                session_id))
+
+    async def password_enter(self, arguments):
+        password = arguments[:31].rstrip(b'\0')
+        self.authenticated = password == self.options.password
+        self.write(pack_response(messages.auth.PasswordEnterCfm,
+            0 if self.authenticated else 1))
+
+    async def get_version(self, arguments):
+        self.write(pack_response(messages.general.GetVersionCfm,
+            bytes((0, 2, 0, 0, 71, 0)), 6, 14, 3))
+
+    async def get_protocol_version(self, arguments):
+        self.write(pack_response(messages.general.GetProtocolVersionCfm, 3, 18))
+
+    async def get_state(self, arguments):
+        self.write(pack_response(messages.general.GetStateCfm, 2, 0, b'\0' * 4))
+
+    async def get_network_setup(self, arguments):
+        self.write(pack_response(messages.general.GetNetworkSetupCfm,
+            bytes((127, 0, 0, 1)), bytes((255, 0, 0, 0)),
+            bytes((127, 0, 0, 1)), 0))
+
+    async def get_local_time(self, arguments):
+        now = time.time()
+        local = time.localtime(now)
+        self.write(pack_response(messages.general.GetLocalTimeCfm,
+            int(now), local.tm_sec, local.tm_min, local.tm_hour,
+            local.tm_mday, local.tm_mon - 1, local.tm_year - 1900,
+            local.tm_wday, local.tm_yday - 1, max(0, local.tm_isdst)))
+
+    async def set_utc(self, arguments):
+        self.write(pack_response(messages.general.SetUTCCfm))
+
+    async def set_time_zone(self, arguments):
+        self.write(pack_response(messages.general.RtcSetTimeZoneCfm, 1))
+
+    async def house_status_monitor_enable(self, arguments):
+        self.monitor_enabled = True
+        self.write(pack_response(messages.info.HouseStatusMonitorEnableCfm))
+
+    async def house_status_monitor_disable(self, arguments):
+        self.monitor_enabled = False
+        self.write(pack_response(messages.info.HouseStatusMonitorDisableCfm))
+
+    async def get_all_nodes_information(self, arguments):
+        nodes = list(self.simulator.nodes.values())
+        self.write(pack_response(messages.info.GetAllNodesInformationCfm,
+            0, len(nodes)))
+        for node in nodes:
+            await asyncio.sleep(0)
+            self.write(self.simulator.node_information_ntf(node, time.monotonic()))
+        self.write(pack_response(messages.info.GetAllNodesInformationFinishedNtf))
+
+    async def command_send(self, arguments):
+        session_id, main_parameter = struct.unpack('>H5xH', arguments[:9])
+        nodes = arguments[42:42 + arguments[41]]
+        known_nodes = [self.simulator.nodes[node_id] for node_id in nodes
+                if node_id in self.simulator.nodes]
+        accepted = bool(known_nodes) and main_parameter <= POSITION_MAX_RELATIVE
+        self.write(pack_response(messages.command_handler.CommandSendCfm,
+            session_id, int(accepted)))
+        if not accepted:
+            return
+
+        now = time.monotonic()
+        self.sessions[session_id] = set(node.node_id for node in known_nodes)
+        for node in known_nodes:
+            node.move_to(main_parameter, now, (self, session_id))
+            self.write(pack_response(messages.command_handler.CommandRunStatusNtf,
+                session_id, 1, node.node_id, 0, node.position(now), 2, 1, 0))
+
+    async def finish_immediately(self, arguments, confirmation_class):
+        session_id = struct.unpack('>H', arguments[:2])[0]
+        self.write(pack_response(confirmation_class, session_id, 1))
+        await asyncio.sleep(self.options.latency)
+        self.write(pack_response(messages.command_handler.SessionFinishedNtf,
+            session_id))
+
+    async def wink_send(self, arguments):
+        await self.finish_immediately(arguments,
+                messages.command_handler.WinkSendCfm)
+
+    async def status_request(self, arguments):
+        await self.finish_immediately(arguments,
+                messages.command_handler.StatusRequestCfm)
+
+    async def activate_scene(self, arguments):
+        # No scene is ever recorded in the simulator
+        session_id = struct.unpack('>H', arguments[:2])[0]
+        self.write(pack_response(messages.scenes.ActivateSceneCfm, 1, session_id))
+
+    handlers = {
+        messages.auth.PasswordEnterReq.klf_command: password_enter,
+        messages.general.GetVersionReq.klf_command: get_version,
+        messages.general.GetProtocolVersionReq.klf_command: get_protocol_version,
+        messages.general.GetStateReq.klf_command: get_state,
+        messages.general.GetNetworkSetupReq.klf_command: get_network_setup,
+        messages.general.GetLocalTimeReq.klf_command: get_local_time,
+        messages.general.SetUTCReq.klf_command: set_utc,
+        messages.general.RtcSetTimeZoneReq.klf_command: set_time_zone,
+        messages.info.HouseStatusMonitorEnableReq.klf_command: house_status_monitor_enable,
+        messages.info.HouseStatusMonitorDisableReq.klf_command: house_status_monitor_disable,
+        messages.info.GetAllNodesInformationReq.klf_command: get_all_nodes_information,
+        messages.command_handler.CommandSendReq.klf_command: command_send,
+        messages.command_handler.WinkSendReq.klf_command: wink_send,
+        messages.command_handler.StatusRequestReq.klf_command: status_request,
+        messages.scenes.ActivateSceneReq.klf_command: activate_scene,
+    }
+
+async def start_simulator(host='', port=51200, options=None, cert=None, key=None):
+    """
+    Start a simulated gateway and return the asyncio server and the
+    simulator state. Without cert and key, a self-signed certificate is
+    generated in a directory which simulator.stop removes.
+    """
+    simulator = KlfSimulator(options)
+    if cert is None or key is None:
+        simulator.cert_directory = tempfile.mkdtemp(prefix='klf200-sim-')
+        cert, key = generate_self_signed_cert(simulator.cert_directory)
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(cert, key)
+
+    simulator.start()
+    server = await asyncio.get_running_loop().create_server(
+            lambda: SimulatorConnection(simulator),
+            host=host, port=port, ssl=ssl_context)
+    return server, simulator
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=51200)
+    parser.add_argument('--password', default='velux123')
+    parser.add_argument('--nodes', type=int, default=10,
+            help="number of simulated nodes")
+    parser.add_argument('--travel-time', type=float, default=20,
+            help="seconds for a node to travel between both ends")
+    parser.add_argument('--latency', type=float, default=0.02,
+            help="delay before answering a request, in seconds")
+    parser.add_argument('--jitter', type=float, default=0.01,
+            help="random delay added to the latency, in seconds")
+    parser.add_argument('--busy-rate', type=float, default=0,
+            help="probability of answering a request with a busy error")
+    parser.add_argument('--disconnect-rate', type=float, default=0,
+            help="probability of dropping the connection on a request")
+    parser.add_argument('--notification-interval', type=float, default=1,
+            help="delay between position notifications of moving nodes")
+    parser.add_argument('--cert', help="TLS certificate, generated if missing")
+    parser.add_argument('--key', help="TLS private key, generated if missing")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    options = SimulatorOptions(password=args.password.encode('utf-8'),
+            nodes=args.nodes, travel_time=args.travel_time,
+            latency=args.latency, jitter=args.jitter,
+            busy_rate=args.busy_rate, disconnect_rate=args.disconnect_rate,
+            notification_interval=args.notification_interval)
+    server, simulator = await start_simulator(args.host, args.port, options,
+            args.cert, args.key)
+    logging.info("Simulated gateway listening on port {port}".format(port=args.port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        simulator.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main())
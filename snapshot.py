@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+On-disk snapshot of the gateway state, so that a restarted process can
+answer from it until its first node sweep completes.
+
+A snapshot starts with a header made of a magic string, the time it was
+saved (double) and the number of sections (byte). Each section has a
+header holding its kind, record count and record size (byte, unsigned
+short, unsigned short), followed by fixed-size records; sections of
+unknown kinds are skipped, so that groups and scenes can be added
+later. All integers are big-endian.
+"""
+
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+
+logger = logging.getLogger('klf.snapshot')
+
+SNAPSHOT_MAGIC = b'KLFSNAP1'
+HEADER = struct.Struct('>8sdB')
+SECTION_HEADER = struct.Struct('>BHH')
+
+SECTION_NODES = 1
+
+# Node id, name, product group, product type, state, current position,
+# target position, remaining time. Unknown values are stored as all
+# ones. Node ids are those of the node table, which may be the global
+# ids of a KlfGatewayManager, hence beyond a byte.
+NODE_RECORD = struct.Struct('>I64sBBBHHH')
+NODE_FIELDS = ('product_group', 'product_type', 'state',
+        'current_position', 'target_position', 'remaining_time')
+NODE_FIELD_UNKNOWN = (0xFF, 0xFF, 0xFF, 0xFFFF, 0xFFFF, 0xFFFF)
+
+class SnapshotFormatError(Exception):
+    """
+    Exception raised when reading a file which is not a valid snapshot.
+    """
+    pass
+
+def encode_snapshot(node_table, saved=None):
+    """
+    Return the snapshot of a KlfNodeTable, as bytes.
+    """
+    records = []
+    for node in node_table:
+        values = [getattr(node, field) for field in NODE_FIELDS]
+        records.append(NODE_RECORD.pack(node.node_id,
+            (node.name or '').encode('utf-8')[:64],
+            *(unknown if value is None else value
+                for value, unknown in zip(values, NODE_FIELD_UNKNOWN))))
+
+    return HEADER.pack(SNAPSHOT_MAGIC, time.time() if saved is None else saved, 1) + \
+            SECTION_HEADER.pack(SECTION_NODES, len(records), NODE_RECORD.size) + \
+            b''.join(records)
+
+def save_snapshot(path, data):
+    """
+    Atomically replace the snapshot file at path with data.
+    """
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+def decode_nodes(buffer, offset, count, node_table):
+    for i in range(count):
+        node_id, name, *values = NODE_RECORD.unpack_from(buffer,
+                offset + i * NODE_RECORD.size)
+        node = node_table.get_or_create(node_id)
+        node.name = name.split(b'\0', 1)[0].decode('utf-8', 'replace')
+        for field, value, unknown in zip(NODE_FIELDS, values, NODE_FIELD_UNKNOWN):
+            setattr(node, field, None if value == unknown else value)
+        node_table.touch(node)
+
+def load_snapshot(path, node_table):
+    """
+    Fill an empty KlfNodeTable from the snapshot at path, and mark it
+    stale. Return the time the snapshot was saved.
+    """
+    with open(path, 'rb') as snapshot_file:
+        try:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise SnapshotFormatError("Empty snapshot")
+
+    with buffer:
+        try:
+            magic, saved, section_count = HEADER.unpack_from(buffer)
+            if magic != SNAPSHOT_MAGIC:
+                raise SnapshotFormatError("Not a snapshot file")
+
+            offset = HEADER.size
+            for i in range(section_count):
+                kind, count, record_size = SECTION_HEADER.unpack_from(buffer, offset)
+                offset += SECTION_HEADER.size
+                if offset + count * record_size > len(buffer):
+                    raise SnapshotFormatError("Truncated snapshot")
+                if kind == SECTION_NODES:
+                    if record_size != NODE_RECORD.size:
+                        raise SnapshotFormatError("Unexpected node record size")
+                    decode_nodes(buffer, offset, count, node_table)
+                offset += count * record_size
+        except struct.error:
+            raise SnapshotFormatError("Truncated snapshot")
+
+    node_table.populated = True
+    node_table.stale = True
+    return saved
+
+class KlfSnapshotWriter:
+    """
+    Save the snapshot of a node table every interval seconds, when it
+    changed.
+    """
+    def __init__(self, path, node_table, interval=5):
+        self.path = path
+        self.node_table = node_table
+        self.interval = interval
+        self.saved_version = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            version = (self.node_table.epoch, self.node_table.version)
+            if version == self.saved_version or not self.node_table.populated:
+                continue
+            try:
+                data = encode_snapshot(self.node_table)
+            except (struct.error, ValueError) as e:
+                logger.error("Cannot encode the snapshot", extra={'error': e})
+                continue
+            try:
+                await loop.run_in_executor(None, save_snapshot, self.path, data)
+            except OSError as e:
+                logger.error("Cannot save the snapshot",
+                        extra={'path': self.path, 'error': e})
+                continue
+            self.saved_version = version
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Supervised gateway connection, reconnected whenever it drops
+"""
+
+import asyncio
+import logging
+import random
+import ssl
+
+import messages.auth
+import messages.info
+from client import KlfClient
+from metrics import REGISTRY
+
+logger = logging.getLogger('klf.client')
+
+RECONNECTIONS = REGISTRY.counter('klf_reconnections_total',
+        'Connections to the gateway established after a drop', ('resumed',))
+CONNECTION_ATTEMPTS = REGISTRY.counter('klf_connection_attempts_total',
+        'Attempts to connect to the gateway', ('result',))
+
+class KlfAuthenticationError(Exception):
+    """
+    Exception raised when the gateway refuses the password.
+    """
+    pass
+
+class KlfResumingSSLContext(ssl.SSLContext):
+    """
+    Client SSL context offering the session of the previous connection,
+    so that the gateway can skip the full TLS handshake.
+    """
+    saved_session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+            server_hostname=None, session=None):
+        if session is None:
+            session = self.saved_session
+        return super().wrap_bio(incoming, outgoing, server_side,
+                server_hostname, session)
+
+class KlfSupervisor:
+    """
+    Keep a KlfClient connected to the gateway.
+
+    The same KlfClient instance serves every connection, so that its
+    listeners and node table survive reconnections. After a drop, the
+    supervisor reconnects with exponential backoff, resuming the TLS
+    session when the gateway allows it, authenticates, enables the
+    house status monitor again, then releases the requests held in the
+    meantime and resynchronizes the node table.
+    """
+    def __init__(self, loop, address, password, port=51200,
+            policy=KlfClient.POLICY_HOLD, min_delay=1, max_delay=60,
+            heartbeat_interval=10 * 60, heartbeat_timeout=30, answer_timeout=10):
+        self.loop = loop
+        self.address = address
+        self.password = password
+        self.port = port
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        # A gateway not answering within answer_timeout seconds while
+        # connecting counts as a failed attempt
+        self.answer_timeout = answer_timeout
+        self.client = KlfClient(loop, policy=policy,
+                heartbeat_interval=heartbeat_interval,
+                heartbeat_timeout=heartbeat_timeout)
+        self.client.holding = True
+        self.client.connection_lost_handler = self.connection_lost
+        self.reconnect_task = None
+        self.ready = False
+        self.closing = False
+
+        self.ssl_context = KlfResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ssl_context.check_hostname = False
+        # The gateway certificate is self-signed.
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def connect(self):
+        """
+        Make one connection attempt, and bring the client to a ready
+        state.
+        """
+        transport, _ = await self.loop.create_connection(lambda: self.client,
+                host=self.address, port=self.port, ssl=self.ssl_context)
+        ssl_object = transport.get_extra_info('ssl_object')
+        resumed = ssl_object.session_reused
+
+        try:
+            confirmation = await asyncio.wait_for(self.client.send_now(
+                    messages.auth.PasswordEnterReq(self.password)),
+                    self.answer_timeout)
+            if not confirmation.is_success:
+                raise KlfAuthenticationError("Invalid gateway password")
+            # Have the gateway notify us of every node state change
+            await asyncio.wait_for(self.client.send_now(
+                    messages.info.HouseStatusMonitorEnableReq()),
+                    self.answer_timeout)
+        except BaseException:
+            transport.abort()
+            raise
+
+        # TLS 1.3 session tickets only arrive after the handshake
+        self.ssl_context.saved_session = ssl_object.session
+        self.ready = True
+        self.client.release_held()
+        return resumed
+
+    async def start(self):
+        """
+        Connect for the first time, retrying until the gateway answers.
+        Invalid credentials are not retried.
+        """
+        await self.run_attempts()
+        return self.client
+
+    async def run_attempts(self):
+        delay = self.min_delay
+        while True:
+            try:
+                resumed = await self.connect()
+            except KlfAuthenticationError:
+                CONNECTION_ATTEMPTS.inc(result='refused')
+                raise
+            except (OSError, ssl.SSLError, asyncio.TimeoutError) as e:
+                CONNECTION_ATTEMPTS.inc(result='failed')
+                logger.warning("Cannot connect to the gateway, retrying",
+                        extra={'error': e, 'delay': round(delay, 1)})
+            else:
+                CONNECTION_ATTEMPTS.inc(result='connected')
+                return resumed
+
+            # Full jitter, so that several clients do not retry together
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, self.max_delay)
+
+    def connection_lost(self, exc):
+        # Failed attempts are retried by the loop which made them
+        was_ready, self.ready = self.ready, False
+        if self.closing or not was_ready or self.reconnect_task is not None:
+            return
+        self.reconnect_task = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        try:
+            await asyncio.sleep(random.uniform(0, self.min_delay))
+            while True:
+                try:
+                    resumed = await self.run_attempts()
+                    break
+                except KlfAuthenticationError:
+                    logger.critical("Gateway refused the password, retrying")
+                    await asyncio.sleep(self.max_delay)
+            RECONNECTIONS.inc(resumed=resumed)
+            logger.info("Reconnected to the gateway",
+                    extra={'tls_resumed': resumed})
+        finally:
+            self.reconnect_task = None
+
+        # Nodes which changed while disconnected bump the table version,
+        # unchanged ones are left as they are.
+        try:
+            await self.client.get_all_nodes_information()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        self.closing = True
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        if self.client.transport is not None:
+            self.client.transport.close()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Helpers shared by the test cases: an in-memory link between a KlfClient
+and the gateway simulator, and a minimal HTTP client for the REST
+server.
+"""
+
+import asyncio
+import json
+
+from client import KlfClient
+from simulator import KlfSimulator, SimulatorConnection, SimulatorOptions
+
+class LoopbackTransport(asyncio.Transport):
+    """
+    Transport handing written data to the peer protocol on the next loop
+    iteration, as a socket would.
+    """
+    def __init__(self, protocol, peer):
+        super().__init__()
+        self.protocol = protocol
+        self.peer = peer
+        self.peer_transport = None
+        self.closing = False
+
+    def write(self, data):
+        if not self.closing:
+            asyncio.get_running_loop().call_soon(self.peer.data_received, data)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+        loop = asyncio.get_running_loop()
+        for transport in (self, self.peer_transport):
+            transport.closing = True
+            loop.call_soon(transport.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+def connect_loopback(protocol, peer):
+    """
+    Connect two protocols to each other, and return the transport of
+    the first one.
+    """
+    transport = LoopbackTransport(protocol, peer)
+    peer_transport = LoopbackTransport(peer, protocol)
+    transport.peer_transport = peer_transport
+    peer_transport.peer_transport = transport
+    peer.connection_made(peer_transport)
+    protocol.connection_made(transport)
+    return transport
+
+def simulator_options(**options):
+    """
+    Return options of a fast simulator: no latency, and nodes travelling
+    in a tenth of a second.
+    """
+    values = {
+        'nodes': 4,
+        'travel_time': 0.1,
+        'latency': 0,
+        'jitter': 0,
+        'notification_interval': 0.01,
+    }
+    values.update(options)
+    return SimulatorOptions(**values)
+
+async def connect_simulator(client=None, options=None):
+    """
+    Connect a KlfClient to a new simulator, authenticate and enable the
+    house status monitor. Return the client and the simulator; the
+    caller stops the simulator.
+    """
+    import messages.info
+
+    simulator = KlfSimulator(options or simulator_options())
+    simulator.start()
+    if client is None:
+        client = KlfClient(asyncio.get_running_loop())
+    connect_loopback(client, SimulatorConnection(simulator))
+    confirmation = await client.authenticate(simulator.options.password)
+    assert confirmation.is_success
+    await client.send(messages.info.HouseStatusMonitorEnableReq())
+    return client, simulator
+
+class HttpResponse:
+    """
+    Response read by http_request.
+    """
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+async def http_request(port, method, path, body=None, headers=()):
+    """
+    Send a single request to a local HTTP server and read the response,
+    the connection being closed by the server.
+    """
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+    body = body or b''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+            'Connection: close\r\nContent-Length: {length}\r\n{headers}\r\n'.format(
+                method=method, path=path, length=len(body),
+                headers=''.join('{}: {}\r\n'.format(name, value)
+                    for name, value in headers)).encode('ascii') + body)
+    data = await reader.read()
+    writer.close()
+
+    head, _, body = data.partition(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('ascii').split('\r\n')
+    return HttpResponse(int(status_line.split()[1]),
+            {name.lower(): value for name, value in
+                (line.split(': ', 1) for line in header_lines)},
+            body)
+
+async def start_rest_server(klf_client, **server_args):
+    """
+    Start a RestServer on a free local port. Return the asyncio server
+    and its port.
+    """
+    from rest_server import RestServer
+
+    rest_server = RestServer(klf_client, **server_args)
+    server = await asyncio.start_server(rest_server.handle_client, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+from admission import AdmissionController, AdmissionLimits, Rejection, TokenBucket
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_delay(self):
+        bucket = TokenBucket(rate=0.5, burst=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        delay = bucket.take()
+        self.assertGreater(delay, 1.9)
+        self.assertLessEqual(delay, 2)
+
+class RejectionTest(unittest.TestCase):
+    def test_retry_after_is_a_whole_positive_number(self):
+        self.assertEqual(Rejection(429, b'', 0.1).retry_after, 1)
+        self.assertEqual(Rejection(429, b'', 2.5).retry_after, 3)
+        self.assertEqual(Rejection(429, b'', 0).retry_after, 1)
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_connections(self):
+        admission = AdmissionController(AdmissionLimits(max_connections=2))
+        self.assertIsNone(admission.open_connection())
+        self.assertIsNone(admission.open_connection())
+        self.assertEqual(admission.open_connection().status_code, 503)
+        admission.close_connection()
+        self.assertIsNone(admission.open_connection())
+
+    def test_inflight_per_client(self):
+        admission = AdmissionController(AdmissionLimits(
+            max_inflight_per_client=2, client_rate=None))
+        self.assertIsNone(admission.admit('a'))
+        self.assertIsNone(admission.admit('a'))
+        self.assertEqual(admission.admit('a').status_code, 429)
+        self.assertIsNone(admission.admit('b'))
+        admission.release('a')
+        self.assertIsNone(admission.admit('a'))
+
+        for _ in range(2):
+            admission.release('a')
+        admission.release('b')
+        self.assertEqual(admission.inflight, 0)
+        self.assertEqual(admission.client_inflight, {})
+
+    def test_queue_depth(self):
+        admission = AdmissionController(AdmissionLimits(max_queue_depth=2,
+            max_inflight_per_client=None, client_rate=None))
+        self.assertIsNone(admission.admit('a'))
+        self.assertIsNone(admission.admit('b'))
+        self.assertEqual(admission.admit('c').status_code, 503)
+
+    def test_rate(self):
+        admission = AdmissionController(AdmissionLimits(client_rate=0.1,
+            client_burst=1, max_inflight_per_client=None))
+        self.assertIsNone(admission.admit('a'))
+        rejection = admission.admit('a')
+        self.assertEqual(rejection.status_code, 429)
+        self.assertEqual(rejection.retry_after, 10)
+        self.assertIsNone(admission.admit('b'))
+
+    def test_rejected_requests_are_not_in_flight(self):
+        admission = AdmissionController(AdmissionLimits(client_rate=0.1,
+            client_burst=1))
+        admission.admit('a')
+        admission.admit('a')
+        self.assertEqual(admission.inflight, 1)
+
+    def test_tracked_clients_are_bounded(self):
+        admission = AdmissionController(AdmissionLimits(client_rate=0.1,
+            client_burst=1, max_inflight_per_client=None))
+        admission.MAX_TRACKED_CLIENTS = 2
+        for client in ('a', 'b', 'c'):
+            admission.admit(client)
+        self.assertEqual(list(admission.buckets), ['b', 'c'])
+
+class AdmissionRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    async def start_server(self, **limits):
+        server, port = await start_rest_server(self.client,
+                limits=AdmissionLimits(**limits))
+        self.addCleanup(server.close)
+        return port
+
+    async def test_rate_limited(self):
+        port = await self.start_server(client_rate=0.5, client_burst=2)
+        for _ in range(2):
+            response = await http_request(port, 'GET', '/version/')
+            self.assertEqual(response.status, 200)
+        response = await http_request(port, 'GET', '/version/')
+        self.assertEqual(response.status, 429)
+        self.assertEqual(response.headers['retry-after'], '2')
+
+    async def test_connection_shed(self):
+        port = await self.start_server(max_connections=0, retry_after=5)
+        # The response comes before the request is even read: sending
+        # one would have the connection reset
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        data = await reader.read()
+        writer.close()
+        self.assertTrue(data.startswith(b'HTTP/1.1 503 '))
+        self.assertIn(b'\r\nRetry-After: 5\r\n', data)
+        self.assertIn(b'\r\nConnection: close\r\n', data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class BatchCommandTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    async def send(self, commands):
+        response = await http_request(self.port, 'POST', '/actuators/send/', commands)
+        self.assertEqual(response.status, 200)
+        return response.json()
+
+    async def test_nodes_sharing_a_value_share_a_frame(self):
+        results = await self.send([
+            {'node': 0, 'value': '50%'},
+            {'node': 1, 'value': '50%'},
+            {'node': 2, 'value': '20%'},
+        ])
+        self.assertEqual([result['status'] for result in results],
+                ['accepted'] * 3)
+        self.assertEqual(results[0]['session_id'], results[1]['session_id'])
+        self.assertNotEqual(results[0]['session_id'], results[2]['session_id'])
+
+    async def test_invalid_entries_are_reported_alone(self):
+        results = await self.send([
+            {'node': 0, 'value': '50%'},
+            {'node': 1, 'value': 'sideways'},
+            {'node': 300, 'value': '50%'},
+            'node 2',
+        ])
+        self.assertEqual([result['status'] for result in results],
+                ['accepted', 'error', 'error', 'error'])
+
+    async def test_duplicate_nodes_keep_their_last_value(self):
+        results = await self.send([
+            {'node': 0, 'value': '10%'},
+            {'node': 1, 'value': '10%'},
+            {'node': 0, 'value': '50%'},
+        ])
+        self.assertEqual([result['status'] for result in results],
+                ['superseded', 'accepted', 'accepted'])
+        self.assertNotEqual(results[1]['session_id'], results[2]['session_id'])
+        self.assertEqual(self.simulator.nodes[0].target, 0x6400)
+
+    async def test_rejects_a_body_which_is_not_a_list(self):
+        response = await http_request(self.port, 'POST', '/actuators/send/',
+                {'node': 0, 'value': '50%'})
+        self.assertEqual(response.status, 400)
+
+if __name__ == '__main__':
+    unittest.main()
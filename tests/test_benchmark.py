@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+import messages.info
+from benchmark import Benchmark, build_benchmarks, compare, make_stream
+from client import KlfConnection
+
+class StreamTest(unittest.TestCase):
+    def test_streams_decode_whatever_the_chunk_size(self):
+        for escape_density in (0, 0.5):
+            stream = make_stream(escape_density, 20)
+            for chunk_size in (1, 7, len(stream)):
+                with self.subTest(escape_density=escape_density, chunk_size=chunk_size):
+                    connection = KlfConnection(instrumented=False)
+                    for offset in range(0, len(stream), chunk_size):
+                        connection.receive_data(stream[offset:offset + chunk_size])
+                    events = list(connection.iter_events())
+                    self.assertEqual([event.node_id for event in events], list(range(20)))
+                    self.assertTrue(all(isinstance(event,
+                        messages.info.GetAllNodesInformationNtf) for event in events))
+
+class CompareTest(unittest.TestCase):
+    def test_regressions(self):
+        baseline = {'fast': (1000, 100), 'lean': (1000, 1000), 'gone': (1, 1)}
+        results = {'fast': (700, 100), 'lean': (1000, 1400), 'new': (1, 1)}
+        regressions = compare(results, baseline, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('fast: 700 ops/s'))
+        self.assertTrue(regressions[1].startswith('lean: 1400 B/op'))
+
+    def test_within_tolerance(self):
+        self.assertEqual(compare({'fast': (900, 150)}, {'fast': (1000, 100)}, 0.2), [])
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run(self):
+        calls = []
+        ops_per_second, bytes_per_op = Benchmark('append',
+                lambda: calls.append(None), ops=2).run(0.01)
+        self.assertGreater(ops_per_second, 0)
+        self.assertGreaterEqual(len(calls), 11)
+
+    def test_names_are_unique(self):
+        names = [benchmark.name for benchmark in build_benchmarks()]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn('response[GetAllNodesInformationNtf]', names)
+
+if __name__ == '__main__':
+    unittest.main()
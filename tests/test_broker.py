@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import asyncio
+import os
+import stat
+import tempfile
+import types
+import unittest
+
+import messages.auth
+import messages.command_handler
+import messages.commands
+import messages.general
+import messages.info
+from broker import (KlfBroker, KlfBrokerClient, KlfBrokerError, MSG_NOTIFY,
+        SESSION_BLOCK, pack_message, prepare_socket_directory, raw_request,
+        read_message, run_worker, start_broker_server)
+from messages.command_handler import KlfSessionId
+from main import load_config
+from messages.fp import parse_value
+from simulator import build_frame
+from tests.helpers import connect_simulator
+
+class MessageTest(unittest.IsolatedAsyncioTestCase):
+    async def test_round_trip(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data(pack_message(MSG_NOTIFY, 7, b'frame'))
+        self.assertEqual(await read_message(reader), (MSG_NOTIFY, 7, b'frame'))
+
+class RawRequestTest(unittest.TestCase):
+    def test_request(self):
+        request = raw_request(bytes(messages.general.GetVersionReq()))
+        self.assertEqual(type(request).__name__, 'GetVersionReq')
+        self.assertIs(request.cfm_type, messages.general.GetVersionCfm)
+        self.assertEqual(bytes(request), bytes(messages.general.GetVersionReq()))
+
+    def test_invalid_frames(self):
+        for frame in (b'\x00', build_frame(messages.general.GetVersionCfm,
+                bytes(6), 0, 0, 0)):
+            with self.subTest(frame=frame):
+                self.assertRaises(KlfBrokerError, raw_request, frame)
+
+    def test_forbidden_requests(self):
+        virgin_state = types.SimpleNamespace(
+                klf_command=messages.commands.GW_CS_VIRGIN_STATE_REQ)
+        for frame in (bytes(messages.auth.PasswordChangeReq(b'old', b'new')),
+                build_frame(virgin_state)):
+            with self.subTest(frame=frame):
+                self.assertRaises(KlfBrokerError, raw_request, frame)
+
+class SocketDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_create_private_directory(self):
+        path = os.path.join(self.directory, 'broker', 'broker.sock')
+        prepare_socket_directory(path)
+        mode = os.stat(os.path.dirname(path)).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0o700)
+
+    def test_shared_directory(self):
+        os.chmod(self.directory, 0o777)
+        self.assertRaises(KlfBrokerError, prepare_socket_directory,
+                os.path.join(self.directory, 'broker.sock'))
+
+class BrokerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.addCleanup(KlfSessionId.set_session_range, *KlfSessionId._session_range)
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.broker = KlfBroker(self.client)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'broker.sock')
+        self.server = await start_broker_server(self.broker, self.path)
+        self.addCleanup(self.server.close)
+
+    async def connect_worker(self):
+        worker = KlfBrokerClient(asyncio.get_running_loop())
+        await worker.connect(self.path)
+        self.addCleanup(worker.reader_task.cancel)
+        self.addCleanup(worker.writer.close)
+        return worker
+
+    def test_broker_sessions(self):
+        self.assertEqual(KlfSessionId._session_range, (0, SESSION_BLOCK))
+
+    def test_socket_mode(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    async def test_requests(self):
+        worker = await self.connect_worker()
+        self.assertEqual(worker.worker_index, 1)
+        self.assertEqual(KlfSessionId._session_range, (SESSION_BLOCK, 2 * SESSION_BLOCK))
+        confirmation = await worker.send(messages.general.GetVersionReq())
+        self.assertEqual(confirmation.product_group, 14)
+
+    async def test_session_frames_reach_their_worker_only(self):
+        first = await self.connect_worker()
+        second = await self.connect_worker()
+        self.assertEqual(second.worker_index, 2)
+        events = {first: [], second: []}
+        for worker, worker_events in events.items():
+            worker.add_listener(worker_events.append)
+
+        # The second worker allocates from its own block
+        request = messages.command_handler.CommandSendReq(
+                main_parameter=parse_value('50%'), nodes=(1,))
+        self.assertEqual(request.session_id // SESSION_BLOCK, 2)
+        self.assertTrue((await second.send(request)).is_success)
+        while not any(isinstance(event, messages.command_handler.SessionFinishedNtf)
+                for event in events[second]):
+            await asyncio.sleep(0.01)
+
+        for worker, session_expected in ((first, False), (second, True)):
+            with self.subTest(worker=worker.worker_index):
+                self.assertEqual(any(getattr(event, 'session_id', None) == request.session_id
+                    for event in events[worker]), session_expected)
+                self.assertTrue(any(isinstance(event,
+                    messages.info.NodeStatePositionChangedNtf)
+                    for event in events[worker]))
+
+    async def test_broker_loss(self):
+        worker = await self.connect_worker()
+        self.server.close()
+        for writer in list(self.broker.workers.values()):
+            writer.close()
+        await worker.reader_task
+        with self.assertRaises(KlfBrokerError):
+            await worker.send(messages.general.GetVersionReq())
+
+    async def test_worker_exits_on_broker_loss(self):
+        args = argparse.Namespace(socket=self.path, port=0)
+        worker = asyncio.ensure_future(run_worker(args, load_config()))
+        self.addCleanup(worker.cancel)
+        while not self.broker.workers:
+            await asyncio.sleep(0.01)
+        for writer in list(self.broker.workers.values()):
+            writer.close()
+        await asyncio.wait_for(worker, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+import messages.auth
+from capture import CaptureFormatError, CaptureWriter, KlfReplayer, read_capture
+from client import KlfClient
+from framelog import FRAME_IN, FRAME_OUT, command_name
+from tests.helpers import connect_simulator
+
+class CaptureTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'traffic.klfcap')
+
+    async def capture_traffic(self):
+        with CaptureWriter(self.path) as writer:
+            client = KlfClient(asyncio.get_running_loop())
+            client.recorder = writer
+            client, simulator = await connect_simulator(client)
+            self.addCleanup(simulator.stop)
+            await client.get_all_nodes_information()
+            client.transport.close()
+        return writer.count
+
+    async def test_round_trip(self):
+        count = await self.capture_traffic()
+        records = list(read_capture(self.path))
+        self.assertEqual(len(records), count)
+        self.assertEqual([command_name(frame) for _, direction, frame in records[:2]],
+                ['GW_PASSWORD_ENTER_REQ', 'GW_PASSWORD_ENTER_CFM'])
+        self.assertEqual([direction for _, direction, frame in records[:2]],
+                [FRAME_OUT, FRAME_IN])
+
+    async def test_passwords_are_redacted(self):
+        await self.capture_traffic()
+        with open(self.path, 'rb') as capture:
+            self.assertNotIn(b'velux123', capture.read())
+
+    async def test_replay(self):
+        await self.capture_traffic()
+        replayer = KlfReplayer(self.path, 'client')
+        await replayer.run()
+        self.assertEqual(replayer.frames, sum(1 for _, direction, _ in
+            read_capture(self.path) if direction == FRAME_IN))
+        self.assertEqual(len(replayer.client.nodes), 4)
+        self.assertTrue(replayer.client.nodes.populated)
+
+    def test_invalid_files(self):
+        with open(self.path, 'wb') as capture:
+            capture.write(b'not a capture')
+        self.assertRaises(CaptureFormatError, list, read_capture(self.path))
+
+        with CaptureWriter(self.path) as writer:
+            writer.record(FRAME_OUT, bytes(messages.auth.PasswordEnterReq(b'x')))
+        with open(self.path, 'rb+') as capture:
+            capture.truncate(os.path.getsize(self.path) - 1)
+        with self.assertRaises(CaptureFormatError):
+            list(read_capture(self.path))
+
+    def test_unknown_replay_target(self):
+        self.assertRaises(ValueError, KlfReplayer, self.path, 'gateway')
+
+if __name__ == '__main__':
+    unittest.main()
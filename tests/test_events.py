@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import unittest
+
+import messages.command_handler
+from client import KlfClient
+from events import KlfEventSubscription
+from messages.base import KlfGwResponse
+from messages.fp import parse_value
+from simulator import build_frame
+from tests.helpers import connect_simulator, start_rest_server
+
+def session_finished(session_id):
+    return KlfGwResponse(build_frame(
+        messages.command_handler.SessionFinishedNtf, session_id))
+
+class EventSubscriptionTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.client = KlfClient(self.loop)
+
+    def test_drops_the_oldest_events_when_full(self):
+        with KlfEventSubscription(self.client, maxsize=2) as subscription:
+            for session_id in range(3):
+                self.client.dispatch(session_finished(session_id))
+            self.assertEqual(subscription.dropped, 1)
+            self.assertEqual(subscription.queue.get_nowait(),
+                    ('session_finished', {'session_id': 1}))
+
+    def test_unsubscribes_on_exit(self):
+        with KlfEventSubscription(self.client) as subscription:
+            pass
+        self.client.dispatch(session_finished(1))
+        self.assertTrue(subscription.queue.empty())
+
+class EventStreamTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    async def read_event(self, reader, name):
+        while True:
+            line = await reader.readline()
+            if line == b'event: ' + name.encode('ascii') + b'\n':
+                data = await reader.readline()
+                return json.loads(data[len(b'data: '):])
+
+    async def test_streams_the_events_of_a_command(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.addCleanup(writer.close)
+        writer.write(b'GET /events/ HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(await reader.readline(), b'HTTP/1.1 200 OK\r\n')
+        await asyncio.sleep(0.05)
+
+        request = messages.command_handler.CommandSendReq(
+                main_parameter=parse_value('50%'), nodes=(1,))
+        await self.client.send(request)
+        position = await asyncio.wait_for(
+                self.read_event(reader, 'node_position'), 2)
+        self.assertEqual(position['node'], 1)
+        self.assertEqual(position['target'], 50.0)
+        finished = await asyncio.wait_for(
+                self.read_event(reader, 'session_finished'), 2)
+        self.assertEqual(finished, {'session_id': request.session_id})
+
+if __name__ == '__main__':
+    unittest.main()
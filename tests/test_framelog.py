@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import stat
+import tempfile
+import unittest
+from functools import reduce
+from operator import xor
+
+import messages.auth
+import messages.general
+from framelog import FRAME_IN, FRAME_OUT, FrameRing, command_name, redact_frame
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class RedactFrameTest(unittest.TestCase):
+    def test_password_frames(self):
+        for request in (messages.auth.PasswordEnterReq(b'velux123'),
+                messages.auth.PasswordChangeReq(b'velux123', b'secret')):
+            with self.subTest(request=type(request).__name__):
+                frame = bytes(request)
+                redacted = redact_frame(frame)
+                self.assertEqual(len(redacted), len(frame))
+                self.assertEqual(redacted[:4], frame[:4])
+                self.assertEqual(redacted[4:-1], bytes(len(frame) - 5))
+                self.assertEqual(reduce(xor, redacted), 0)
+
+    def test_other_frames(self):
+        frame = bytes(messages.general.GetVersionReq())
+        self.assertIs(redact_frame(frame), frame)
+        self.assertEqual(redact_frame(b'\x00'), b'\x00')
+
+class FrameRingTest(unittest.TestCase):
+    def test_keeps_the_last_frames(self):
+        ring = FrameRing(size=3)
+        for index in range(5):
+            ring.record(FRAME_OUT if index % 2 else FRAME_IN, bytes((index,)))
+        self.assertEqual([(direction, frame) for _, direction, frame in ring],
+                [(FRAME_IN, b'\x02'), (FRAME_OUT, b'\x03'), (FRAME_IN, b'\x04')])
+
+    def test_command_name(self):
+        frame = bytes(messages.general.GetVersionReq())
+        self.assertEqual(command_name(frame), 'GW_GET_VERSION_REQ')
+        self.assertEqual(command_name(b'\x00\x03\xff\xfe'), '0xfffe')
+        self.assertIsNone(command_name(b'\x00'))
+
+    def test_dump(self):
+        ring = FrameRing()
+        ring.record(FRAME_OUT, bytes(messages.general.GetVersionReq()))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frames.txt')
+            with open(path, 'w') as planted:
+                planted.write('planted')
+            os.chmod(path, 0o644)
+            ring.dump(path)
+
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            with open(path) as dump:
+                line, = dump.read().splitlines()
+            self.assertRegex(line, ' out GW_GET_VERSION_REQ 000300080b$')
+            self.assertEqual(os.listdir(directory), ['frames.txt'])
+
+class DebugFramesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    async def test_ring_is_redacted(self):
+        password_frames = [frame for _, direction, frame in self.client.frame_ring
+                if command_name(frame) == 'GW_PASSWORD_ENTER_REQ']
+        self.assertEqual(len(password_frames), 1)
+        self.assertNotIn(self.simulator.options.password, password_frames[0])
+
+    async def test_disabled_by_default(self):
+        server, port = await start_rest_server(self.client)
+        self.addCleanup(server.close)
+        response = await http_request(port, 'GET', '/debug/frames/')
+        self.assertEqual(response.status, 404)
+
+    async def test_enabled(self):
+        server, port = await start_rest_server(self.client, debug_frames=True)
+        self.addCleanup(server.close)
+        response = await http_request(port, 'GET', '/debug/frames/')
+        self.assertEqual(response.status, 200)
+        frames = response.json()
+        self.assertEqual(frames[0]['command'], 'GW_PASSWORD_ENTER_REQ')
+        self.assertEqual(frames[0]['direction'], 'out')
+        self.assertNotIn(self.simulator.options.password.hex(), frames[0]['frame'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import unittest
+
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class HttpServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        await self.client.get_all_nodes_information()
+        self.server, self.port = await start_rest_server(self.client,
+                max_body_size=1024)
+        self.addCleanup(self.server.close)
+
+    async def test_pipelined_requests_are_answered_in_order(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.addCleanup(writer.close)
+        writer.write(b''.join(
+            'GET /actuator/{}/ HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(
+                node_id).encode('ascii') for node_id in (2, 0, 1)))
+
+        node_ids = []
+        for i in range(3):
+            self.assertEqual(await reader.readline(), b'HTTP/1.1 200 OK\r\n')
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                name, _, value = line.decode('ascii').partition(':')
+                headers[name.lower()] = value.strip()
+            body = await reader.readexactly(int(headers['content-length']))
+            node_ids.append(json.loads(body)['id'])
+        self.assertEqual(node_ids, [2, 0, 1])
+
+    async def test_rejects_large_bodies(self):
+        response = await http_request(self.port, 'POST', '/actuator/1/send/',
+                {'value': '50%', 'padding': 'x' * 2048})
+        self.assertEqual(response.status, 413)
+        self.assertEqual(response.headers['connection'], 'close')
+
+    async def test_rejects_invalid_json(self):
+        response = await http_request(self.port, 'POST', '/actuator/1/send/',
+                b'{"value": ')
+        self.assertEqual(response.status, 400)
+
+if __name__ == '__main__':
+    unittest.main()
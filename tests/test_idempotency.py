@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+from framelog import FRAME_OUT, command_name
+from rest_server import IdempotencyCache
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class IdempotencyCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def test_least_recently_used_keys_are_dropped(self):
+        cache = IdempotencyCache(max_entries=2)
+        first = cache.add('a', b'1')
+        cache.add('b', b'2')
+        self.assertIs(cache.get('a'), first)
+        cache.add('c', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertIs(cache.get('a'), first)
+
+    async def test_expiry(self):
+        cache = IdempotencyCache(ttl=0)
+        cache.add('a', b'1')
+        self.assertIsNone(cache.get('a'))
+
+    async def test_discard(self):
+        cache = IdempotencyCache()
+        first = cache.add('a', b'1')
+        second = cache.add('a', b'1')
+        cache.discard('a', first)
+        self.assertIs(cache.get('a'), second)
+        cache.discard('a', second)
+        self.assertIsNone(cache.get('a'))
+
+class IdempotentRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    def commands_sent(self):
+        return sum(1 for _, direction, frame in self.client.frame_ring
+                if direction == FRAME_OUT and command_name(frame) == 'GW_COMMAND_SEND_REQ')
+
+    def send(self, key, value='50%', node_id=1):
+        return http_request(self.port, 'POST', '/actuator/{}/send/'.format(node_id),
+                {'value': value}, headers=(('Idempotency-Key', key),))
+
+    async def test_replay(self):
+        first = await self.send('k1')
+        second = await self.send('k1')
+        self.assertEqual(first.status, 200)
+        self.assertEqual(second.status, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertNotIn('idempotent-replayed', first.headers)
+        self.assertEqual(second.headers['idempotent-replayed'], 'true')
+        self.assertEqual(self.commands_sent(), 1)
+
+    async def test_concurrent_requests(self):
+        responses = await asyncio.gather(*(self.send('k2') for _ in range(3)))
+        self.assertEqual(len(set(response.body for response in responses)), 1)
+        self.assertEqual(self.commands_sent(), 1)
+
+    async def test_key_reused_for_another_request(self):
+        await self.send('k3')
+        for value, node_id in (('20%', 1), ('50%', 2)):
+            with self.subTest(value=value, node_id=node_id):
+                response = await self.send('k3', value, node_id)
+                self.assertEqual(response.status, 422)
+        self.assertEqual(self.commands_sent(), 1)
+
+    async def test_distinct_keys(self):
+        await self.send('k4')
+        await self.send('k5')
+        self.assertEqual(self.commands_sent(), 2)
+
+    async def test_key_too_long(self):
+        response = await self.send('k' * 256)
+        self.assertEqual(response.status, 400)
+        self.assertEqual(self.commands_sent(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+import messages.command_handler
+from journal import KlfCommandJournal, KlfDuplicateCommand, KlfJournalEntry
+from messages.fp import parse_value
+from tests.helpers import connect_simulator
+
+def command(value, *nodes):
+    return messages.command_handler.CommandSendReq(
+            main_parameter=parse_value(value), nodes=nodes)
+
+class JournalTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal')
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    def open_journal(self):
+        journal = KlfCommandJournal(self.path)
+        journal.open()
+        self.addCleanup(journal.close)
+        return journal
+
+    def records(self):
+        with open(self.path) as journal_file:
+            return [json.loads(line) for line in journal_file]
+
+    def write_pending(self, *requests):
+        with open(self.path, 'w') as journal_file:
+            for key, request in requests:
+                journal_file.write(json.dumps(
+                    KlfJournalEntry.from_request(key, request).to_json()) + '\n')
+                request.free_session(request.session_id)
+
+    async def test_send(self):
+        journal = self.open_journal()
+        confirmation = await journal.send(self.client, command('50%', 1), 'a')
+        self.assertTrue(confirmation.is_success)
+        while journal.writer_task is not None:
+            await asyncio.sleep(0.01)
+        self.assertEqual([(record['op'], record['key']) for record in self.records()],
+                [('submit', 'a'), ('done', 'a')])
+        self.assertEqual(self.records()[1]['status'], 'accepted')
+        self.assertEqual(journal.entries, {})
+
+    async def test_open_keeps_pending_commands(self):
+        self.write_pending(('a', command('50%', 1)), ('b', command('20%', 2)))
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"op":"done","key":"a"}\n{"op":"sub')
+        journal = self.open_journal()
+        self.assertEqual(list(journal.entries), ['b'])
+        self.assertEqual([record['key'] for record in self.records()], ['b'])
+
+    async def test_duplicate_key(self):
+        self.write_pending(('a', command('50%', 1)))
+        journal = self.open_journal()
+        request = command('50%', 1)
+        with self.assertRaises(KlfDuplicateCommand):
+            await journal.send(self.client, request, 'a')
+        self.assertNotIn(request.session_id,
+                messages.command_handler.KlfSessionId._running_sessions)
+
+    async def test_replay(self):
+        self.write_pending(('a', command('50%', 1)), ('b', command('+10%', 2)))
+        journal = self.open_journal()
+        journal.replay(self.client)
+        await asyncio.gather(*journal.tasks)
+        while journal.writer_task is not None:
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(self.simulator.nodes[1].target, 0x6400)
+        self.assertEqual(self.simulator.nodes[2].target, 0)
+        self.assertEqual({record['key']: record['status'] for record in self.records()
+            if record['op'] == 'done'}, {'a': 'accepted', 'b': 'abandoned'})
+        self.assertEqual(journal.entries, {})
+
+    async def test_compaction_keeps_the_batch(self):
+        journal = self.open_journal()
+        journal.COMPACT_SIZE = 10
+        journal.write_sync(b'x' * 100, False)
+        journal.write_sync(b'{"op":"done","key":"a"}\n', True)
+        with open(self.path, 'rb') as journal_file:
+            self.assertEqual(journal_file.read(), b'{"op":"done","key":"a"}\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import messages.general
+from client import KlfClient
+from framelog import FRAME_OUT, command_name
+from main import KlfConfigError, config_keepalive, load_config
+from supervisor import KlfSupervisor
+from tests.helpers import connect_simulator
+
+class KeepaliveTest(unittest.IsolatedAsyncioTestCase):
+    async def connect(self, heartbeat_interval, heartbeat_timeout=1):
+        client = KlfClient(asyncio.get_running_loop(),
+                heartbeat_interval=heartbeat_interval,
+                heartbeat_timeout=heartbeat_timeout)
+        client, self.simulator = await connect_simulator(client)
+        self.addCleanup(self.simulator.stop)
+        return client
+
+    def heartbeats(self, client):
+        return sum(1 for _, direction, frame in client.frame_ring
+                if direction == FRAME_OUT and command_name(frame) == 'GW_GET_STATE_REQ')
+
+    async def test_idle_connection(self):
+        client = await self.connect(0.05)
+        await asyncio.sleep(0.28)
+        self.assertGreaterEqual(self.heartbeats(client), 3)
+        self.assertLessEqual(self.heartbeats(client), 5)
+
+    async def test_activity_postpones_heartbeats(self):
+        client = await self.connect(0.1)
+        for _ in range(10):
+            await client.send(messages.general.GetVersionReq())
+            await asyncio.sleep(0.03)
+        self.assertEqual(self.heartbeats(client), 0)
+
+    async def test_unanswered_heartbeat(self):
+        client = await self.connect(0.05, heartbeat_timeout=0.05)
+        lost = asyncio.get_running_loop().create_future()
+        client.connection_lost_handler = lost.set_result
+        # The gateway stops answering
+        self.simulator.options.latency = 10
+        await asyncio.wait_for(lost, 1)
+        self.assertIsNone(client.transport)
+        self.assertEqual(self.heartbeats(client), 1)
+
+    async def test_supervised_client(self):
+        supervisor = KlfSupervisor(asyncio.get_running_loop(), '127.0.0.1',
+                b'velux123', heartbeat_interval=5, heartbeat_timeout=2)
+        self.assertEqual(supervisor.client.heartbeat_interval, 5)
+        self.assertEqual(supervisor.client.heartbeat_timeout, 2)
+
+class KeepaliveSettingsTest(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(config_keepalive(load_config()),
+                {'heartbeat_interval': 600, 'heartbeat_timeout': 30})
+
+    def test_invalid_settings(self):
+        for interval, timeout in (('often', '30'), ('600', '0'), ('-1', '30')):
+            with self.subTest(interval=interval, timeout=timeout):
+                config = load_config()
+                config['keepalive'] = {'interval': interval, 'timeout': timeout}
+                self.assertRaises(KlfConfigError, config_keepalive, config)
+
+if __name__ == '__main__':
+    unittest.main()
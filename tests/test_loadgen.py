@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from admission import AdmissionLimits
+from loadgen import HttpConnection, LoadGenerator, parse_mix, percentile
+from tests.helpers import connect_simulator, start_rest_server
+
+class ParseMixTest(unittest.TestCase):
+    def test_weights(self):
+        self.assertEqual(parse_mix('list=6,send=2,wink'),
+                {'list': 6, 'send': 2, 'wink': 1})
+
+    def test_unknown_kind(self):
+        self.assertRaises(ValueError, parse_mix, 'list=1,scene=2')
+
+class PercentileTest(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(100))
+        self.assertEqual(percentile(values, .5), 50)
+        self.assertEqual(percentile(values, .999), 99)
+        self.assertNotEqual(percentile([], .5), percentile([], .5))
+
+class LoadGeneratorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client,
+                limits=AdmissionLimits(max_connections=None,
+                    max_inflight_per_client=None, max_queue_depth=None,
+                    client_rate=None))
+        self.addCleanup(self.server.close)
+
+    async def test_keep_alive(self):
+        connection = await HttpConnection.open('127.0.0.1', self.port)
+        self.addCleanup(connection.close)
+        for path in ('/version/', '/actuator/', '/nowhere/'):
+            status_code = await connection.request('GET', path)
+            self.assertTrue(connection.next_cycle())
+        self.assertEqual(status_code, 404)
+        self.assertEqual(await connection.request('POST', '/actuator/1/send/',
+            {'value': '50%'}), 200)
+
+    async def test_run(self):
+        generator = LoadGenerator('127.0.0.1', self.port, rate=200,
+                duration=0.2, weights=parse_mix('list,send,version'),
+                nodes=[0, 1, 2, 3])
+        elapsed = await generator.run()
+        self.assertEqual(generator.errors, {})
+        self.assertGreater(sum(map(len, generator.latencies.values())), 0)
+        self.assertIn('Errors: 0', generator.report(elapsed))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import io
+import logging
+import logging.handlers
+import queue
+import threading
+import unittest
+
+import messages.command_handler
+from logs import DeferredQueueHandler, HexDump, KeyValueFormatter
+from messages.fp import parse_value
+from tests.helpers import connect_simulator
+
+def make_record(msg, args=(), **extra):
+    record = logging.LogRecord('klf.test', logging.INFO, __file__, 1, msg,
+            args, None)
+    record.__dict__.update(extra)
+    return record
+
+class RenderedIn:
+    """
+    Log argument remembering the thread which rendered it.
+    """
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return 'rendered'
+
+class KeyValueFormatterTest(unittest.TestCase):
+    def test_fields(self):
+        line = KeyValueFormatter().format(make_record('Frame %s', ('x',),
+            command='GetStateReq', node='1,2', latency=0.25))
+        self.assertRegex(line, '^time=')
+        self.assertIn(' level=INFO logger=klf.test msg="Frame x" '
+                'command=GetStateReq node=1,2 latency=0.25', line)
+
+    def test_quoting(self):
+        formatter = KeyValueFormatter()
+        self.assertEqual(formatter.format_value('plain'), 'plain')
+        self.assertEqual(formatter.format_value(''), '""')
+        self.assertEqual(formatter.format_value('a="b"'), r'"a=\"b\""')
+
+class HexDumpTest(unittest.TestCase):
+    def test_str(self):
+        self.assertEqual(str(HexDump(b'\x00\x0a\xff')), '00:0a:ff')
+
+class DeferredQueueHandlerTest(unittest.TestCase):
+    def test_arguments_are_not_formatted(self):
+        log_queue = queue.SimpleQueue()
+        argument = RenderedIn()
+        DeferredQueueHandler(log_queue).handle(make_record('Got %s', (argument,)))
+
+        record = log_queue.get_nowait()
+        self.assertIsNone(argument.thread)
+        self.assertEqual(record.args, (argument,))
+        self.assertEqual(record.getMessage(), 'Got rendered')
+
+    def test_listener_thread_renders(self):
+        log_queue = queue.SimpleQueue()
+        stream = io.StringIO()
+        output = logging.StreamHandler(stream)
+        output.setFormatter(KeyValueFormatter())
+        listener = logging.handlers.QueueListener(log_queue, output)
+        listener.start()
+        argument = RenderedIn()
+        DeferredQueueHandler(log_queue).handle(make_record('Got %s', (argument,)))
+        listener.stop()
+
+        self.assertIn('msg="Got rendered"', stream.getvalue())
+        self.assertIsNot(argument.thread, threading.current_thread())
+
+class RequestLogTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    async def test_confirmation_fields(self):
+        request = messages.command_handler.CommandSendReq(
+                main_parameter=parse_value('50%'), nodes=(1, 2))
+        with self.assertLogs('klf.client', logging.DEBUG) as logs:
+            await self.client.send(request)
+        record, = [record for record in logs.records
+                if record.getMessage() == 'Request confirmed']
+        self.assertEqual(record.command, 'CommandSendReq')
+        self.assertEqual(record.node, '1,2')
+        self.assertEqual(record.session_id, request.session_id)
+
+if __name__ == '__main__':
+    unittest.main()
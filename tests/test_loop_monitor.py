@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import threading
+import time
+import unittest
+
+from loop_monitor import LoopMonitor, SlowCallback
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+def block_the_loop(duration):
+    time.sleep(duration)
+
+class LoopMonitorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.monitor = LoopMonitor(asyncio.get_running_loop(),
+                interval=0.01, slow_threshold=0.05)
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+
+    async def test_slow_callback(self):
+        await asyncio.sleep(0.05)
+        block_the_loop(0.2)
+        for _ in range(100):
+            if self.monitor.slow_callbacks:
+                break
+            await asyncio.sleep(0.01)
+
+        slow = self.monitor.to_json()['slow_callbacks'][0]
+        self.assertGreaterEqual(slow['duration'], 0.15)
+        self.assertIn('block_the_loop', ''.join(slow['stack']))
+        self.assertGreater(self.monitor.max_lag, 0.1)
+
+    async def test_stall(self):
+        self.monitor.stall_limit = 0.1
+        await asyncio.sleep(0.05)
+        with self.assertLogs(level='ERROR') as logs:
+            block_the_loop(0.4)
+        # Listed while the loop is still blocked
+        slow = self.monitor.slow_callbacks[0]
+        self.assertIsNone(slow.duration)
+        self.assertIn('stalled for more than 0.1s', logs.output[0])
+
+        for _ in range(100):
+            if slow.duration is not None:
+                break
+            await asyncio.sleep(0.01)
+        self.assertGreaterEqual(slow.duration, 0.35)
+
+    async def test_idle_loop(self):
+        await asyncio.sleep(0.1)
+        body = self.monitor.to_json()
+        self.assertEqual(body['slow_callbacks'], [])
+        self.assertEqual(body['interval'], 0.01)
+
+class SlowCallbackHistoryTest(unittest.TestCase):
+    def test_to_json_holds_the_lock(self):
+        monitor = LoopMonitor(None, history=2)
+        for timestamp in range(3):
+            monitor.slow_callbacks.append(SlowCallback(timestamp, []))
+        self.assertEqual([slow['timestamp'] for slow in
+            monitor.to_json()['slow_callbacks']], [1, 2])
+
+        with monitor.slow_callbacks_lock:
+            reader = threading.Thread(target=monitor.to_json)
+            reader.start()
+            reader.join(0.05)
+            self.assertTrue(reader.is_alive())
+        reader.join()
+
+class LoopRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    async def test_disabled_by_default(self):
+        server, port = await start_rest_server(self.client)
+        self.addCleanup(server.close)
+        response = await http_request(port, 'GET', '/debug/loop/')
+        self.assertEqual(response.status, 404)
+
+    async def test_enabled(self):
+        monitor = LoopMonitor(asyncio.get_running_loop())
+        server, port = await start_rest_server(self.client, loop_monitor=monitor)
+        self.addCleanup(server.close)
+        response = await http_request(port, 'GET', '/debug/loop/')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.json()['slow_callbacks'], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from main import (KlfConfigError, apply_arguments, check_config,
+        config_admission, config_gateways, load_config)
+
+CONFIG = """
+[gateway:main]
+address = 192.168.1.10
+password = velux123
+
+[gateway:garage]
+address = 192.168.1.11
+password = secret
+port = 51201
+
+[rest]
+port = 8080
+debug_frames = yes
+"""
+
+def arguments(**values):
+    args = dict.fromkeys(('gateway', 'host', 'port', 'debug_frames',
+        'loop_monitor', 'journal', 'snapshot', 'log_level'))
+    args.update(values)
+    return argparse.Namespace(**args)
+
+class ConfigTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'klf200.ini')
+        with open(self.path, 'w') as config_file:
+            config_file.write(CONFIG)
+
+    def test_load(self):
+        config = load_config(self.path)
+        self.assertEqual(config_gateways(config), [
+            ('main', '192.168.1.10', b'velux123', 51200),
+            ('garage', '192.168.1.11', b'secret', 51201),
+        ])
+        self.assertEqual(config['rest'].getint('port'), 8080)
+        self.assertTrue(config['rest'].getboolean('debug_frames'))
+        self.assertFalse(config['rest'].getboolean('loop_monitor'))
+        self.assertEqual(config['journal']['path'], '')
+        self.assertEqual(config['logging']['level'], 'INFO')
+        check_config(config)
+
+    def test_unreadable_file(self):
+        self.assertRaises(KlfConfigError, load_config, self.path + '.missing')
+        with open(self.path, 'w') as config_file:
+            config_file.write('address = nowhere\n')
+        self.assertRaises(KlfConfigError, load_config, self.path)
+
+    def test_invalid_configurations(self):
+        for section, option, value in (
+                ('gateway:main', 'port', 'http'),
+                ('rest', 'port', 'http'),
+                ('rest', 'debug_frames', 'maybe'),
+                ('rest', 'loop_monitor', 'maybe'),
+                ('logging', 'level', 'LOUD'),
+                ('keepalive', 'timeout', '0'),
+                ('admission', 'max_connections', 'many'),
+                ('admission', 'client_rate', '')):
+            with self.subTest(section=section, option=option):
+                config = load_config(self.path)
+                config[section][option] = value
+                self.assertRaises(KlfConfigError, check_config, config)
+
+    def test_admission(self):
+        config = load_config(self.path)
+        self.assertEqual(config_admission(config).max_connections, 64)
+        config['admission']['max_queue_depth'] = ''
+        config['admission']['client_rate'] = '2.5'
+        limits = config_admission(config)
+        self.assertIsNone(limits.max_queue_depth)
+        self.assertEqual(limits.client_rate, 2.5)
+
+    def test_missing_gateway(self):
+        config = load_config()
+        self.assertRaises(KlfConfigError, check_config, config)
+        config['gateway:main'] = {'address': '192.168.1.10'}
+        self.assertRaises(KlfConfigError, check_config, config)
+
+    def test_arguments_override_the_file(self):
+        config = load_config(self.path)
+        apply_arguments(config, arguments(port=9090, loop_monitor=True,
+            journal='/tmp/journal'))
+        self.assertEqual(config['rest'].getint('port'), 9090)
+        self.assertTrue(config['rest'].getboolean('loop_monitor'))
+        self.assertTrue(config['rest'].getboolean('debug_frames'))
+        self.assertEqual(config['journal']['path'], '/tmp/journal')
+
+    def test_gateway_argument(self):
+        config = load_config(self.path)
+        with mock.patch.dict(os.environ, {'KLF200_PASSWORD': 'pass'}):
+            apply_arguments(config, arguments(gateway='10.0.0.1:51300'))
+        self.assertEqual(config_gateways(config),
+                [('main', '10.0.0.1', b'pass', 51300)])
+
+        with mock.patch.dict(os.environ):
+            os.environ.pop('KLF200_PASSWORD', None)
+            self.assertRaises(KlfConfigError, apply_arguments, config,
+                    arguments(gateway='10.0.0.1'))
+
+class LazyImportTest(unittest.TestCase):
+    def test_optional_subsystems(self):
+        # A fresh interpreter, as the test run already imported them all
+        modules = subprocess.run([sys.executable, '-c',
+            'import sys, main, rest_server; print(" ".join(sys.modules))'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            check=True, capture_output=True, text=True).stdout.split()
+        for module in ('ws_server', 'journal', 'manager', 'planner',
+                'loop_monitor', 'supervisor', 'snapshot'):
+            with self.subTest(module=module):
+                self.assertNotIn(module, modules)
+
+if __name__ == '__main__':
+    unittest.main()
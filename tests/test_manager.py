@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import messages.command_handler
+from manager import KlfGatewayManager, KlfRoutingError, NODE_ID_STRIDE
+from messages.fp import parse_value
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+async def connect_manager(test_case):
+    """
+    Return a manager of two simulated gateways, and the simulators.
+    """
+    manager = KlfGatewayManager()
+    simulators = []
+    for name in ('main', 'garage'):
+        client, simulator = await connect_simulator()
+        test_case.addCleanup(simulator.stop)
+        manager.add_gateway(name, client)
+        simulators.append(simulator)
+    return manager, simulators
+
+class ManagerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.manager, self.simulators = await connect_manager(self)
+
+    def command(self, *nodes):
+        return messages.command_handler.CommandSendReq(
+                main_parameter=parse_value('50%'), nodes=nodes)
+
+    def test_locate(self):
+        gateway, local_id = self.manager.locate(NODE_ID_STRIDE + 3)
+        self.assertEqual((gateway.name, local_id), ('garage', 3))
+        for node_id in (2 * NODE_ID_STRIDE, 200, -1):
+            with self.subTest(node_id=node_id):
+                self.assertRaises(KlfRoutingError, self.manager.locate, node_id)
+
+    def test_is_node_id(self):
+        self.assertTrue(self.manager.is_node_id(199))
+        self.assertTrue(self.manager.is_node_id(5 * NODE_ID_STRIDE + 3))
+        self.assertFalse(self.manager.is_node_id(200))
+        self.assertFalse(self.manager.is_node_id(-1))
+
+    async def test_routes_to_the_node_gateway(self):
+        confirmation = await self.manager.send(self.command(NODE_ID_STRIDE + 1))
+        self.assertTrue(confirmation.is_success)
+        self.assertEqual(self.simulators[1].nodes[1].target, 0x6400)
+        self.assertEqual(self.simulators[0].nodes[1].target, 0)
+
+    async def test_message_keeps_global_node_ids(self):
+        command = self.command(NODE_ID_STRIDE + 1, NODE_ID_STRIDE + 2)
+        await self.manager.send(command)
+        self.assertEqual(tuple(command.nodes),
+                (NODE_ID_STRIDE + 1, NODE_ID_STRIDE + 2))
+
+    async def test_nodes_of_several_gateways(self):
+        with self.assertRaises(KlfRoutingError):
+            self.manager.send(self.command(1, NODE_ID_STRIDE + 1))
+
+    async def test_global_node_table(self):
+        information = await self.manager.get_all_nodes_information()
+        expected = [0, 1, 2, 3] + [NODE_ID_STRIDE + node_id for node_id in range(4)]
+        self.assertEqual(sorted(event.node_id for event in information), expected)
+        self.assertEqual([node.node_id for node in self.manager.nodes], expected)
+        self.assertTrue(self.manager.nodes.populated)
+        # Gateway tables keep their local identifiers
+        self.assertEqual([node.node_id for node in self.manager.gateways[1].client.nodes],
+                [0, 1, 2, 3])
+
+    async def test_listeners(self):
+        events = []
+        self.manager.add_listener(events.append)
+        await self.manager.send(self.command(NODE_ID_STRIDE + 2))
+        while not any(isinstance(event, messages.command_handler.SessionFinishedNtf)
+                for event in events):
+            await asyncio.sleep(0.01)
+        self.assertIn(NODE_ID_STRIDE + 2, [event.index for event in events
+            if isinstance(event, messages.command_handler.CommandRunStatusNtf)])
+
+        self.manager.remove_listener(events.append)
+        del events[:]
+        await self.manager.send(self.command(1))
+        await asyncio.sleep(0.05)
+        self.assertEqual(events, [])
+
+class ManagerRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.manager, self.simulators = await connect_manager(self)
+        self.server, self.port = await start_rest_server(self.manager)
+        self.addCleanup(self.server.close)
+
+    async def test_rest_routing(self):
+        response = await http_request(self.port, 'POST',
+                '/actuator/{}/send/'.format(NODE_ID_STRIDE + 3), {'value': '50%'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.simulators[1].nodes[3].target, 0x6400)
+
+        response = await http_request(self.port, 'POST',
+                '/actuator/{}/send/'.format(2 * NODE_ID_STRIDE + 3), {'value': '50%'})
+        self.assertEqual(response.status, 404)
+
+if __name__ == '__main__':
+    unittest.main()
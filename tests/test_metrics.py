@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+from metrics import MetricsRegistry
+from rest_server import HTTP_LATENCY, HTTP_REQUESTS
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('frames_total', 'Frames', ('direction',))
+        counter.inc(direction='in')
+        counter.inc(2, direction='in')
+        gauge = self.registry.gauge('queue_depth', 'Queue "depth"')
+        gauge.set_function(lambda: 3)
+        self.assertEqual(self.registry.expose(),
+                '# HELP frames_total Frames\n'
+                '# TYPE frames_total counter\n'
+                'frames_total{direction="in"} 3\n'
+                '# HELP queue_depth Queue "depth"\n'
+                '# TYPE queue_depth gauge\n'
+                'queue_depth 3\n')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency',
+                buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+        self.assertEqual(histogram.expose().split('\n')[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.15',
+            'latency_seconds_count 3',
+        ])
+
+    def test_label_escaping(self):
+        counter = self.registry.counter('errors_total', 'Errors', ('message',))
+        counter.inc(message='a "b"\\\n')
+        self.assertIn(r'errors_total{message="a \"b\"\\\n"} 1',
+                counter.expose())
+
+    def test_duplicate_metric(self):
+        self.registry.counter('frames_total', 'Frames')
+        self.assertRaises(ValueError, self.registry.gauge, 'frames_total', 'Frames')
+
+def request_count(route, method, status):
+    return HTTP_REQUESTS.values.get((route, method, str(status)), 0)
+
+class HttpMetricsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    async def test_errors_are_counted(self):
+        not_found = request_count('unmatched', 'GET', 404)
+        not_allowed = request_count('unmatched', 'DELETE', 405)
+        await http_request(self.port, 'GET', '/nowhere/')
+        await http_request(self.port, 'DELETE', '/version/')
+        self.assertEqual(request_count('unmatched', 'GET', 404), not_found + 1)
+        self.assertEqual(request_count('unmatched', 'DELETE', 405), not_allowed + 1)
+
+    async def test_handled_requests(self):
+        count = request_count('/version/', 'GET', 200)
+        await http_request(self.port, 'GET', '/version/')
+        self.assertEqual(request_count('/version/', 'GET', 200), count + 1)
+        self.assertIn(('/version/',), HTTP_LATENCY.values)
+
+    async def test_event_streams(self):
+        count = request_count('/events/', 'GET', 200)
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        writer.write(b'GET /events/ HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        await reader.readline()
+        writer.close()
+        for _ in range(100):
+            if request_count('/events/', 'GET', 200) > count:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(request_count('/events/', 'GET', 200), count + 1)
+        self.assertNotIn(('/events/',), HTTP_LATENCY.values)
+
+    async def test_exposition(self):
+        await http_request(self.port, 'GET', '/version/')
+        response = await http_request(self.port, 'GET', '/metrics/')
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+        self.assertIn(b'\nhttp_requests_total{route="/version/",method="GET",status="200"} ',
+                response.body)
+        self.assertIn(b'\nhttp_connections ', response.body)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import messages.info
+from messages.base import KlfGwResponse
+from nodes import KlfNodeTable
+from simulator import build_frame
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+def position_ntf(node_id, position):
+    return KlfGwResponse(build_frame(messages.info.NodeStatePositionChangedNtf,
+        node_id, 4, position, position, 0, 0, 0, 0, 0, 0))
+
+def information_ntf(node_id, name):
+    return KlfGwResponse(build_frame(messages.info.GetAllNodesInformationNtf,
+        node_id, node_id, 0, name.encode('utf-8'), 0, 0x0040, 14, 2, 0, 0, 0,
+        b'\0' * 8, 4, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+def finished_ntf():
+    return KlfGwResponse(build_frame(
+        messages.info.GetAllNodesInformationFinishedNtf))
+
+class KlfNodeTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = KlfNodeTable()
+
+    def test_versions(self):
+        self.table(position_ntf(1, 0))
+        self.table(position_ntf(2, 0))
+        self.assertEqual(self.table.version, 2)
+        cursor = self.table.version
+
+        self.table(position_ntf(1, 0))
+        self.assertEqual(self.table.version, 2, "Unchanged nodes keep the version")
+        self.table(position_ntf(1, 0x6400))
+        self.assertEqual([node.node_id for node in self.table.changed_since(cursor)], [1])
+        self.assertEqual([node.node_id for node in self.table.changed_since(0)], [1, 2])
+
+    def test_etag(self):
+        etag = self.table.etag
+        self.assertIn(self.table.epoch, etag)
+        self.table(position_ntf(1, 0))
+        self.assertNotEqual(self.table.etag, etag)
+        self.assertNotEqual(KlfNodeTable().epoch, self.table.epoch)
+
+    def test_stale_sweep(self):
+        for node_id in (1, 2, 3):
+            self.table(information_ntf(node_id, 'Node {}'.format(node_id)))
+        self.table(finished_ntf())
+        self.assertTrue(self.table.populated)
+
+        self.table.stale = True
+        version = self.table.version
+        for node_id in (1, 3):
+            self.table(information_ntf(node_id, 'Node {}'.format(node_id)))
+        self.table(finished_ntf())
+        self.assertFalse(self.table.stale)
+        self.assertEqual([node.node_id for node in self.table], [1, 3])
+        self.assertGreater(self.table.version, version)
+        self.assertEqual(self.table.removed_since(version), [2])
+        self.assertEqual(self.table.removed_since(self.table.version), [])
+
+        # A node coming back is no longer removed
+        self.table(position_ntf(2, 0))
+        self.assertEqual(self.table.removed_since(version), [])
+
+    def test_sweep_of_a_fresh_table_keeps_nodes(self):
+        self.table(information_ntf(1, 'Node 1'))
+        self.table(position_ntf(2, 0))
+        self.table(finished_ntf())
+        self.assertEqual(len(self.table), 2)
+
+class NodeListRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    async def move_node(self, node_id):
+        version = self.client.nodes.version
+        response = await http_request(self.port, 'POST',
+                '/actuator/{}/send/'.format(node_id), {'value': '50%'})
+        self.assertEqual(response.status, 200)
+        while self.client.nodes.version == version:
+            await asyncio.sleep(0.01)
+
+    async def test_delta(self):
+        response = await http_request(self.port, 'GET', '/actuator/?since=0')
+        body = response.json()
+        self.assertTrue(body['full'])
+        self.assertEqual(len(body['nodes']), 4)
+        self.assertEqual(body['cursor'], '{}:{}'.format(body['epoch'], body['version']))
+        self.assertEqual(response.headers['x-node-table-epoch'], body['epoch'])
+
+        await self.move_node(2)
+        for since in (body['cursor'], str(body['version'])):
+            with self.subTest(since=since):
+                response = await http_request(self.port, 'GET',
+                        '/actuator/?since=' + since)
+                delta = response.json()
+                self.assertFalse(delta['full'])
+                self.assertEqual([node['id'] for node in delta['nodes']], [2])
+
+    async def test_removed_nodes(self):
+        response = await http_request(self.port, 'GET', '/actuator/?since=0')
+        cursor = response.json()['cursor']
+        self.assertEqual(response.json()['removed'], [])
+
+        # The gateway forgot a node while the table was stale
+        del self.simulator.nodes[3]
+        self.client.nodes.stale = True
+        await self.client.get_all_nodes_information()
+        response = await http_request(self.port, 'GET', '/actuator/?since=' + cursor)
+        delta = response.json()
+        self.assertFalse(delta['full'])
+        self.assertEqual(delta['nodes'], [])
+        self.assertEqual(delta['removed'], [3])
+
+        response = await http_request(self.port, 'GET',
+                '/actuator/?since=' + delta['cursor'])
+        self.assertEqual(response.json()['removed'], [])
+
+    async def test_cursor_of_another_epoch(self):
+        await http_request(self.port, 'GET', '/actuator/')
+        for since in ('00000000:1', '{}:{}'.format(self.client.nodes.epoch, 10 ** 6)):
+            with self.subTest(since=since):
+                response = await http_request(self.port, 'GET',
+                        '/actuator/?since=' + since)
+                body = response.json()
+                self.assertTrue(body['full'])
+                self.assertEqual(len(body['nodes']), 4)
+
+    async def test_not_modified(self):
+        response = await http_request(self.port, 'GET', '/actuator/')
+        etag = response.headers['etag']
+        response = await http_request(self.port, 'GET', '/actuator/',
+                headers=(('If-None-Match', 'W/' + etag),))
+        self.assertEqual(response.status, 304)
+
+        await self.move_node(1)
+        response = await http_request(self.port, 'GET', '/actuator/',
+                headers=(('If-None-Match', etag),))
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.headers['etag'], etag)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import unittest
+
+from client import KlfClient
+from messages.fp import parse_value
+from planner import KlfCommandPlanner
+from tests.helpers import connect_simulator
+
+class PlannerCompileTest(unittest.TestCase):
+    def setUp(self):
+        self.planner = KlfCommandPlanner(KlfClient(asyncio.new_event_loop()))
+        self.addCleanup(self.planner.klf_client.loop.close)
+
+    def test_groups_nodes_sharing_a_value(self):
+        planned = self.planner.compile([
+            (1, parse_value('50%')),
+            (2, parse_value('0%')),
+            (3, parse_value('50%')),
+        ])
+        self.assertEqual(sorted(command.nodes for command in planned),
+                [[1, 3], [2]])
+
+    def test_splits_frames_of_more_than_20_nodes(self):
+        planned = self.planner.compile(
+                [(node_id, parse_value('50%')) for node_id in range(45)])
+        self.assertEqual([len(command.nodes) for command in planned],
+                [20, 20, 5])
+
+    def test_last_value_of_a_node_wins(self):
+        planned = self.planner.compile([
+            (1, parse_value('10%')),
+            (2, parse_value('10%')),
+            (1, parse_value('50%')),
+        ])
+        self.assertEqual(sorted((command.nodes, bytes(command.main_parameter))
+                for command in planned), [
+                    ([1], bytes(parse_value('50%'))),
+                    ([2], bytes(parse_value('10%'))),
+                ])
+
+    def test_skips_ignored_values(self):
+        self.assertTrue(self.planner.is_noop(1, parse_value('ignore')))
+
+    def test_never_skips_nodes_of_a_stale_table(self):
+        node = self.planner.klf_client.nodes.get_or_create(1)
+        node.current_position = node.target_position = 0x6400
+        self.assertTrue(self.planner.is_noop(1, parse_value('50%')))
+        self.planner.klf_client.nodes.stale = True
+        self.assertFalse(self.planner.is_noop(1, parse_value('50%')))
+
+class PlannerApplyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    async def test_apply_skips_nodes_already_in_place(self):
+        planner = KlfCommandPlanner(self.client)
+        planned, skipped = await planner.apply({
+            0: parse_value('50%'),
+            1: parse_value('50%'),
+            2: parse_value('0%'),
+        })
+        self.assertEqual(sorted(command.nodes for command in planned), [[0, 1]])
+        self.assertEqual(skipped, [2])
+        self.assertEqual([command.status for command in planned], ['accepted'])
+
+        await asyncio.sleep(0.3)
+        planned, skipped = await planner.apply({0: parse_value('50%')})
+        self.assertEqual(planned, [])
+        self.assertEqual(skipped, [0])
+
+if __name__ == '__main__':
+    unittest.main()
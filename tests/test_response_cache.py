@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import messages.general
+from messages.base import KlfGwResponse
+from rest_server import CacheEntry, ResponseCache, etag_matches
+from simulator import build_frame
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class EtagMatchesTest(unittest.TestCase):
+    def test_strong_and_weak_tags(self):
+        self.assertTrue(etag_matches('"abc"', '"abc"'))
+        self.assertTrue(etag_matches('W/"abc"', '"abc"'))
+        self.assertTrue(etag_matches(b'W/"abc"', '"abc"'))
+        self.assertFalse(etag_matches('"abd"', '"abc"'))
+
+    def test_lists_and_wildcard(self):
+        self.assertTrue(etag_matches('"x", W/"abc" , "y"', '"abc"'))
+        self.assertFalse(etag_matches('"x", "y"', '"abc"'))
+        self.assertTrue(etag_matches('*', '"abc"'))
+
+    def test_missing_header(self):
+        self.assertFalse(etag_matches(None, '"abc"'))
+
+    def test_cache_entry(self):
+        entry = CacheEntry(b'{}', 60)
+        self.assertTrue(entry.matches(entry.etag))
+        self.assertTrue(entry.matches('W/' + entry.etag))
+        self.assertNotEqual(CacheEntry(b'[]', 60).etag, entry.etag)
+
+class ResponseCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.builds = 0
+
+    async def build(self):
+        self.builds += 1
+        await asyncio.sleep(0)
+        return {'build': self.builds}
+
+    async def test_concurrent_misses_share_a_build(self):
+        cache = ResponseCache()
+        entries = await asyncio.gather(*(cache.fetch('version', self.build)
+            for _ in range(5)))
+        self.assertEqual(self.builds, 1)
+        self.assertTrue(all(entry is entries[0] for entry in entries))
+
+    async def test_expiry(self):
+        cache = ResponseCache(ttls={'clock': 0})
+        await cache.fetch('clock', self.build)
+        await cache.fetch('clock', self.build)
+        self.assertEqual(self.builds, 2)
+
+    async def test_gateway_frames_invalidate_entries(self):
+        cache = ResponseCache()
+        await cache.fetch('clock', self.build)
+        await cache.fetch('version', self.build)
+        cache(KlfGwResponse(build_frame(messages.general.SetUTCCfm)))
+        self.assertIsNone(cache.get('clock'))
+        self.assertIsNotNone(cache.get('version'))
+        cache(KlfGwResponse(build_frame(messages.general.RebootCfm)))
+        self.assertIsNone(cache.get('version'))
+
+    async def test_invalidation_during_build(self):
+        cache = ResponseCache()
+        answered = asyncio.Event()
+
+        async def build():
+            await answered.wait()
+            return {}
+
+        fetch = asyncio.ensure_future(cache.fetch('clock', build))
+        while 'clock' not in cache.pending:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        cache.invalidate(('clock',))
+        answered.set()
+        await fetch
+        self.assertIsNone(cache.get('clock'))
+
+class CachedRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    async def test_not_modified(self):
+        response = await http_request(self.port, 'GET', '/version/')
+        self.assertEqual(response.status, 200)
+        etag = response.headers['etag']
+        self.assertIn('max-age=', response.headers['cache-control'])
+
+        for if_none_match in (etag, 'W/' + etag, '"other", ' + etag):
+            with self.subTest(if_none_match=if_none_match):
+                response = await http_request(self.port, 'GET', '/version/',
+                        headers=(('If-None-Match', if_none_match),))
+                self.assertEqual(response.status, 304)
+                self.assertEqual(response.headers['etag'], etag)
+                self.assertEqual(response.body, b'')
+
+        response = await http_request(self.port, 'GET', '/version/',
+                headers=(('If-None-Match', '"other"'),))
+        self.assertEqual(response.status, 200)
+
+if __name__ == '__main__':
+    unittest.main()
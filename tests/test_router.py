@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+from router import MethodNotAllowed, RouteNotFound, Router, parse_int
+from tests.helpers import connect_simulator, http_request, start_rest_server
+
+class ParseIntTest(unittest.TestCase):
+    def test_accepts_ascii_digits(self):
+        self.assertEqual(parse_int('042'), 42)
+
+    def test_rejects_what_int_accepts(self):
+        for segment in ('-1', '+3', ' 7', '7 ', '٣', '1_000', ''):
+            with self.subTest(segment=segment):
+                self.assertRaises(ValueError, parse_int, segment)
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.router.add('GET', '/actuator/', 'list')
+        self.router.add('GET', '/actuator/<int:node_id>/', 'get')
+        self.router.add('POST', '/actuator/<int:node_id>/send/', 'send')
+        self.router.add('GET', '/actuator/<name>/', 'by_name')
+
+    def test_matches_static_and_typed_segments(self):
+        self.assertEqual(self.router.match(b'GET', b'/actuator'),
+                ('list', {}, '/actuator/'))
+        self.assertEqual(self.router.match(b'POST', b'/actuator/3/send/?x=1'),
+                ('send', {'node_id': 3}, '/actuator/<int:node_id>/send/'))
+
+    def test_falls_back_to_other_parameters(self):
+        self.assertEqual(self.router.match('GET', '/actuator/-1/'),
+                ('by_name', {'name': '-1'}, '/actuator/<name>/'))
+
+    def test_unknown_path(self):
+        self.assertRaises(RouteNotFound, self.router.match, 'GET', '/actuator/3/stop/')
+        self.assertRaises(RouteNotFound, self.router.match, 'POST', '/actuator/+3/send/')
+
+    def test_method_not_allowed(self):
+        with self.assertRaises(MethodNotAllowed) as context:
+            self.router.match('DELETE', '/actuator/3/')
+        self.assertEqual(context.exception.allowed, ['GET'])
+
+class NodeRouteTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+
+    async def test_invalid_node_ids_are_not_found(self):
+        for node_id in ('-1', '+3', '%207', '300', '200'):
+            with self.subTest(node_id=node_id):
+                response = await http_request(self.port, 'POST',
+                        '/actuator/{}/send/'.format(node_id), {'value': '50%'})
+                self.assertEqual(response.status, 404)
+
+    async def test_highest_node_id(self):
+        response = await http_request(self.port, 'POST', '/actuator/199/send/',
+                {'value': '50%'})
+        self.assertEqual(response.status, 200)
+
+if __name__ == '__main__':
+    unittest.main()
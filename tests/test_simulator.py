@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import unittest
+
+import messages.command_handler
+import messages.general
+from client import FRAMES, KlfClient
+from messages.fp import parse_value
+from simulator import KlfSimulator, SimulatorConnection
+from tests.helpers import connect_loopback, connect_simulator, simulator_options
+
+class SimulatorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+
+    async def test_command_moves_nodes(self):
+        request = messages.command_handler.CommandSendReq(
+                main_parameter=parse_value('50%'), nodes=(1, 2))
+        finished = self.client.loop.create_future()
+        self.client.add_listener(lambda event:
+                isinstance(event, messages.command_handler.SessionFinishedNtf) and
+                event.session_id == request.session_id and
+                not finished.done() and finished.set_result(event))
+        confirmation = await self.client.send(request)
+        self.assertTrue(confirmation.is_success)
+        await asyncio.wait_for(finished, 2)
+
+        for node_id in (1, 2):
+            self.assertEqual(self.client.nodes.get(node_id).current_position,
+                    0x6400)
+        self.assertEqual(self.simulator.nodes[3].target, 0)
+
+    async def test_unknown_nodes_are_rejected(self):
+        confirmation = await self.client.send(messages.command_handler.CommandSendReq(
+            main_parameter=parse_value('50%'), nodes=(42,)))
+        self.assertFalse(confirmation.is_success)
+
+    async def test_node_information(self):
+        await self.client.get_all_nodes_information()
+        self.assertEqual([node.name for node in self.client.nodes],
+                ['Simulated node {}'.format(node_id) for node_id in range(4)])
+
+    async def test_simulator_traffic_is_not_accounted(self):
+        received = FRAMES.values.get(('in',), 0)
+        sent = FRAMES.values.get(('out',), 0)
+        await self.client.send(messages.general.GetVersionReq())
+        self.assertEqual(FRAMES.values.get(('in',), 0), received + 1)
+        self.assertEqual(FRAMES.values.get(('out',), 0), sent + 1)
+        connection, = self.simulator.connections
+        self.assertIsNone(connection.klf_connection.frame_ring)
+
+class SimulatorErrorTest(unittest.IsolatedAsyncioTestCase):
+    async def connect(self, **options):
+        simulator = KlfSimulator(simulator_options(**options))
+        simulator.start()
+        self.addCleanup(simulator.stop)
+        client = KlfClient(asyncio.get_running_loop())
+        connect_loopback(client, SimulatorConnection(simulator))
+        return client
+
+    async def test_wrong_password(self):
+        client = await self.connect()
+        confirmation = await client.authenticate(b'wrong')
+        self.assertFalse(confirmation.is_success)
+        with self.assertRaises(Exception) as context:
+            await client.send(messages.general.GetVersionReq())
+        self.assertEqual(context.exception.args[0].error_number,
+                KlfSimulator.ERROR_NOT_AUTHENTICATED)
+
+    async def test_busy(self):
+        client = await self.connect(busy_rate=1)
+        with self.assertRaises(Exception) as context:
+            await client.authenticate(b'velux123')
+        self.assertEqual(context.exception.args[0].error_number,
+                KlfSimulator.ERROR_BUSY)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import struct
+import tempfile
+import unittest
+
+from main import restore_snapshot
+from manager import KlfGatewayManager
+from nodes import KlfNodeTable
+from rest_server import RestServer
+from snapshot import (HEADER, SECTION_HEADER, SNAPSHOT_MAGIC, KlfSnapshotWriter,
+        SnapshotFormatError, encode_snapshot, load_snapshot, save_snapshot)
+from tests.helpers import connect_simulator, http_request
+
+class SnapshotTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'nodes.snapshot')
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        await self.client.get_all_nodes_information()
+
+    def load(self):
+        table = KlfNodeTable()
+        saved = load_snapshot(self.path, table)
+        return table, saved
+
+    async def test_round_trip(self):
+        self.client.nodes.get(3).remaining_time = None
+        save_snapshot(self.path, encode_snapshot(self.client.nodes, saved=1234.5))
+        table, saved = self.load()
+        self.assertEqual(saved, 1234.5)
+        self.assertTrue(table.populated)
+        self.assertTrue(table.stale)
+        self.assertEqual([node.to_json() for node in table],
+                [node.to_json() for node in self.client.nodes])
+        self.assertEqual(table.get(2).product_group, 14)
+        self.assertIsNone(table.get(3).remaining_time)
+
+    async def test_global_node_ids(self):
+        manager = KlfGatewayManager()
+        for name in ('main', 'garage'):
+            client, simulator = await connect_simulator()
+            self.addCleanup(simulator.stop)
+            manager.add_gateway(name, client)
+        await manager.get_all_nodes_information()
+        save_snapshot(self.path, encode_snapshot(manager.nodes))
+        table, _ = self.load()
+        self.assertEqual([node.node_id for node in table],
+                [0, 1, 2, 3, 1000, 1001, 1002, 1003])
+
+    async def test_unknown_sections_are_skipped(self):
+        data = encode_snapshot(self.client.nodes)
+        magic, saved, sections = HEADER.unpack_from(data)
+        save_snapshot(self.path, HEADER.pack(magic, saved, sections + 1) +
+                SECTION_HEADER.pack(9, 2, 3) + bytes(6) + data[HEADER.size:])
+        table, _ = self.load()
+        self.assertEqual(len(table), 4)
+
+    async def test_invalid_files(self):
+        data = encode_snapshot(self.client.nodes)
+        for invalid in (b'', data[:5], data[:-1],
+                b'NOTASNAP' + data[len(SNAPSHOT_MAGIC):],
+                data[:HEADER.size] + struct.pack('>BHH', 1, 4, 10) + bytes(40)):
+            with self.subTest(invalid=invalid[:12]):
+                save_snapshot(self.path, invalid)
+                self.assertRaises(SnapshotFormatError, self.load)
+
+    async def test_writer(self):
+        writer = KlfSnapshotWriter(self.path, self.client.nodes, interval=0.01)
+        writer.start()
+        self.addCleanup(writer.stop)
+        while writer.saved_version is None:
+            await asyncio.sleep(0.01)
+        modified = os.stat(self.path).st_mtime_ns
+        await asyncio.sleep(0.05)
+        self.assertEqual(os.stat(self.path).st_mtime_ns, modified)
+
+        self.client.nodes.touch(self.client.nodes.get(1))
+        while writer.saved_version[1] != self.client.nodes.version:
+            await asyncio.sleep(0.01)
+
+    async def test_writer_survives_encoding_errors(self):
+        writer = KlfSnapshotWriter(self.path, self.client.nodes, interval=0.01)
+        node = self.client.nodes.get(1)
+        node.current_position = 0x10000
+        self.client.nodes.touch(node)
+        with self.assertLogs('klf.snapshot', 'ERROR'):
+            writer.start()
+            self.addCleanup(writer.stop)
+            await asyncio.sleep(0.05)
+        self.assertFalse(os.path.exists(self.path))
+
+        node.current_position = 0
+        self.client.nodes.touch(node)
+        while writer.saved_version is None:
+            await asyncio.sleep(0.01)
+        self.assertTrue(os.path.exists(self.path))
+
+class RestoredTableTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'nodes.snapshot')
+
+    async def test_missing_or_invalid_snapshot(self):
+        self.assertFalse(restore_snapshot(KlfGatewayManager(), self.path))
+        save_snapshot(self.path, b'garbage')
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(restore_snapshot(KlfGatewayManager(), self.path))
+
+    async def test_answers_before_the_gateway_is_connected(self):
+        client, simulator = await connect_simulator()
+        self.addCleanup(simulator.stop)
+        await client.get_all_nodes_information()
+        save_snapshot(self.path, encode_snapshot(client.nodes))
+
+        manager = KlfGatewayManager()
+        self.assertTrue(restore_snapshot(manager, self.path))
+        rest_server = RestServer(manager)
+        rest_server.ready = False
+        server = await asyncio.start_server(rest_server.handle_client, '127.0.0.1', 0)
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+
+        response = await http_request(port, 'GET', '/actuator/')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['x-node-table-stale'], 'true')
+        self.assertEqual(len(response.json()), 4)
+        response = await http_request(port, 'GET', '/actuator/2/')
+        self.assertEqual(response.json()['name'], 'Simulated node 2')
+        response = await http_request(port, 'GET', '/version/')
+        self.assertEqual(response.status, 503)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import messages.auth
+import messages.general
+import messages.info
+from client import KlfClient, KlfConnectionLost
+from simulator import SimulatorConnection, generate_self_signed_cert, start_simulator
+from supervisor import CONNECTION_ATTEMPTS, RECONNECTIONS, KlfAuthenticationError, KlfSupervisor
+from tests.helpers import connect_loopback, connect_simulator, simulator_options
+
+async def wait_until(predicate, timeout=5):
+    for _ in range(int(timeout * 100)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Condition not met within {}s".format(timeout))
+
+class HeldRequestTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        client = KlfClient(asyncio.get_running_loop(), policy=KlfClient.POLICY_HOLD)
+        self.client, self.simulator = await connect_simulator(client)
+        self.addCleanup(self.simulator.stop)
+
+    async def reconnect(self):
+        connect_loopback(self.client, SimulatorConnection(self.simulator))
+        await self.client.send_now(messages.auth.PasswordEnterReq(
+            self.simulator.options.password))
+        self.client.release_held()
+
+    async def test_drop_during_node_sweep(self):
+        def drop(event):
+            if isinstance(event, messages.info.GetAllNodesInformationNtf) and \
+                    self.client.transport is not None:
+                self.client.transport.close()
+        self.client.add_listener(drop)
+        with self.assertRaises(KlfConnectionLost):
+            await asyncio.wait_for(self.client.get_all_nodes_information(), 2)
+        self.client.remove_listener(drop)
+
+        # The sweep can be run again once reconnected
+        sweep = asyncio.ensure_future(self.client.get_all_nodes_information())
+        await self.reconnect()
+        self.assertEqual(len(await asyncio.wait_for(sweep, 2)), 4)
+
+    async def test_sweep_held_while_disconnected(self):
+        self.client.transport.close()
+        await wait_until(lambda: self.client.transport is None)
+        sweep = asyncio.ensure_future(self.client.get_all_nodes_information())
+        await asyncio.sleep(0.01)
+        self.assertFalse(sweep.done())
+        await self.reconnect()
+        self.assertEqual(len(await asyncio.wait_for(sweep, 2)), 4)
+
+@unittest.skipUnless(shutil.which('openssl'), "needs the openssl command")
+class SupervisorTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cert, cls.key = generate_self_signed_cert(cls.directory.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    async def asyncSetUp(self):
+        await self.start_simulator()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def start_simulator(self, port=0):
+        self.server, self.simulator = await start_simulator('127.0.0.1', port,
+                simulator_options(), self.cert, self.key)
+        self.addCleanup(self.simulator.stop)
+        self.addCleanup(self.server.close)
+
+    def supervise(self, password=b'velux123', **options):
+        supervisor = KlfSupervisor(asyncio.get_running_loop(), '127.0.0.1',
+                password, self.port, min_delay=0.01, max_delay=0.05, **options)
+        self.addCleanup(supervisor.close)
+        return supervisor
+
+    async def test_start(self):
+        client = await self.supervise().start()
+        confirmation = await client.send(messages.general.GetVersionReq())
+        self.assertEqual(confirmation.product_group, 14)
+        connection, = self.simulator.connections
+        self.assertTrue(connection.monitor_enabled)
+
+    async def test_silent_gateway(self):
+        failed = CONNECTION_ATTEMPTS.values.get(('failed',), 0)
+        self.simulator.options.latency = 10
+        start = asyncio.ensure_future(self.supervise(answer_timeout=0.05).start())
+        await wait_until(lambda:
+                CONNECTION_ATTEMPTS.values.get(('failed',), 0) >= failed + 2)
+        self.assertFalse(start.done())
+
+        self.simulator.options.latency = 0
+        client = await asyncio.wait_for(start, 5)
+        self.assertIsNotNone(client.transport)
+
+    async def test_invalid_password(self):
+        with self.assertRaises(KlfAuthenticationError):
+            await self.supervise(b'wrong').start()
+
+    async def test_reconnects_and_releases_held_requests(self):
+        supervisor = self.supervise()
+        client = await supervisor.start()
+        reconnections = sum(RECONNECTIONS.values.values())
+
+        # The gateway goes away for a while
+        self.server.close()
+        connection, = self.simulator.connections
+        connection.transport.abort()
+        await wait_until(lambda: not supervisor.ready)
+        request = client.send(messages.general.GetVersionReq())
+        await asyncio.sleep(0.1)
+        self.assertFalse(request.done())
+
+        await self.start_simulator(self.port)
+        confirmation = await asyncio.wait_for(request, 5)
+        self.assertEqual(confirmation.product_group, 14)
+        self.assertTrue(supervisor.ready)
+        self.assertEqual(sum(RECONNECTIONS.values.values()), reconnections + 1)
+        connection, = self.simulator.connections
+        self.assertTrue(connection.monitor_enabled)
+
+    async def test_closing_does_not_reconnect(self):
+        supervisor = self.supervise()
+        await supervisor.start()
+        supervisor.close()
+        await wait_until(lambda: not self.simulator.connections)
+        self.assertIsNone(supervisor.reconnect_task)
+
+    async def test_generated_certificate_removed_on_stop(self):
+        server, simulator = await start_simulator('127.0.0.1', 0,
+                simulator_options())
+        self.addCleanup(server.close)
+        directory = simulator.cert_directory
+        self.assertTrue(os.path.isdir(directory))
+        simulator.stop()
+        self.assertFalse(os.path.exists(directory))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import unittest
+
+import wsproto
+import wsproto.events
+
+from tests.helpers import connect_simulator, start_rest_server
+
+class WebSocketClient:
+    """
+    Minimal WebSocket client, built on wsproto.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.connection = wsproto.WSConnection(wsproto.ConnectionType.CLIENT)
+        self.messages = []
+
+    @classmethod
+    async def connect(cls, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        client = cls(reader, writer)
+        writer.write(client.connection.send(
+            wsproto.events.Request(host='localhost', target='/ws/')))
+        while not await client.receive(wsproto.events.AcceptConnection):
+            pass
+        return client
+
+    async def receive(self, event_type=wsproto.events.TextMessage):
+        """
+        Read data, and return whether an event of event_type came.
+        """
+        self.connection.receive_data(await self.reader.read(65536))
+        found = False
+        for event in self.connection.events():
+            if isinstance(event, wsproto.events.TextMessage):
+                self.messages.append(json.loads(event.data))
+            found = found or isinstance(event, event_type)
+        return found
+
+    async def request(self, message):
+        self.writer.write(self.connection.send(
+            wsproto.events.TextMessage(data=json.dumps(message))))
+        while True:
+            for received in self.messages:
+                if received.get('id') == message.get('id') and \
+                        received.get('type') != 'event':
+                    return received
+            await self.receive()
+
+    async def event(self, name):
+        while True:
+            for received in self.messages:
+                if received.get('event') == name:
+                    return received['data']
+            await self.receive()
+
+    def close(self):
+        self.writer.close()
+
+class WebSocketTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client, self.simulator = await connect_simulator()
+        self.addCleanup(self.simulator.stop)
+        self.server, self.port = await start_rest_server(self.client)
+        self.addCleanup(self.server.close)
+        self.ws = await WebSocketClient.connect(self.port)
+        self.addCleanup(self.ws.close)
+
+    async def test_commands_and_their_events(self):
+        reply = await self.ws.request(
+                {'id': 1, 'type': 'send', 'node': 2, 'value': '50%'})
+        self.assertEqual(reply['status'], 'accepted')
+        finished = await asyncio.wait_for(self.ws.event('session_finished'), 2)
+        self.assertEqual(finished['session_id'], reply['session_id'])
+
+    async def test_wink(self):
+        reply = await self.ws.request(
+                {'id': 2, 'type': 'wink', 'nodes': [1, 2], 'time': 10})
+        self.assertEqual(reply['status'], 'accepted')
+
+    async def test_invalid_wink_time(self):
+        for wink_time in ('ten', 300, -1, None):
+            reply = await self.ws.request(
+                    {'id': 3, 'type': 'wink', 'node': 1, 'time': wink_time})
+            self.assertEqual(reply['status'], 'error')
+            self.assertIn('between 0 and 255', reply['message'])
+            self.ws.messages.clear()
+
+    async def test_invalid_messages(self):
+        reply = await self.ws.request({'id': 4, 'type': 'dance'})
+        self.assertEqual(reply, {'id': 4, 'status': 'error',
+            'message': 'Invalid message'})
+        reply = await self.ws.request({'id': 5, 'type': 'send', 'nodes': [],
+            'value': '50%'})
+        self.assertEqual(reply['status'], 'error')
+
+    async def test_invalid_node_ids(self):
+        for nodes in ([-1], [1, 200], [5000]):
+            with self.subTest(nodes=nodes):
+                reply = await self.ws.request({'id': 6, 'type': 'status',
+                    'nodes': nodes})
+                self.assertEqual(reply['status'], 'error')
+                self.assertEqual(reply['message'],
+                        'Unknown node {}'.format(nodes[-1]))
+                self.ws.messages.clear()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# pyKlf200 - Python client implementation of the Velux KLF200 protocol
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+WebSocket control channel: commands and notification events share a
+single persistent connection.
+
+Clients send JSON messages such as:
+
+    {"id": 1, "type": "send", "node": 3, "value": "50%"}
+    {"id": 2, "type": "wink", "nodes": [3, 4], "time": 10}
+    {"id": 3, "type": "scene", "scene": 2}
+    {"id": 4, "type": "status", "node": 3}
+
+and get replies bearing the same "id". Notifications are pushed as
+{"type": "event", "event": ..., "data": ...} messages.
+"""
+
+import asyncio
+import json
+import logging
+
+import wsproto.connection
+import wsproto.events
+import wsproto.utilities
+
+import messages.command_handler
+import messages.scenes
+from events import KlfEventSubscription
+from messages.fp import parse_value
+
+def accept_token(request):
+    """
+    Return the Sec-WebSocket-Accept value for an HTTP upgrade request,
+    or None if the request is not a WebSocket handshake.
+    """
+    headers = dict(request.headers)
+    if headers.get(b'upgrade', b'').lower() != b'websocket':
+        return None
+    key = headers.get(b'sec-websocket-key')
+    if key is None:
+        return None
+    return wsproto.utilities.generate_accept_token(key)
+
+class WebSocketError(Exception):
+    """
+    Exception raised when a client message cannot be handled.
+    """
+    pass
+
+class WebSocketConnection:
+    """
+    Handle a WebSocket connection once the HTTP upgrade is done.
+    """
+    def __init__(self, reader, writer, klf_client, trailing_data=b''):
+        self.reader = reader
+        self.writer = writer
+        self.klf_client = klf_client
+        self.connection = wsproto.connection.Connection(
+                wsproto.connection.ConnectionType.SERVER)
+        self.trailing_data = trailing_data
+        self.text_buffer = []
+        self.commands = set()
+
+    def send_json(self, body):
+        if self.connection.state is not wsproto.connection.ConnectionState.OPEN:
+            return
+        self.writer.write(self.connection.send(
+            wsproto.events.TextMessage(data=json.dumps(body))))
+
+    async def push_events(self, subscription):
+        while True:
+            name, data = await subscription.get()
+            self.send_json({'type': 'event', 'event': name, 'data': data})
+            await self.writer.drain()
+
+    async def run(self):
+        logging.info("WebSocket client connected")
+        with KlfEventSubscription(self.klf_client) as subscription:
+            pusher = asyncio.ensure_future(self.push_events(subscription))
+            try:
+                data = self.trailing_data
+                while True:
+                    if data:
+                        self.connection.receive_data(data)
+                        if not self.handle_events():
+                            break
+                    data = await self.reader.read(65536)
+                    if not data:
+                        break
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                pusher.cancel()
+                for command in self.commands:
+                    command.cancel()
+
+        logging.info("WebSocket client disconnected")
+        self.writer.close()
+
+    def handle_events(self):
+        """
+        Handle pending WebSocket events. Return False once the
+        connection is closed.
+        """
+        for event in self.connection.events():
+            if isinstance(event, wsproto.events.TextMessage):
+                self.text_buffer.append(event.data)
+                if event.message_finished:
+                    text = ''.join(self.text_buffer)
+                    self.text_buffer = []
+                    command = asyncio.ensure_future(self.handle_message(text))
+                    self.commands.add(command)
+                    command.add_done_callback(self.commands.discard)
+            elif isinstance(event, wsproto.events.Ping):
+                self.writer.write(self.connection.send(event.response()))
+            elif isinstance(event, wsproto.events.CloseConnection):
+                self.writer.write(self.connection.send(event.response()))
+                return False
+            elif isinstance(event, wsproto.events.BytesMessage):
+                self.send_json({'status': 'error',
+                    'message': 'Binary messages are not supported'})
+        return True
+
+    async def handle_message(self, text):
+        message_id = None
+        try:
+            try:
+                message = json.loads(text)
+                message_id = message.get('id')
+                handler = self.message_handlers[message['type']]
+            except (json.JSONDecodeError, AttributeError, KeyError):
+                raise WebSocketError('Invalid message')
+            reply = await handler(self, message)
+        except WebSocketError as e:
+            reply = {'status': 'error', 'message': str(e)}
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            reply = {'status': 'error', 'message': 'Internal error'}
+
+        reply['id'] = message_id
+        self.send_json(reply)
+
+    def get_nodes(self, message):
+        try:
+            if 'nodes' in message:
+                nodes = tuple(int(node_id) for node_id in message['nodes'])
+            else:
+                nodes = (int(message['node']),)
+        except (KeyError, TypeError, ValueError):
+            raise WebSocketError('Invalid node list')
+        if not 0 < len(nodes) <= 20:
+            raise WebSocketError('Between 1 and 20 nodes are expected')
+        for node_id in nodes:
+            if not self.klf_client.is_node_id(node_id):
+                raise WebSocketError('Unknown node {}'.format(node_id))
+        return nodes
+
+    @staticmethod
+    def session_reply(request, confirmation):
+        return {
+            'status': 'accepted' if confirmation.is_success else 'rejected',
+            'session_id': request.session_id,
+        }
+
+    async def handle_send(self, message):
+        try:
+            value = parse_value(message['value'])
+        except (KeyError, TypeError, ValueError):
+            raise WebSocketError('Invalid value')
+        command_req = messages.command_handler.CommandSendReq(
+                main_parameter=value, nodes=self.get_nodes(message))
+        return self.session_reply(command_req,
+                await self.klf_client.send(command_req))
+
+    async def handle_wink(self, message):
+        try:
+            wink_time = int(message.get('time', 15))
+        except (TypeError, ValueError):
+            wink_time = None
+        # The gateway takes a byte: seconds, or 254 and 255 for the
+        # node default and an endless wink
+        if wink_time is None or not 0 <= wink_time <= 255:
+            raise WebSocketError('Wink time must be an integer between 0 and 255')
+        wink_req = messages.command_handler.WinkSendReq(
+                wink_state=messages.command_handler.WinkSendReq.WINK_ENABLE,
+                wink_time=wink_time,
+                nodes=self.get_nodes(message))
+        return self.session_reply(wink_req,
+                await self.klf_client.send(wink_req))
+
+    async def handle_scene(self, message):
+        try:
+            scene_id = int(message['scene'])
+        except (KeyError, TypeError, ValueError):
+            raise WebSocketError('Invalid scene')
+        scene_req = messages.scenes.ActivateSceneReq(scene_id)
+        return self.session_reply(scene_req,
+                await self.klf_client.send(scene_req))
+
+    async def handle_status(self, message):
+        status_req = messages.command_handler.StatusRequestReq(
+                nodes=self.get_nodes(message))
+        return self.session_reply(status_req,
+                await self.klf_client.send(status_req))
+
+    message_handlers = {
+        'send': handle_send,
+        'wink': handle_wink,
+        'scene': handle_scene,
+        'status': handle_status,
+    }